@@ -0,0 +1,69 @@
+"""
+Compare two results of run_benchmarks.py, i.e. of two commits.
+
+The cases are matched by (case, size, temporal), and the ratios new/base of the time and the memory are printed.
+The exit code is 1 if any ratio exceeds ``1 + --threshold``, so the script can guard a CI job.
+
+    python benchmark/compare.py base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+METRICS = ["seconds", "tracemalloc_peak_mb", "max_rss_mb"]
+
+
+def load(path):
+    with open(path) as file:
+        content = json.load(file)
+    return content["meta"], {(record["case"], record["size"], record["temporal"]): record
+                             for record in content["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative increase reported as a regression")
+    parser.add_argument("--metrics", default=",".join(METRICS), help="comma separated metrics to compare")
+    parser.add_argument("--min-seconds", type=float, default=0.01,
+                        help="cases faster than this in both results are not compared by time")
+    args = parser.parse_args()
+
+    base_meta, base = load(args.base)
+    new_meta, new = load(args.new)
+    metrics = args.metrics.split(",")
+    print("base: {} ({})".format(base_meta.get("commit"), base_meta.get("time")))
+    print("new:  {} ({})".format(new_meta.get("commit"), new_meta.get("time")))
+    print("{:<22}{:>8} {:<9}".format("case", "size", "temporal") +
+          "".join("{:>24}".format(metric) for metric in metrics))
+    regressions = []
+    for key in sorted(set(base) | set(new), key=lambda key: (key[0], key[2], key[1])):
+        line = "{:<22}{:>8} {:<9}".format(key[0], key[1], str(key[2]))
+        if key not in base or key not in new:
+            print(line + "  only in " + ("new" if key in new else "base"))
+            continue
+        old_record, new_record = base[key], new[key]
+        if old_record["status"] != "ok" or new_record["status"] != "ok":
+            print(line + "  {} -> {}".format(old_record["status"], new_record["status"]))
+            continue
+        for metric in metrics:
+            old_value, new_value = old_record.get(metric), new_record.get(metric)
+            if old_value is None or new_value is None or old_value <= 0:
+                line += "{:>24}".format("-")
+                continue
+            ratio = new_value / old_value
+            flag = ""
+            small = metric == "seconds" and max(old_value, new_value) < args.min_seconds
+            if ratio > 1 + args.threshold and not small:
+                flag = " !"
+                regressions.append((key, metric, ratio))
+            line += "{:>24}".format("{:.4g} -> {:.4g} x{:.2f}{}".format(old_value, new_value, ratio, flag))
+        print(line)
+    if regressions:
+        print("\n{} regression(s) above {:.0%}".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Scaling of the data-parallel training on CPU, ``GNNWR.run(distributed=True)`` with 1 to 8 processes.
+
+The same synthetic data and model (see run_benchmarks.py) are trained in ``gnnwr.distributed.spawn`` processes,
+each with ``cpus / processes`` intra-op threads, and the median seconds per epoch (without the first epoch) are
+reported with the speedup and the scaling efficiency ``t1 / (p * tp)`` against one process.
+
+    python benchmark/distributed_scaling.py --size 20000 --epochs 6 --processes 1,2,4,8
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmarks import X_COLUMN, Y_COLUMN, SPATIAL_COLUMN, make_data  # noqa: E402
+
+
+def train(rank, world_size, args, work_dir):
+    import torch
+    from gnnwr import datasets, models
+    from gnnwr.utils import NullSink
+    torch.manual_seed(args.seed)  # the same initial model, which DistributedDataParallel also broadcasts
+    data = make_data(args.size, False, args.seed)
+    reference = {"Reference": "kmeans", "reference_size": args.reference_size} if args.reference_size else {}
+    train_dataset, valid_dataset, test_dataset = datasets.init_dataset(data, 0.15, 0.1, X_COLUMN, Y_COLUMN,
+                                                                       spatial_column=SPATIAL_COLUMN,
+                                                                       batch_size=args.batch_size, **reference)
+    model = models.GNNWR(train_dataset, valid_dataset, test_dataset, use_gpu=False,
+                         model_save_path=os.path.join(work_dir, "models"), write_path=os.path.join(work_dir, "runs"),
+                         log_path=os.path.join(work_dir, "logs") + "/", log_level=logging.WARNING,
+                         metrics_sink=NullSink())
+    model.run(args.epochs, print_frequency=args.epochs + 1, profile=True, distributed=True)
+    seconds = model.getProfile()["total_seconds"].values
+    return {"seconds_per_epoch": float(np.median(seconds[1:] if len(seconds) > 1 else seconds)),
+            "best_r2": float(model._bestr2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=20000, help="number of synthetic samples")
+    parser.add_argument("--epochs", type=int, default=6)
+    parser.add_argument("--processes", default="1,2,4,8", help="comma separated numbers of processes")
+    parser.add_argument("--batch-size", type=int, default=256, help="batch size of all the processes together")
+    parser.add_argument("--reference-size", type=int, default=500,
+                        help="number of k-means reference points, 0 for all the train points")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="intra-op threads of each process (default: the CPUs divided by the processes)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="save the result as JSON")
+    args = parser.parse_args()
+
+    from gnnwr.distributed import spawn
+    results = []
+    print("{:>10}{:>10}{:>18}{:>10}{:>12}{:>10}".format("processes", "threads", "seconds/epoch", "speedup",
+                                                        "efficiency", "best R2"), flush=True)
+    for processes in [int(p) for p in args.processes.split(",")]:
+        threads = args.threads or max((os.cpu_count() or 1) // processes, 1)
+        with tempfile.TemporaryDirectory(prefix="gnnwr_ddp_") as work_dir:
+            result = spawn(train, processes, args=(args, work_dir), threads=threads)
+        result.update(processes=processes, threads=threads)
+        base = results[0]["seconds_per_epoch"] * results[0]["processes"] if results else \
+            result["seconds_per_epoch"] * processes
+        result["speedup"] = base / result["seconds_per_epoch"]
+        result["efficiency"] = result["speedup"] / processes
+        results.append(result)
+        print("{:>10}{:>10}{:>18.4f}{:>10.2f}{:>12.1%}{:>10.4f}".format(processes, threads,
+                                                                       result["seconds_per_epoch"], result["speedup"],
+                                                                       result["efficiency"], result["best_r2"]), flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"cpus": os.cpu_count(), "size": args.size, "results": results}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Import time of gnnwr, measured with ``python -X importtime`` in fresh interpreters.
+
+The time of the required libraries (torch, numpy, pandas) is reported apart from the rest, which is the overhead of
+gnnwr itself and is checked against ``--budget-ms``. The optional heavy libraries (tensorboard, sklearn, statsmodels,
+folium, branca) must be imported on first use, so the check also fails if any of them is imported by ``import gnnwr``.
+
+    python benchmark/import_time.py --budget-ms 300
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MODULES = ["gnnwr.models", "gnnwr.datasets", "gnnwr.distributed", "gnnwr.networks", "gnnwr.raster", "gnnwr.serving",
+           "gnnwr.tuning", "gnnwr.utils"]
+CORE = ["torch", "numpy", "pandas"]
+LAZY = ["torch.utils.tensorboard", "tensorboard", "sklearn", "statsmodels", "folium", "branca", "scipy.stats"]
+
+
+def measure(modules):
+    """
+    import the modules in a fresh interpreter, return the cumulative microseconds of each imported module
+    and the total
+    """
+    env = dict(os.environ, PYTHONPATH=SRC_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+                             env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True)
+    cumulative = {}
+    total = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, us, name = line.split("|")
+        # the name is indented by two spaces per level of nesting
+        top_level = len(name) - len(name.lstrip()) <= 1
+        cumulative[name.strip()] = int(us)
+        if top_level:
+            total += int(us)
+    return cumulative, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", default=",".join(MODULES), help="comma separated modules imported together")
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters, the median is reported")
+    parser.add_argument("--budget-ms", type=float, default=300,
+                        help="max import time of gnnwr without torch, numpy and pandas")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules printed")
+    parser.add_argument("--output", default=None, help="save the result as JSON")
+    args = parser.parse_args()
+
+    runs = [measure(args.modules.split(",")) for _ in range(args.repeat)]
+    totals = np.array([total for _, total in runs]) / 1000
+    core = np.array([sum(cumulative.get(name, 0) for name in CORE) for cumulative, _ in runs]) / 1000
+    overhead = float(np.median(totals - core))
+    imported = set().union(*[cumulative for cumulative, _ in runs])
+    eager = [lazy for lazy in LAZY if any(name == lazy or name.startswith(lazy + ".") for name in imported)]
+
+    last = runs[len(runs) // 2][0]
+    print("{:<40}{:>12}".format("module (median run)", "cumulative"))
+    for name in sorted(last, key=last.get, reverse=True)[:args.top]:
+        print("{:<40}{:>10.1f}ms".format(name, last[name] / 1000))
+    print("total {:.1f} ms, torch/numpy/pandas {:.1f} ms, gnnwr overhead {:.1f} ms (budget {:.0f} ms)".format(
+        float(np.median(totals)), float(np.median(core)), overhead, args.budget_ms))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"total_ms": float(np.median(totals)), "core_ms": float(np.median(core)),
+                       "overhead_ms": overhead, "eager_imports": eager}, output, indent=2)
+
+    failed = False
+    if eager:
+        print("imported eagerly, should be imported on first use:", ", ".join(eager))
+        failed = True
+    if overhead > args.budget_ms:
+        print("the import time of gnnwr exceeds the budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
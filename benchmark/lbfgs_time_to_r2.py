@@ -0,0 +1,112 @@
+"""
+Time to a target validation R2 of the full-batch L-BFGS mode against Adagrad on the bundled datasets.
+
+Each dataset of ``data/`` is prepared once by ``init_dataset`` and GNNWR is trained with each optimizer from the same
+initial model. The wall time and the validation R2 are recorded after every epoch, and the target is
+``--target-fraction`` of the best validation R2 reached by any of the optimizers on the dataset, so the report shows how
+long each optimizer takes to get close to the best model.
+
+    python benchmark/lbfgs_time_to_r2.py --adagrad-epochs 2000 --lbfgs-epochs 100
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# file, x columns, y column, spatial columns
+DATASETS = {
+    "simulated": ("simulated_data.csv", ["x1", "x2"], ["y"], ["u", "v"]),
+    "pm25": ("pm25_data.csv", ["dem", "w10", "d10", "t2m", "aod_sat", "ndvi"], ["PM2_5"], ["proj_x", "proj_y"]),
+    "co2": ("co2_gnnwr.csv", ["Chl", "Temp", "Salt"], ["fCO2"], ["lon", "lat"]),
+}
+
+
+def train(datasets_, optimizer, epochs, args, work_dir):
+    """
+    train GNNWR with the optimizer, return the seconds and the validation R2 after each epoch
+    """
+    import torch
+    from gnnwr import models
+    from gnnwr.utils import NullSink
+    torch.manual_seed(args.seed)
+    if optimizer == "LBFGS":
+        params = {"start_lr": 1., "drop_out": 0., "optimizer_params": {"lbfgs_max_iter": args.lbfgs_max_iter}}
+    else:
+        params = {"start_lr": args.adagrad_lr}
+    model = models.GNNWR(*datasets_, optimizer=optimizer, use_gpu=False, model_save_path=os.path.join(work_dir, "models"),
+                         write_path=os.path.join(work_dir, "runs"), log_path=os.path.join(work_dir, "logs") + "/",
+                         log_level=logging.WARNING, metrics_sink=NullSink(), **params)
+    history = []
+    start = time.perf_counter()
+
+    def record(trained_model, epoch):
+        history.append((time.perf_counter() - start, float(trained_model._valid_r2)))
+
+    model.run(epochs, early_stop=args.early_stop, print_frequency=epochs + 1, callback=record)
+    return history
+
+
+def summarize(history, target):
+    """
+    epochs and seconds of the run, and to the first epoch reaching the target
+    """
+    reached = [epoch for epoch, (_, r2) in enumerate(history) if r2 >= target]
+    first = reached[0] if reached else None
+    return {"epochs": len(history), "seconds": history[-1][0], "best_r2": max(r2 for _, r2 in history),
+            "epochs_to_target": None if first is None else first + 1,
+            "seconds_to_target": None if first is None else history[first][0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", default=",".join(DATASETS), help="comma separated datasets")
+    parser.add_argument("--adagrad-epochs", type=int, default=2000)
+    parser.add_argument("--adagrad-lr", type=float, default=0.1)
+    parser.add_argument("--lbfgs-epochs", type=int, default=100)
+    parser.add_argument("--lbfgs-max-iter", type=int, default=20, help="iterations of each L-BFGS step")
+    parser.add_argument("--early-stop", type=int, default=-1, help="early stop of both optimizers")
+    parser.add_argument("--target-fraction", type=float, default=0.98,
+                        help="the target is this fraction of the best validation R2 of the dataset")
+    parser.add_argument("--batch-size", type=int, default=32, help="batch size of Adagrad")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="save the result as JSON")
+    args = parser.parse_args()
+
+    from gnnwr import datasets
+    results = {}
+    print("{:<12}{:<10}{:>8}{:>10}{:>10}{:>14}{:>16}".format("dataset", "optimizer", "epochs", "seconds", "best R2",
+                                                            "target R2", "to target s/ep"), flush=True)
+    for name in args.datasets.split(","):
+        file, x_column, y_column, spatial_column = DATASETS[name]
+        data = pd.read_csv(os.path.join(DATA_DIR, file))
+        datasets_ = datasets.init_dataset(data, 0.15, 0.1, x_column, y_column, spatial_column=spatial_column,
+                                          batch_size=args.batch_size, sample_seed=args.seed)
+        histories = {}
+        for optimizer, epochs in (("Adagrad", args.adagrad_epochs), ("LBFGS", args.lbfgs_epochs)):
+            with tempfile.TemporaryDirectory(prefix="gnnwr_lbfgs_") as work_dir:
+                histories[optimizer] = train(datasets_, optimizer, epochs, args, work_dir)
+        target = args.target_fraction * max(r2 for history in histories.values() for _, r2 in history)
+        results[name] = {"target_r2": target}
+        for optimizer, history in histories.items():
+            result = summarize(history, target)
+            results[name][optimizer] = result
+            to_target = "-" if result["seconds_to_target"] is None else \
+                "{:.2f}/{}".format(result["seconds_to_target"], result["epochs_to_target"])
+            print("{:<12}{:<10}{:>8}{:>10.2f}{:>10.4f}{:>14.4f}{:>16}".format(name, optimizer, result["epochs"],
+                                                                              result["seconds"], result["best_r2"],
+                                                                              target, to_target), flush=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
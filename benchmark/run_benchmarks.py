@@ -0,0 +1,297 @@
+"""
+Benchmarks of the main entry points of gnnwr on synthetic data.
+
+Synthetic spatial (and spatio-temporal) data in the style of ``data/simulated_data.csv`` is generated at each size,
+and every case runs in a fresh child process, which records:
+    | seconds: wall time of the measured call
+    | tracemalloc_peak_mb: peak of the python/numpy allocations during the call
+    | max_rss_mb: peak resident memory of the child process, including the setup of the case
+
+The cases are ``init_dataset``, ``init_dataset_cv``, ``init_predict_dataset``, ``run_epoch`` (``GNNWR.run``,
+seconds per epoch with the phases of ``getProfile``), ``diagnosis`` (``DIAGNOSIS``), ``reg_result``,
+``visualize_dataset`` and ``visualize_heatmap`` (``Visualize``, with the HTML rendered).
+Cases whose estimated memory exceeds ``--memory-limit-mb`` are recorded as skipped instead of run.
+
+    python benchmark/run_benchmarks.py --sizes 1000,5000 --output results.json
+    python benchmark/compare.py base.json results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+
+import numpy as np
+import pandas as pd
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+X_COLUMN = ["x1", "x2"]
+Y_COLUMN = ["y"]
+SPATIAL_COLUMN = ["u", "v"]
+TEMP_COLUMN = ["t"]
+CASES = ["init_dataset", "init_dataset_cv", "init_predict_dataset", "run_epoch", "diagnosis", "reg_result",
+         "visualize_dataset", "visualize_heatmap"]
+
+
+def make_data(size, temporal, seed):
+    """
+    synthetic data with spatially (and temporally) varying coefficients, the same columns as simulated_data.csv
+    """
+    rng = np.random.RandomState(seed)
+    u = rng.uniform(0, 25, size)
+    v = rng.uniform(0, 25, size)
+    x1 = rng.uniform(0, 1, size)
+    x2 = rng.uniform(0, 1, size)
+    beta0 = 3 + (u + v) / 12
+    beta1 = 1 + (36 - (6 - u / 2) ** 2) * (36 - (6 - v / 2) ** 2) / 324
+    beta2 = 2 + np.sin(u / 4) * np.cos(v / 4)
+    data = {"id": np.arange(size), "u": u, "v": v}
+    if temporal:
+        t = rng.randint(1, 13, size).astype(np.float64)
+        data["t"] = t
+        seasonal = 1 + 0.2 * np.sin(t / 12 * 2 * np.pi)
+        beta1, beta2 = beta1 * seasonal, beta2 / seasonal
+    data.update({"x1": x1, "x2": x2, "y": beta0 + beta1 * x1 + beta2 * x2 + rng.normal(0, 0.5, size)})
+    return pd.DataFrame(data)
+
+
+def reference_for(size, args):
+    """
+    use the train set as the reference points (the default) if its distance matrix fits in the memory limit,
+    otherwise ``--reference-size`` landmarks selected by ``--reference-method``
+    """
+    train_size = int(size * (1 - 0.15 - 0.1))
+    if size * train_size * 8 * 2 / 2 ** 20 <= args.memory_limit_mb:
+        return {}
+    return {"Reference": args.reference_method, "reference_size": args.reference_size}
+
+
+def diagnosis_mb(rows, k):
+    # DIAGNOSIS keeps (rows, rows, k) tiles and (rows, rows, k, k) products of float32
+    return rows * rows * (3 * k + k * k) * 4 / 2 ** 20
+
+
+def init(data, temporal, reference):
+    from gnnwr import datasets
+    return datasets.init_dataset(data, 0.15, 0.1, X_COLUMN, Y_COLUMN, spatial_column=SPATIAL_COLUMN,
+                                 temp_column=TEMP_COLUMN if temporal else None, **reference)
+
+
+def make_model(train_dataset, valid_dataset, test_dataset, work_dir):
+    from gnnwr import models
+    # the spatio-temporal data has two distance channels, which GTNNWR reduces with its STPNN
+    model_class = models.GTNNWR if train_dataset.temporal is not None else models.GNNWR
+    return model_class(train_dataset, valid_dataset, test_dataset, use_gpu=False,
+                       model_save_path=os.path.join(work_dir, "models"), write_path=os.path.join(work_dir, "runs"),
+                       log_path=os.path.join(work_dir, "logs") + "/")
+
+
+def save_untrained(model):
+    """
+    save the untrained network where ``reg_result`` loads it from, so the cases after training need no training
+    """
+    import torch
+    os.makedirs(model._modelSavePath, exist_ok=True)
+    torch.save(model._model, model._modelSavePath + "/" + model._modelName + ".pkl")
+
+
+class Measure:
+    def __enter__(self):
+        tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        self.tracemalloc_peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+
+def run_case(case, size, temporal, args, work_dir):
+    """
+    set up and measure one case, return the record without the process-level fields
+    """
+    import torch
+    torch.manual_seed(args.seed)
+    data = make_data(size, temporal, args.seed)
+    reference = reference_for(size, args)
+    extra = {"reference_size": reference.get("reference_size")}
+    if case == "init_dataset":
+        with Measure() as measure:
+            init(data, temporal, reference)
+    elif case == "init_dataset_cv":
+        from gnnwr import datasets
+        with Measure() as measure:
+            datasets.init_dataset_cv(data, 0.15, args.k_fold, X_COLUMN, Y_COLUMN, spatial_column=SPATIAL_COLUMN,
+                                     temp_column=TEMP_COLUMN if temporal else None, **reference)
+    elif case == "init_predict_dataset":
+        from gnnwr import datasets
+        train_dataset, _, _ = init(data, temporal, reference)
+        predict_data = make_data(size, temporal, args.seed + 1)
+        with Measure() as measure:
+            datasets.init_predict_dataset(predict_data, train_dataset, X_COLUMN, spatial_column=SPATIAL_COLUMN,
+                                          temp_column=TEMP_COLUMN if temporal else None)
+    elif case == "run_epoch":
+        model = make_model(*init(data, temporal, reference), work_dir)
+        with Measure() as measure:
+            model.run(args.epochs, print_frequency=args.epochs + 1, profile=True)
+        profile = model.getProfile()
+        # the first epoch includes warm up
+        steady = profile.iloc[1:] if len(profile) > 1 else profile
+        extra["run_seconds"] = measure.seconds
+        extra["phases"] = {column[:-len("_seconds")]: float(steady[column].mean())
+                           for column in steady.columns if column.endswith("_seconds")}
+        measure.seconds = float(steady["total_seconds"].median())
+    elif case == "diagnosis":
+        from gnnwr.utils import DIAGNOSIS
+        k = len(X_COLUMN) + 1
+        weight = torch.rand(size, k)
+        x_data = torch.cat((torch.rand(size, k - 1), torch.ones(size, 1)), dim=1)
+        y_data = torch.rand(size, 1)
+        y_pred = torch.sum(weight * x_data, dim=1, keepdim=True)
+        with Measure() as measure:
+            diagnosis = DIAGNOSIS(weight, x_data, y_data, y_pred)
+            diagnosis.R2(), diagnosis.RMSE(), diagnosis.AIC(), diagnosis.AICc()
+    elif case == "reg_result":
+        model = make_model(*init(data, temporal, reference), work_dir)
+        save_untrained(model)
+        with Measure() as measure:
+            model.reg_result(only_return=True)
+    elif case in ("visualize_dataset", "visualize_heatmap"):
+        from gnnwr.utils import Visualize
+        model = make_model(*init(data, temporal, reference), work_dir)
+        save_untrained(model)
+        model.result_data = model.getWeights()
+        with Measure() as measure:
+            visualize = Visualize(model, lon_lat_columns=SPATIAL_COLUMN)
+            if case == "visualize_dataset":
+                result = visualize.display_dataset(y_column=Y_COLUMN[0])
+            else:
+                result = visualize.weights_heatmap("weight_x1")
+            result.get_root().render()
+    else:
+        raise ValueError("unknown case " + case)
+    record = {"seconds": measure.seconds, "tracemalloc_peak_mb": measure.tracemalloc_peak_mb}
+    record.update(extra)
+    return record
+
+
+def skip_reason(case, size, args):
+    k = len(X_COLUMN) + 1
+    train_size = int(size * (1 - 0.15 - 0.1))
+    if case == "diagnosis" and diagnosis_mb(size, k) > args.memory_limit_mb:
+        return "DIAGNOSIS of {} rows needs about {:.0f} MB".format(size, diagnosis_mb(size, k))
+    if case == "run_epoch" and diagnosis_mb(train_size, k) > args.memory_limit_mb:
+        return "DIAGNOSIS of the {} train rows needs about {:.0f} MB".format(train_size, diagnosis_mb(train_size, k))
+    return None
+
+
+def child(connection, case, size, temporal, args):
+    work_dir = tempfile.mkdtemp(prefix="gnnwr_benchmark_")
+    try:
+        import warnings
+        warnings.simplefilter("ignore")
+        # keep the output of the library away from the results
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                record = run_case(case, size, temporal, args, work_dir)
+            finally:
+                sys.stdout = stdout
+        record["status"] = "ok"
+    except Exception:
+        record = {"status": "error", "error": traceback.format_exc(limit=3)}
+    record["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    connection.send(record)
+    connection.close()
+
+
+def measure_case(case, size, temporal, args):
+    record = {"case": case, "size": size, "temporal": temporal}
+    reason = skip_reason(case, size, args)
+    if reason is not None:
+        record.update({"status": "skipped", "reason": reason})
+        return record
+    context = multiprocessing.get_context("fork" if sys.platform != "win32" else "spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(sender, case, size, temporal, args))
+    process.start()
+    sender.close()
+    if receiver.poll(args.timeout):
+        try:
+            record.update(receiver.recv())
+        except EOFError:
+            record.update({"status": "crashed", "exitcode": process.exitcode})
+        process.join()
+    else:
+        process.terminate()
+        process.join()
+        record.update({"status": "timeout", "timeout": args.timeout})
+    if process.exitcode not in (0, None) and "status" not in record:
+        record.update({"status": "crashed", "exitcode": process.exitcode})
+    return record
+
+
+def metadata(args):
+    import torch
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(SRC_DIR),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,5000,10000,50000", help="comma separated numbers of rows")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated cases")
+    parser.add_argument("--modes", default="spatial,spatiotemporal", help="spatial and/or spatiotemporal")
+    parser.add_argument("--epochs", type=int, default=3, help="epochs of run_epoch")
+    parser.add_argument("--k-fold", type=int, default=5, help="folds of init_dataset_cv")
+    parser.add_argument("--reference-size", type=int, default=1000,
+                        help="landmark reference points used when the full distance matrix exceeds the memory limit")
+    parser.add_argument("--reference-method", default="kmeans", help="landmark method of init_dataset")
+    parser.add_argument("--memory-limit-mb", type=float, default=2048,
+                        help="cases estimated to need more memory are skipped")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before a case is stopped")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes.split(","):
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for case in args.cases.split(","):
+                record = measure_case(case, size, mode == "spatiotemporal", args)
+                results.append(record)
+                print("{:<22}{:>8} {:<15}{:<8}{}".format(
+                    case, size, mode, record["status"],
+                    "{:.4f}s".format(record["seconds"]) if record["status"] == "ok" else record.get("reason", "")),
+                    flush=True)
+    with open(args.output, "w") as output:
+        json.dump({"meta": metadata(args), "results": results}, output, indent=2)
+    print("results are saved in", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Local load test of the micro-batching predictor.
+
+A small GNNWR is trained on the simulated data, then ``--clients`` concurrent clients send requests of
+``--points`` points for ``--seconds`` seconds, once to ``BatchPredictor`` and once the unbatched way
+(``init_predict_dataset`` + ``predict`` for every request), and the latency/throughput of both are printed.
+
+    python benchmark/serving_load_test.py --clients 32 --points 4 --seconds 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from gnnwr import datasets, models  # noqa: E402
+from gnnwr.serving import BatchPredictor  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+X_COLUMN = ["x1", "x2"]
+SPATIAL_COLUMN = ["u", "v"]
+
+
+def train_model(work_dir, epochs):
+    data = pd.read_csv(os.path.join(DATA_DIR, "simulated_data.csv"))
+    train_dataset, valid_dataset, test_dataset = datasets.init_dataset(data, 0.15, 0.1, X_COLUMN, ["y"],
+                                                                       spatial_column=SPATIAL_COLUMN)
+    model = models.GNNWR(train_dataset, valid_dataset, test_dataset, use_gpu=False,
+                         model_save_path=os.path.join(work_dir, "models"),
+                         write_path=os.path.join(work_dir, "runs"),
+                         log_path=os.path.join(work_dir, "logs") + "/")
+    model.run(epochs, print_frequency=epochs + 1)
+    return model, train_dataset
+
+
+async def client(send, pool, points, stop_time, rng, latencies):
+    while time.perf_counter() < stop_time:
+        request = pool.iloc[rng.randint(0, len(pool), points)]
+        start = time.perf_counter()
+        await send(request)
+        latencies.append(time.perf_counter() - start)
+
+
+async def load(send, pool, clients, points, seconds, seed):
+    latencies = []
+    stop_time = time.perf_counter() + seconds
+    start = time.perf_counter()
+    await asyncio.gather(*[client(send, pool, points, stop_time, np.random.RandomState(seed + i), latencies)
+                           for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "points_per_second": len(latencies) * points / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+async def main(args):
+    work_dir = tempfile.mkdtemp(prefix="gnnwr_serving_")
+    model, train_dataset = train_model(work_dir, args.epochs)
+    pool = pd.read_csv(os.path.join(DATA_DIR, "simulated_predict_data.csv"))
+
+    predictor = BatchPredictor(model, train_dataset, X_COLUMN, SPATIAL_COLUMN, max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms)
+    async with predictor:
+        batched = await load(predictor.predict, pool, args.clients, args.points, args.seconds, args.seed)
+        batched["predictor"] = predictor.metrics()
+
+    loop = asyncio.get_running_loop()
+
+    def predict_one(request):
+        dataset = datasets.init_predict_dataset(request.reset_index(drop=True), train_dataset, X_COLUMN,
+                                                spatial_column=SPATIAL_COLUMN)
+        return model.predict(dataset)
+
+    async def send_unbatched(request):
+        # the same thread model as the predictor, one forward pass at a time off the event loop
+        return await loop.run_in_executor(executor, predict_one, request)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        unbatched = await load(send_unbatched, pool, args.clients, args.points, args.seconds, args.seed)
+
+    print(json.dumps({"batched": batched, "unbatched": unbatched}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32, help="number of concurrent clients")
+    parser.add_argument("--points", type=int, default=4, help="points per request")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each load phase")
+    parser.add_argument("--max-batch-size", type=int, default=1024)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--epochs", type=int, default=20, help="training epochs of the served model")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,14 +1,17 @@
+import hashlib
 import json
 import os
+import sqlite3
+import time
+from collections import OrderedDict
 
 import numpy as np
 import pandas
 import pandas as pd
 import torch
-from sklearn.preprocessing import MinMaxScaler, StandardScaler
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import warnings
-from scipy.spatial import distance
+from .networks import DistanceLayer, default_dense_layer
 
 r"""
 The package of `datasets` includes the following functions:
@@ -17,14 +20,51 @@ The package of `datasets` includes the following functions:
     3. init_predict_dataset: initialize the dataset for prediction
     4. BasicDistance: calculate the distance matrix of spatial/spatio-temporal data
     5. ManhattanDistance: calculate the Manhattan distance matrix of spatial/spatio-temporal data
+    6. select_landmarks: select a small representative reference set of the data
+    7. estimate_memory: estimate the peak memory of dataset preparation, training and prediction
+    8. update_dataset: add new observations to a dataset without preparing the data again
 and the following classes:
     1. baseDataset: the base class of dataset
     2. predictDataset: the class of dataset for prediction
+    3. DistanceProvider: the base class of distance functions
+    4. TableDistance: the distances looked up in a table of unique values, used for temporal distances
+    5. MatrixDistance: the distances of the rows computed once, used for spatial distances next to a TableDistance
+    6. LazyDistances: the distance matrix whose rows are computed on demand
+    7. SparseDistances: the proximities of the reference points within a radius, as a sparse matrix
+    8. DistanceCache: the persistent cache of the distance rows of prediction
 the purpose of this package is to provide the basic functions of pre-processing data and calculating distance matrix
 to facilitate the use of the model.
 """
 
 
+# number of elements of the intermediates made at once when distances are computed or scaled in chunks
+_CHUNK_ELEMENTS = 2 ** 20
+
+
+def _chunk_rows(row_shape):
+    """
+    number of rows of a chunk with rows of the given shape
+    """
+    return max(1, _CHUNK_ELEMENTS // max(1, int(np.prod(row_shape))))
+
+
+def _float32(array):
+    """
+    the array as a C-contiguous float32 array, which ``torch.from_numpy`` wraps without copying
+    | no copy is made if the array is already one
+    """
+    return np.ascontiguousarray(array, dtype=np.float32)
+
+
+def _distance_tensor(distances):
+    """
+    the distance rows of a batch as a tensor, the rows of ``SparseDistances`` are already sparse tensors
+    """
+    if isinstance(distances, torch.Tensor):
+        return distances
+    return torch.from_numpy(_float32(distances))
+
+
 class baseDataset(Dataset):
     r"""
     baseDataset is the base class of dataset, which is used to store the data and other information.
@@ -80,6 +120,7 @@ class baseDataset(Dataset):
         self.batch_size = None
         self.shuffle = None
         self.distances_scale_param = None
+        self.distance_on_device = False  # whether to yield coordinates and compute distances on the model's device
 
     def __len__(self):
         """
@@ -92,15 +133,16 @@ class baseDataset(Dataset):
         :param index: the index of sample
         :return: the index-th distance matrix and the index-th sample
         """
+        # the arrays are float32, so the rows are wrapped without a conversion
         if self.is_need_STNN:
-            return torch.cat((torch.tensor(self.distances[index], dtype=torch.float),
-                              torch.tensor(self.temporal[index], dtype=torch.float)), dim=-1), \
-                torch.tensor(self.x_data[index], dtype=torch.float), \
-                torch.tensor(self.y_data[index], dtype=torch.float), \
+            return torch.cat((torch.from_numpy(_float32(self.distances[index])),
+                              torch.from_numpy(_float32(self.temporal[index]))), dim=-1), \
+                torch.from_numpy(_float32(self.x_data[index])), \
+                torch.from_numpy(_float32(self.y_data[index])), \
                 torch.tensor(self.id_data[index], dtype=torch.float)
-        return torch.tensor(self.distances[index], dtype=torch.float), torch.tensor(self.x_data[index],
-                                                                                    dtype=torch.float), torch.tensor(
-            self.y_data[index], dtype=torch.float), torch.tensor(self.id_data[index], dtype=torch.float)
+        distances = self.distances.inputs(index) if self.distance_on_device else self.distances[index]
+        return _distance_tensor(distances), torch.from_numpy(_float32(self.x_data[index])), \
+            torch.from_numpy(_float32(self.y_data[index])), torch.tensor(self.id_data[index], dtype=torch.float)
 
     def scale(self, scale_fn=None, scale_params=None):
         """
@@ -134,10 +176,11 @@ class baseDataset(Dataset):
             self.x_data = x_scale_params.transform(pd.DataFrame(self.x_data, columns=self.x))
             self.y_scale_info = {"mean": y_scale_params.mean_, "var": y_scale_params.var_}
 
+        self.x_data = _float32(self.x_data)
         self.getScaledDataframe()
 
         self.x_data = np.concatenate((self.x_data, np.ones(
-            (self.datasize, 1))), axis=1)
+            (self.datasize, 1), dtype=np.float32)), axis=1)
 
     def scale2(self, scale_fn, scale_params):
         """
@@ -165,10 +208,11 @@ class baseDataset(Dataset):
             y_scale_params = scale_params[1]
             self.x_data = (self.x_data - x_scale_params['mean']) / np.sqrt(x_scale_params["var"])
 
+        self.x_data = _float32(self.x_data)
         self.getScaledDataframe()
 
         self.x_data = np.concatenate((self.x_data, np.ones(
-            (self.datasize, 1))), axis=1)
+            (self.datasize, 1), dtype=np.float32)), axis=1)
 
     def getScaledDataframe(self):
         """
@@ -338,11 +382,12 @@ class predictDataset(Dataset):
         else:
             raise ValueError("invalid process_fn")
 
-        self.x_data = np.concatenate((self.x_data, np.ones(
-            (self.datasize, 1))), axis=1)
+        self.x_data = np.concatenate((_float32(self.x_data), np.ones(
+            (self.datasize, 1), dtype=np.float32)), axis=1)
 
         self.distances = None
         self.temporal = None
+        self.distance_on_device = False
 
     def __len__(self):
         """
@@ -356,11 +401,11 @@ class predictDataset(Dataset):
         :return: distance matrix and independent variable data and dependent variable data
         """
         if self.is_need_STNN:
-            return torch.cat((torch.tensor(self.distances[index], dtype=torch.float),
-                              torch.tensor(self.temporal[index], dtype=torch.float)), dim=-1), torch.tensor(
-                self.x_data[index], dtype=torch.float)
-        return torch.tensor(self.distances[index], dtype=torch.float), torch.tensor(self.x_data[index],
-                                                                                    dtype=torch.float)
+            return torch.cat((torch.from_numpy(_float32(self.distances[index])),
+                              torch.from_numpy(_float32(self.temporal[index]))), dim=-1), \
+                torch.from_numpy(_float32(self.x_data[index]))
+        distances = self.distances.inputs(index) if self.distance_on_device else self.distances[index]
+        return _distance_tensor(distances), torch.from_numpy(_float32(self.x_data[index]))
 
     def rescale(self, x):
         """
@@ -417,36 +462,926 @@ class predictDataset(Dataset):
         return x
 
 
-def BasicDistance(x, y):
+class DistanceProvider:
+    """
+    DistanceProvider is the base class of distance functions.
+    | a provider is callable as ``provider(x, y)`` and returns the full distance matrix, so it can be used as
+    | ``spatial_fun``/``temporal_fun`` of :func:`init_dataset` as before.
+    | with ``lazy_distance=True``, the dataset only stores the coordinates and the provider is asked for the
+    | distance rows of each batch when the batch is loaded (see :class:`LazyDistances`).
+
+    Subclasses implement :meth:`pairwise`, and :meth:`torch_pairwise` to support ``distance_on_device``.
+    """
+
+    def pairwise(self, x, y):
+        """
+        Calculate the distance matrix between two sets of points
+
+        :param x: Input point coordinate data
+        :param y: Input target point coordinate data
+        :return: distance matrix
+        """
+        raise NotImplementedError
+
+    def torch_pairwise(self, x, y):
+        """
+        Calculate the distance matrix between two sets of points stored as tensors, on the device of the tensors
+
+        :param x: Input point coordinate tensor
+        :param y: Input target point coordinate tensor
+        :return: distance tensor
+        """
+        raise NotImplementedError("{} can not be evaluated on device".format(type(self).__name__))
+
+    def encode(self, values):
+        """
+        get the provider and the coordinates to use for new rows with the given values,
+        the same reference coordinates are kept
+
+        :param values: Input point coordinate data
+        :return: provider, coordinates of the rows
+        """
+        return self, values
+
+    def __call__(self, x, y):
+        return self.pairwise(x, y)
+
+
+def _chunked_pairwise(fun, x, y):
+    """
+    evaluate ``fun`` on chunks of the rows of ``x`` into a float32 matrix, so that the float64 intermediates of
+    ``fun`` never cover the whole matrix
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    result = np.empty((len(x), len(y)), dtype=np.float32)
+    step = _chunk_rows(y.shape)
+    for start in range(0, len(x), step):
+        result[start:start + step] = fun(x[start:start + step], y)
+    return result
+
+
+class EuclideanDistance(DistanceProvider):
+    """
+    Euclidean distance provider
+    """
+
+    def pairwise(self, x, y):
+        from scipy.spatial import distance
+        x = np.float32(x)
+        y = np.float32(y)
+        return _chunked_pairwise(lambda a, b: distance.cdist(a, b, 'euclidean'), x, y)
+
+    def torch_pairwise(self, x, y):
+        return torch.cdist(x, y, p=2, compute_mode="donot_use_mm_for_euclid_dist")
+
+
+class ManhattanDistance(DistanceProvider):
+    """
+    Manhattan distance provider
+    """
+
+    def pairwise(self, x, y):
+        return _chunked_pairwise(lambda a, b: np.sum(np.abs(a[:, np.newaxis, :] - b), axis=2), x, y)
+
+    def torch_pairwise(self, x, y):
+        return torch.cdist(x, y, p=1)
+
+
+class FunctionDistance(DistanceProvider):
+    """
+    Wrap a plain distance function ``fun(x, y)`` as a provider
+
+    :param fun: distance function
+    """
+
+    def __init__(self, fun):
+        self.fun = fun
+
+    def pairwise(self, x, y):
+        return self.fun(x, y)
+
+
+class TableDistance(DistanceProvider):
+    """
+    TableDistance looks the distances up in a table computed once between the unique values of the rows and
+    the unique values of the reference points, the coordinates it receives are integer codes of those values.
+    | it is used for temporal distances, whose columns typically have few unique values (years, months),
+    | so that only a small unique-time x unique-time table and one code per row are stored.
+
+    :param fun: distance function used to compute the table
+    :param row_values: unique values of the rows
+    :param column_values: unique values of the reference points
+    """
+
+    def __init__(self, fun, row_values, column_values):
+        self.fun = fun
+        self.row_values = row_values
+        self.column_values = column_values
+        self.table = _float32(fun(row_values, column_values))
+
+    @classmethod
+    def from_values(cls, fun, values_list, reference):
+        """
+        build the table of the unique values of several sets of rows and of the reference points
+
+        :param fun: distance function used to compute the table
+        :param values_list: list of coordinate arrays of the rows
+        :param reference: coordinate array of the reference points
+        :return: TableDistance, list of row codes, reference codes
+        """
+        row_values, row_codes = np.unique(np.concatenate(values_list, axis=0), axis=0, return_inverse=True)
+        column_values, column_codes = np.unique(reference, axis=0, return_inverse=True)
+        splits = np.cumsum([len(values) for values in values_list])[:-1]
+        row_codes = [codes.reshape(-1, 1) for codes in np.split(row_codes.reshape(-1), splits)]
+        return cls(fun, row_values, column_values), row_codes, column_codes.reshape(-1, 1)
+
+    def encode(self, values):
+        row_values, row_codes = np.unique(values, axis=0, return_inverse=True)
+        return TableDistance(self.fun, row_values, self.column_values), row_codes.reshape(-1, 1)
+
+    def pairwise(self, x, y):
+        return self.table[np.asarray(x, dtype=np.int64)[:, 0][:, np.newaxis], np.asarray(y, dtype=np.int64)[:, 0]]
+
+
+class MatrixDistance(DistanceProvider):
+    """
+    MatrixDistance keeps the float32 distance matrix between the rows and the reference points, computed once,
+    the coordinates it receives are the indices of the rows of the matrix.
+    | it is used for the spatial distances next to a :class:`TableDistance` of the temporal distances, the locations
+    | are usually all different, so the spatial distances are stored like the eager matrix and not as a table
+
+    :param fun: distance function used to compute the matrix
+    :param values: coordinates of the rows
+    :param reference: coordinates of the reference points
+    """
+
+    def __init__(self, fun, values, reference):
+        self.fun = fun
+        self.reference = np.asarray(reference)
+        self.matrix = _chunked_pairwise(fun, values, self.reference)
+
+    @classmethod
+    def from_values(cls, fun, values_list, reference):
+        """
+        compute the matrix of several sets of rows
+
+        :param fun: distance function used to compute the matrix
+        :param values_list: list of coordinate arrays of the rows
+        :param reference: coordinate array of the reference points
+        :return: MatrixDistance, list of row indices, reference coordinates
+        """
+        starts = np.cumsum([0] + [len(values) for values in values_list])
+        row_codes = [np.arange(start, stop).reshape(-1, 1) for start, stop in zip(starts[:-1], starts[1:])]
+        return cls(fun, np.concatenate(values_list, axis=0), reference), row_codes, np.asarray(reference)
+
+    def encode(self, values):
+        return MatrixDistance(self.fun, values, self.reference), np.arange(len(values)).reshape(-1, 1)
+
+    def pairwise(self, x, y):
+        return self.matrix[np.asarray(x, dtype=np.int64)[:, 0]]
+
+
+# Calculate the Euclidean distance between two sets of points
+BasicDistance = EuclideanDistance()
+# Calculate the Manhattan distance between two sets of points
+Manhattan_distance = ManhattanDistance()
+
+
+def _scale_distance(rows, scale_fn, scale_param):
+    """
+    scale distance rows in the same way as the ``MinMaxScaler``/``StandardScaler`` fitted in :func:`init_dataset`
+
+    :param rows: distance rows
+    :param scale_fn: scale function name
+    :param scale_param: scale parameters of distances
+    :return: scaled distance rows
+    """
+    if scale_fn == "minmax_scale":
+        data_min = np.asarray(scale_param["min"], dtype=np.float64)
+        data_range = np.asarray(scale_param["max"], dtype=np.float64) - data_min
+        scale = 1 / np.where(data_range == 0, 1, data_range)
+        offset = -data_min * scale
+    elif scale_fn == "standard_scale":
+        std = np.sqrt(np.asarray(scale_param["var"], dtype=np.float64))
+        scale = 1 / np.where(std == 0, 1, std)
+        offset = -np.asarray(scale_param["mean"], dtype=np.float64) * scale
+    else:
+        return rows
+    # float32 rows stay float32
+    dtype = np.result_type(rows.dtype, np.float32)
+    return rows * scale.astype(dtype) + offset.astype(dtype)
+
+
+def _scale_distance_inplace(arrays, scale_fn, scale_param):
+    """
+    scale distance arrays in place, chunk by chunk, so that no copy of a whole matrix is made
+
+    :param arrays: list of distance arrays
+    :param scale_fn: scale function name
+    :param scale_param: scale parameters of distances
+    """
+    for array in arrays:
+        step = _chunk_rows(array.shape[1:])
+        for start in range(0, len(array), step):
+            array[start:start + step] = _scale_distance(array[start:start + step], scale_fn, scale_param)
+
+
+class LazyDistances:
+    """
+    LazyDistances is a distance matrix whose rows are computed on demand from the coordinates of the rows
+    and the reference points, it can be used in place of the ``distances`` array of a dataset.
+    | the matrix has one channel per provider, its shape is ``(n, m)`` with one channel and ``(n, m, c)`` otherwise
+    | rows are scaled with ``scale_fn``/``scale_param`` and the most recently used rows are kept in a LRU cache
+
+    :param coords: list of coordinate arrays of the rows, one per channel
+    :param references: list of coordinate arrays of the reference points, one per channel
+    :param providers: list of distance providers, one per channel
+    :param scale_fn: scale function name
+    :param scale_param: scale parameters of distances
+    :param cache_size: number of scaled rows kept in the cache, ``0`` to disable caching
+    """
+
+    def __init__(self, coords, references, providers, scale_fn=None, scale_param=None, cache_size=1024):
+        self.coords = [np.asarray(c) for c in coords]
+        self.references = [np.asarray(r) for r in references]
+        self.providers = [p if isinstance(p, DistanceProvider) else FunctionDistance(p) for p in providers]
+        self.scale_fn = scale_fn
+        self.scale_param = scale_param
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        n, m = len(self.coords[0]), len(self.references[0])
+        self.shape = (n, m) if len(self.providers) == 1 else (n, m, len(self.providers))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def raw_rows(self, index):
+        """
+        calculate the unscaled distance rows
+
+        :param index: indices of the rows
+        :return: distance rows
+        """
+        channels = [provider(coord[index], reference)
+                    for provider, coord, reference in zip(self.providers, self.coords, self.references)]
+        if len(channels) == 1:
+            return np.asarray(channels[0])
+        return np.stack(channels, axis=-1)
+
+    def rows(self, index):
+        """
+        calculate the scaled distance rows, using the cache
+
+        :param index: indices of the rows
+        :return: scaled distance rows
+        """
+        index = np.asarray(index, dtype=np.int64)
+        if self.cache_size <= 0:
+            return _scale_distance(self.raw_rows(index), self.scale_fn, self.scale_param)
+        result = np.empty((len(index),) + self.shape[1:], dtype=np.float32)
+        missing = []
+        for pos, i in enumerate(index.tolist()):
+            row = self._cache.get(i)
+            if row is None:
+                missing.append(pos)
+            else:
+                self._cache.move_to_end(i)
+                result[pos] = row
+        if missing:
+            computed = _scale_distance(self.raw_rows(index[missing]), self.scale_fn, self.scale_param)
+            result[missing] = computed
+            for i, row in zip(index[missing].tolist(), computed):
+                self._cache[i] = row
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.rows(np.arange(*index.indices(self.shape[0])))
+        if np.ndim(index) == 0:
+            return self.rows([index % self.shape[0]])[0]
+        return self.rows(index)
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.rows(np.arange(self.shape[0]))
+        return result if dtype is None else result.astype(dtype)
+
+    def inputs(self, index):
+        """
+        get the coordinates of the rows, concatenated over the channels
+
+        :param index: indices of the rows
+        :return: coordinates of the rows
+        """
+        return np.concatenate([coord[index].reshape(np.shape(index) + (-1,)) for coord in self.coords],
+                              axis=-1).astype(np.float32)
+
+    def distance_layer(self):
+        """
+        build the layer which computes the scaled distance rows from the coordinates of the rows
+        on the device of the model, the inverse of :meth:`inputs`
+
+        :return: DistanceLayer
+        """
+        return DistanceLayer(self.references, self.providers, self.scale_fn, self.scale_param)
+
+    def clear_cache(self):
+        """
+        remove all rows from the cache
+        """
+        self._cache.clear()
+
+
+class SparseDistances:
+    """
+    SparseDistances keeps, for each row, only the reference points within ``radius`` as a CSR matrix of the
+    proximities ``1 - distance / radius``, the points out of the radius are zeros which are not stored.
+    | it can be used in place of the ``distances`` array of a dataset, the rows of a batch are a sparse CSR
+    | tensor and the first layer of SWNN is computed as a sparse-dense product, so the memory
+    | and the multiplications of the first layer are proportional to the number of the neighbors
+
+    :param indptr: the row pointers of the CSR matrix
+    :param indices: the reference points of the stored proximities
+    :param values: the stored proximities
+    :param n_reference: the number of the reference points
+    :param radius: the cutoff radius of the distances
     """
-    Calculate the distance between two points
 
-    :param x: Input point coordinate data
-    :param y: Input target point coordinate data
-    :return: distance matrix
+    def __init__(self, indptr, indices, values, n_reference, radius):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.values = _float32(values)
+        self.radius = float(radius)
+        self.shape = (len(self.indptr) - 1, n_reference)
+
+    @classmethod
+    def from_coordinates(cls, coords, reference, radius, fun=None):
+        """
+        compute the proximities of the reference points within ``radius``, chunk by chunk, so that no dense
+        matrix of all the rows is made
+
+        :param coords: coordinates of the rows
+        :param reference: coordinates of the reference points
+        :param radius: the cutoff radius of the distances
+        :param fun: distance function (default: ``BasicDistance``)
+        :return: SparseDistances
+        """
+        if radius <= 0:
+            raise ValueError("radius must be positive")
+        fun = BasicDistance if fun is None else fun
+        coords, reference = np.asarray(coords), np.asarray(reference)
+        step = _chunk_rows((len(reference),))
+        counts, indices, values = [], [], []
+        for start in range(0, len(coords), step):
+            distances = np.asarray(fun(coords[start:start + step], reference))
+            rows, columns = np.nonzero(distances < radius)
+            counts.append(np.bincount(rows, minlength=len(distances)))
+            indices.append(columns)
+            values.append(1 - distances[rows, columns] / radius)
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate(counts)))) if counts else np.zeros(1)
+        indices = np.concatenate(indices) if indices else np.zeros(0)
+        values = np.concatenate(values) if values else np.zeros(0)
+        return cls(indptr, indices, values, len(reference), radius)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    @property
+    def density(self):
+        """
+        the fraction of the stored proximities
+        """
+        return self.nnz / max(self.shape[0] * self.shape[1], 1)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+    def _positions(self, index):
+        """
+        the rows of the stored proximities of the rows ``index`` and their positions in ``indices``/``values``
+        """
+        starts, counts = self.indptr[index], self.indptr[index + 1] - self.indptr[index]
+        rows = np.repeat(np.arange(len(index)), counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return rows, positions
+
+    def rows(self, index):
+        """
+        :param index: indices of the rows
+        :return: the rows as a ``torch.sparse_csr_tensor`` of the shape ``(len(index), m)``
+        """
+        index = np.asarray(index, dtype=np.int64)
+        _, positions = self._positions(index)
+        indptr = np.concatenate(([0], np.cumsum(self.indptr[index + 1] - self.indptr[index])))
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "Sparse CSR tensor support is in beta")
+            return torch.sparse_csr_tensor(torch.from_numpy(indptr), torch.from_numpy(self.indices[positions]),
+                                           torch.from_numpy(self.values[positions]), (len(index), self.shape[1]))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.rows(np.arange(*index.indices(self.shape[0])))
+        if np.ndim(index) == 0:
+            return self.toarray([index % self.shape[0]])[0]
+        return self.rows(index)
+
+    def take(self, index):
+        """
+        :param index: indices of the rows
+        :return: SparseDistances of the rows ``index``
+        """
+        index = np.asarray(index, dtype=np.int64)
+        _, positions = self._positions(index)
+        indptr = np.concatenate(([0], np.cumsum(self.indptr[index + 1] - self.indptr[index])))
+        return SparseDistances(indptr, self.indices[positions], self.values[positions], self.shape[1], self.radius)
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        :param parts: list of SparseDistances with the same reference points
+        :return: SparseDistances of the rows of all the parts
+        """
+        offsets = np.cumsum([0] + [part.nnz for part in parts])
+        indptr = np.concatenate([[0]] + [part.indptr[1:] + offset for part, offset in zip(parts, offsets)])
+        return SparseDistances(indptr, np.concatenate([part.indices for part in parts]),
+                               np.concatenate([part.values for part in parts]), parts[0].shape[1], parts[0].radius)
+
+    def toarray(self, index=None):
+        """
+        :param index: indices of the rows (default: ``None``, all the rows)
+        :return: the rows as a dense array
+        """
+        index = np.arange(self.shape[0]) if index is None else np.asarray(index, dtype=np.int64)
+        rows, positions = self._positions(index)
+        result = np.zeros((len(index), self.shape[1]), dtype=np.float32)
+        result[rows, self.indices[positions]] = self.values[positions]
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.toarray()
+        return result if dtype is None else result.astype(dtype)
+
+
+def _fit_distance_scale(distances, scale_fn):
     """
-    x = np.float32(x)
-    y = np.float32(y)
-    dist = distance.cdist(x, y, 'euclidean')
-    return dist
+    fit the scale parameters of distances chunk by chunk, the parameters are the same
+    as fitting the scaler on the concatenated distance matrices
 
+    :param distances: list of LazyDistances or distance arrays
+    :param scale_fn: scale function name
+    :return: scale parameters of distances
+    """
+    d_min = d_max = mean = m2 = None
+    count = 0
+    for matrix in distances:
+        step = _chunk_rows(matrix.shape[1:])
+        for start in range(0, len(matrix), step):
+            if isinstance(matrix, LazyDistances):
+                chunk = matrix.raw_rows(np.arange(start, min(start + step, len(matrix))))
+            else:
+                chunk = matrix[start:start + step]
+            chunk = chunk.reshape(-1, chunk.shape[-1])
+            if scale_fn == "minmax_scale":
+                c_min, c_max = chunk.min(axis=0), chunk.max(axis=0)
+                d_min = c_min if d_min is None else np.minimum(d_min, c_min)
+                d_max = c_max if d_max is None else np.maximum(d_max, c_max)
+            else:
+                # merge the mean and the sum of squared deviations of the chunk, accumulated in float64
+                c_count, c_mean = len(chunk), chunk.mean(axis=0, dtype=np.float64)
+                c_m2 = ((chunk - c_mean) ** 2).sum(axis=0)
+                if mean is None:
+                    mean, m2 = c_mean, c_m2
+                else:
+                    delta = c_mean - mean
+                    mean = mean + delta * c_count / (count + c_count)
+                    m2 = m2 + c_m2 + delta ** 2 * count * c_count / (count + c_count)
+                count += c_count
+    if scale_fn == "minmax_scale":
+        return {"min": d_min.astype(np.float64), "max": d_max.astype(np.float64)}
+    return {"mean": mean, "var": m2 / count}
+
+
+def _make_dataloader(dataset, batch_size, shuffle, sampler=None, execution=None):
+    """
+    create the dataloader of a dataset
+    | if the distances of the dataset are lazily evaluated or sparse, the dataset is indexed by whole batches,
+    | so that the distance rows are computed or gathered batch by batch
 
-def Manhattan_distance(x, y):
+    :param dataset: dataset
+    :param batch_size: batch size
+    :param shuffle: shuffle data
+    :param sampler: the sampler of the samples, e.g. a ``DistributedSampler``, instead of the one chosen by ``shuffle``
+    :param execution: :class:`~gnnwr.utils.ExecutionConfig` of the workers of the dataloader
+    :return: dataloader
+    """
+    kwargs = {} if execution is None else execution.dataloader_kwargs()
+    if isinstance(dataset.distances, (LazyDistances, SparseDistances)):
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None,
+                          **kwargs)
+    if sampler is not None:
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
+
+
+class DistanceCache:
     """
-    Calculate the Manhattan distance between two points
+    DistanceCache is a persistent cache of the scaled distance rows of prediction, stored in a SQLite database,
+    so that the rows of the locations predicted before are not computed again by :func:`init_predict_dataset`.
+    | a row is found by the fingerprint of the reference points, the distance functions and the scale parameters,
+    | and the hash of the coordinates of the row
+    | the least recently used rows are removed when there are more than ``max_rows`` rows
+
+    :param path: path of the database file
+    :param max_rows: max number of rows kept in the cache
+    """
+
+    def __init__(self, path, max_rows=1000000):
+        self.path = path
+        self.max_rows = max_rows
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(path)
+        # the cache can be rebuilt, so it does not need to wait for the disk on every commit
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS distance_rows (id INTEGER PRIMARY KEY, fingerprint TEXT, "
+                                 "coordinate TEXT, row BLOB, UNIQUE (fingerprint, coordinate))")
+        # the use times are kept apart from the rows, so that marking a row as used does not rewrite it
+        self._connection.execute("CREATE TABLE IF NOT EXISTS distance_usage (id INTEGER PRIMARY KEY, "
+                                 "last_used INTEGER)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS distance_usage_last_used ON distance_usage (last_used)")
+        self._connection.commit()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM distance_rows").fetchone()[0]
+
+    def get(self, fingerprint, keys, shape):
+        """
+        get the cached rows and mark them as used
+
+        :param fingerprint: fingerprint of the reference points and settings
+        :param keys: hashes of the coordinates of the rows
+        :param shape: shape of a row
+        :return: dict from the hashes to the rows found in the cache
+        """
+        found = {}
+        ids = []
+        for start in range(0, len(keys), 500):  # keep the number of SQL variables small
+            chunk = keys[start:start + 500]
+            rows = self._connection.execute(
+                "SELECT id, coordinate, row FROM distance_rows WHERE fingerprint = ? AND coordinate IN (" +
+                ",".join("?" * len(chunk)) + ")", [fingerprint] + chunk)
+            for row_id, key, row in rows:
+                found[key] = np.frombuffer(row, dtype=np.float32).reshape(shape)
+                ids.append(row_id)
+        if ids:
+            now = time.time_ns()
+            self._connection.executemany("UPDATE distance_usage SET last_used = ? WHERE id = ?",
+                                         [(now, row_id) for row_id in ids])
+            self._connection.commit()
+        return found
+
+    def put(self, fingerprint, rows):
+        """
+        add rows to the cache and remove the least recently used rows beyond ``max_rows``
 
-    :param x: Input point coordinate data
-    :param y: Input target point coordinate data
-    :return: distance matrix
+        :param fingerprint: fingerprint of the reference points and settings
+        :param rows: dict from the hashes of the coordinates to the rows
+        """
+        now = time.time_ns()
+        for key, row in rows.items():
+            cursor = self._connection.execute(
+                "INSERT OR REPLACE INTO distance_rows (fingerprint, coordinate, row) VALUES (?, ?, ?)",
+                (fingerprint, key, _float32(row).tobytes()))
+            self._connection.execute("INSERT OR REPLACE INTO distance_usage VALUES (?, ?)", (cursor.lastrowid, now))
+        overflow = len(self) - self.max_rows
+        if overflow > 0:
+            oldest = "SELECT id FROM distance_usage ORDER BY last_used LIMIT " + str(int(overflow))
+            self._connection.execute("DELETE FROM distance_rows WHERE id IN (" + oldest + ")")
+            self._connection.execute("DELETE FROM distance_usage WHERE id NOT IN (SELECT id FROM distance_rows)")
+        self._connection.commit()
+
+    def clear(self):
+        """
+        remove all the rows
+        """
+        self._connection.execute("DELETE FROM distance_rows")
+        self._connection.execute("DELETE FROM distance_usage")
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def _distance_fingerprint(references, funs, scale_fn, scale_param, n_samples=16):
+    """
+    fingerprint of the reference points, the distance functions and the scale parameters
+    | a function is identified by the name of the function wrapped by ``FunctionDistance`` and by its distances
+    | between some reference points, since lambdas and closures share their names
+
+    :param references: list of the reference coordinates of each distance function
+    :param funs: list of the distance functions
+    :param scale_fn: scale function name
+    :param scale_param: scale parameters of distances
+    :param n_samples: number of the reference points the functions are evaluated on
     """
-    return np.float32(np.sum(np.abs(x[:, np.newaxis, :] - y), axis=2))
+    digest = hashlib.sha1()
+    for reference, fun in zip(references, funs):
+        reference = np.asarray(reference)
+        digest.update(np.ascontiguousarray(reference, dtype=np.float64).tobytes())
+        named = fun.fun if isinstance(fun, FunctionDistance) else fun
+        name = getattr(named, "__qualname__", type(named).__qualname__)
+        digest.update((str(getattr(named, "__module__", "")) + "." + name).encode())
+        sample = reference[:n_samples]
+        digest.update(np.ascontiguousarray(fun(sample, reference[-n_samples:]), dtype=np.float64).tobytes())
+    digest.update(scale_fn.encode())
+    digest.update(b"float32")  # the dtype of the stored rows
+    for key in sorted(scale_param):
+        digest.update(key.encode())
+        digest.update(np.ascontiguousarray(scale_param[key], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _scale_predict_distances(distances, process_fn, train_dataset):
+    """
+    scale the distances of prediction in place with the scale parameters of the train dataset
+    """
+    distances = _float32(distances)
+    _scale_distance_inplace([distances], "minmax_scale" if process_fn == "minmax_scale" else "standard_scale",
+                            train_dataset.distances_scale_param)
+    return distances
+
+
+def select_landmarks(data, spatial_column, reference_size, method="kmeans", temp_column=None, seed=42):
+    """
+    Select a small representative reference set (landmarks) from the data
+
+    | if ``kmeans``, the landmarks are the centroids of k-means clusters of the coordinates
+    | if ``fps``, the landmarks are chosen by farthest-point sampling of the rows
+    | if ``grid``, the coordinates are binned into a regular grid and the row closest to the centre of each
+    | occupied cell is chosen (the most populated cells are kept if there are more than ``reference_size``)
+
+    The coordinates are standardized before selection, so spatial and temporal columns with different units
+    are treated equally.
+
+    :param data: input data
+    :param spatial_column: spatial attribute column name
+    :param reference_size: number of landmarks
+    :param method: selection method, ``kmeans``, ``fps`` or ``grid``
+    :param temp_column: temporal attribute column name
+    :param seed: random seed
+    :return: reference dataframe with the spatial (and temporal) columns
+    """
+    columns = list(spatial_column) + (list(temp_column) if temp_column is not None else [])
+    coords = data[columns].values.astype(np.float64)
+    if reference_size is None or reference_size <= 0:
+        raise ValueError("reference_size must be a positive integer")
+    if reference_size >= len(coords):
+        warnings.warn("reference_size is not smaller than the data size, all rows are used as reference")
+        return data[columns].reset_index(drop=True)
+    std = coords.std(axis=0)
+    std[std == 0] = 1
+    normed = (coords - coords.mean(axis=0)) / std
+    rng = np.random.RandomState(seed)
+    if method == "kmeans":
+        from sklearn.cluster import MiniBatchKMeans
+        kmeans = MiniBatchKMeans(n_clusters=reference_size, random_state=seed, n_init=3,
+                                 batch_size=max(1024, 3 * reference_size))
+        kmeans.fit(normed)
+        centers = kmeans.cluster_centers_ * std + coords.mean(axis=0)
+        return pd.DataFrame(centers, columns=columns)
+    elif method == "fps":
+        chosen = np.empty(reference_size, dtype=np.int64)
+        chosen[0] = rng.randint(len(normed))
+        min_dist = np.sum((normed - normed[chosen[0]]) ** 2, axis=1)
+        for i in range(1, reference_size):
+            chosen[i] = np.argmax(min_dist)
+            min_dist = np.minimum(min_dist, np.sum((normed - normed[chosen[i]]) ** 2, axis=1))
+    elif method == "grid":
+        bins = int(np.ceil(reference_size ** (1 / normed.shape[1])))
+        low, high = normed.min(axis=0), normed.max(axis=0)
+        width = (high - low) / bins
+        width[width == 0] = 1
+        cell = np.minimum(((normed - low) / width).astype(np.int64), bins - 1)
+        cell_id = np.ravel_multi_index(tuple(cell.T), (bins,) * normed.shape[1])
+        centre_dist = np.sum((normed - (low + (cell + 0.5) * width)) ** 2, axis=1)
+        # sort by cell then by distance to the cell centre, the first row of each cell is its landmark
+        order = np.lexsort((centre_dist, cell_id))
+        cells, first, counts = np.unique(cell_id[order], return_index=True, return_counts=True)
+        keep = np.argsort(-counts, kind="stable")[:reference_size]
+        chosen = np.sort(order[first[keep]])
+    else:
+        raise ValueError("landmark method must be 'kmeans', 'fps' or 'grid'")
+    return data[columns].iloc[chosen].reset_index(drop=True)
+
+
+_MEMORY_UNITS = {"b": 1, "kb": 2 ** 10, "mb": 2 ** 20, "gb": 2 ** 30, "tb": 2 ** 40}
+
+# bytes per element of the optimizer state of each parameter
+_OPTIMIZER_STATE = {"SGD": 0, "Adagrad": 1, "RMSprop": 1, "Adadelta": 2, "Adam": 2, "AdamW": 2}
+
+
+def _parse_memory_size(size):
+    """
+    parse a memory size of bytes or a string like ``"512MB"``/``"8 GB"``
+    """
+    if isinstance(size, str):
+        text = size.strip().lower().replace(" ", "").replace("ib", "b")
+        unit = text.lstrip("0123456789.")
+        number = text[:len(text) - len(unit)]
+        if unit not in _MEMORY_UNITS or not number:
+            raise ValueError("memory size must be a number of bytes or a string like '512MB' or '8GB'")
+        return int(float(number) * _MEMORY_UNITS[unit])
+    if size <= 0:
+        raise ValueError("memory size must be positive")
+    return int(size)
+
+
+def _format_memory_size(size):
+    for unit in ("TB", "GB", "MB", "KB"):
+        if size >= _MEMORY_UNITS[unit.lower()]:
+            return "{:.1f} {}".format(size / _MEMORY_UNITS[unit.lower()], unit)
+    return "{} B".format(int(size))
+
+
+def _split_sizes(n_rows, test_ratio, valid_ratio):
+    # the same rounding as the split of init_dataset
+    n_train_val = int((1 - test_ratio) * n_rows)
+    n_valid = int(valid_ratio * n_train_val)
+    return n_train_val - n_valid, n_valid, n_rows - n_train_val
+
+
+def estimate_memory(n_rows, n_x, n_reference=None, spatial_dims=2, temporal_dims=0, test_ratio=0.15, valid_ratio=0.1,
+                    simple_distance=True, is_need_STNN=False, lazy_distance=False, distance_on_device=False,
+                    compress_temporal=False, cache_size=1024, dtype="float32", batch_size=32, max_val_size=-1,
+                    dense_layers=None, optimizer="Adagrad", diagnosis=True, n_predict=0, max_predict_size=-1):
+    """
+    Estimate the peak memory of ``init_dataset``, of training and of prediction before anything is allocated.
+    The estimate counts the arrays and the temporary copies made by the current code paths, the python overhead and
+    the memory of the libraries are not included.
+
+    | dataset: the distance (and temporal) matrices of the train/valid/test sets and the temporary arrays made while
+    | building and scaling them
+    | training: the SWNN weights, gradients and optimizer state, the activations of a batch, the validation pass
+    | over ``max_val_size`` rows and the ``DIAGNOSIS`` of the train set computed every epoch
+    | prediction: the distance matrix of ``n_predict`` rows and the forward pass over ``max_predict_size`` rows
+
+    :param n_rows: number of rows of the data passed to ``init_dataset``
+    :param n_x: number of independent variables
+    :param n_reference: number of reference points (default: the train rows)
+    :param spatial_dims: number of spatial columns
+    :param temporal_dims: number of temporal columns, ``0`` for spatial data
+    :param test_ratio: test data ratio
+    :param valid_ratio: valid data ratio
+    :param simple_distance: whether the distances are computed by the distance functions
+    :param is_need_STNN: whether the coordinates are kept for STNN
+    :param lazy_distance: whether the distance rows are computed on demand
+    :param distance_on_device: whether the distance rows are computed by the model on its device
+    :param compress_temporal: whether the temporal distances are stored as a table of the unique times
+    :param cache_size: number of distance rows cached by each dataset with ``lazy_distance``
+    :param dtype: dtype of the stored distance matrices
+    :param batch_size: batch size of training
+    :param max_val_size: max valid data size in one injection, ``-1`` for the whole valid set
+    :param dense_layers: dense layers of the SWNN (default: :func:`gnnwr.networks.default_dense_layer`)
+    :param optimizer: name of the optimizer, which decides the size of the optimizer state
+    :param diagnosis: whether the ``DIAGNOSIS`` of the train set is computed during training
+    :param n_predict: number of rows to predict
+    :param max_predict_size: max predict data size in one injection, ``-1`` for all rows
+    :return: dict of ``"dataset"``, ``"training"`` and ``"prediction"``, each a dict of the components and ``"peak"``
+        in bytes, and the overall ``"peak"``
+    """
+    n_train, n_valid, n_test = _split_sizes(n_rows, test_ratio, valid_ratio)
+    n_reference = n_train if n_reference is None else n_reference
+    itemsize = np.dtype(dtype).itemsize
+    lazy_distance = lazy_distance or distance_on_device
+    # channels of the stored distance matrix and of the separate temporal matrix
+    if simple_distance and not is_need_STNN:
+        distance_channels = 1 + (temporal_dims > 0)
+        temporal_channels = int(temporal_dims > 0)
+    elif is_need_STNN:
+        distance_channels = 2 * spatial_dims
+        temporal_channels = 2 * temporal_dims
+    else:
+        distance_channels = 2 * (spatial_dims + temporal_dims)
+        temporal_channels = 2 * temporal_dims
+    matrix = n_rows * n_reference * itemsize  # one channel of the distances of all rows
+
+    dataset = {"coordinates": n_rows * (spatial_dims + temporal_dims + n_x + 2) * 8}
+    if lazy_distance:
+        dataset["distance_cache"] = 3 * cache_size * n_reference * distance_channels * 8
+        # the scale of the distances is fitted chunk by chunk
+        dataset["scale_fit"] = 2 * _CHUNK_ELEMENTS * 8
+        dataset["peak"] = sum(dataset.values())
+    elif compress_temporal:
+        # the spatial distances are one float32 matrix, the temporal ones a small table of the unique times,
+        # and the scaled rows are cached
+        dataset["distances"] = n_rows * n_reference * 4
+        dataset["distance_cache"] = 3 * cache_size * n_reference * distance_channels * 4
+        dataset["scale_fit"] = 2 * _CHUNK_ELEMENTS * 8
+        dataset["peak"] = sum(dataset.values())
+    else:
+        dataset["distances"] = matrix * distance_channels
+        dataset["temporal"] = matrix * temporal_channels
+        # the channels of a set are built apart and then concatenated, the train set is the largest
+        dataset["construction"] = n_train * n_reference * itemsize * distance_channels if distance_channels > 1 else 0
+        # the matrices are scaled in place, chunk by chunk
+        dataset["scale_fit"] = 2 * _CHUNK_ELEMENTS * 8
+        dataset["peak"] = sum(dataset.values())
+
+    k = n_x + 1
+    insize = n_reference
+    if dense_layers is None or len(dense_layers) == 0:
+        dense_layers = default_dense_layer(insize, k)
+    sizes = [insize] + list(dense_layers) + [k]
+    n_params = sum(sizes[i] * sizes[i + 1] + sizes[i + 1] for i in range(len(sizes) - 1))
+    n_params += 4 * sum(dense_layers)  # batch normalization
+    max_val_size = n_valid if max_val_size is None or max_val_size < 0 else min(max_val_size, n_valid)
+    input_bytes = n_reference * distance_channels * (itemsize + 4)  # a row indexed from the matrix and its tensor
+    training = {
+        "parameters": n_params * 4,
+        "gradients": n_params * 4,
+        "optimizer_state": n_params * 4 * _OPTIMIZER_STATE.get(optimizer, 2),
+        # linear, batch norm, activation and dropout outputs are kept for backward
+        "batch_activations": batch_size * (input_bytes + 4 * 4 * sum(sizes[1:])),
+        "validation_pass": max_val_size * (input_bytes + 2 * 4 * max(sizes)),
+    }
+    if diagnosis:
+        # DIAGNOSIS keeps (n, n, k) tiles, the (n, k, n) hat products and the (n, n) hat matrix
+        training["diagnosis"] = n_train * n_train * (3 * k + 1) * 4
+    training["peak"] = sum(training.values())
+
+    prediction = {}
+    if n_predict:
+        max_predict_size = n_predict if max_predict_size is None or max_predict_size < 0 else \
+            min(max_predict_size, n_predict)
+        predict_matrix = n_predict * n_reference * itemsize
+        prediction["distances"] = predict_matrix * (distance_channels + temporal_channels)
+        prediction["scale_fit"] = 2 * _CHUNK_ELEMENTS * 8
+        prediction["forward_pass"] = max_predict_size * (input_bytes + 2 * 4 * max(sizes))
+        prediction["parameters"] = n_params * 4
+    prediction["peak"] = sum(prediction.values())
+
+    # the datasets stay in memory during training and prediction
+    resident = dataset["peak"] - dataset.get("construction", 0) - dataset.get("scale_fit", 0)
+    return {"dataset": dataset, "training": training, "prediction": prediction,
+            "peak": max(dataset["peak"], resident + training["peak"], resident + prediction["peak"])}
+
+
+def _plan_distance_mode(memory_budget, n_rows, n_x, n_reference, spatial_dims, temporal_dims, test_ratio, valid_ratio,
+                        simple_distance, is_need_STNN, lazy_distance, distance_on_device, compress_temporal, cache_size,
+                        batch_size, max_val_size):
+    """
+    check the estimated memory of init_dataset against the budget, return whether the distances are computed on demand
+    """
+    budget = _parse_memory_size(memory_budget)
+    params = dict(n_rows=n_rows, n_x=n_x, n_reference=n_reference, spatial_dims=spatial_dims,
+                  temporal_dims=temporal_dims, test_ratio=test_ratio, valid_ratio=valid_ratio,
+                  simple_distance=simple_distance, is_need_STNN=is_need_STNN, distance_on_device=distance_on_device,
+                  compress_temporal=compress_temporal, cache_size=cache_size, batch_size=batch_size,
+                  max_val_size=max_val_size)
+    plan = estimate_memory(lazy_distance=lazy_distance, **params)
+    if plan["dataset"]["peak"] > budget:
+        message = "the datasets of {} rows and {} reference points need about {}, more than the budget of {}".format(
+            n_rows, n_reference, _format_memory_size(plan["dataset"]["peak"]), _format_memory_size(budget))
+        if lazy_distance or distance_on_device or is_need_STNN or not simple_distance:
+            raise MemoryError(message + ", use fewer reference points (reference_size) or a larger budget")
+        plan = estimate_memory(lazy_distance=True, **params)
+        if plan["dataset"]["peak"] > budget:
+            raise MemoryError(message + ", and {} with lazy_distance, use fewer reference points (reference_size) "
+                                        "or a larger budget".format(_format_memory_size(plan["dataset"]["peak"])))
+        warnings.warn(message + ", the distance rows are computed on demand (lazy_distance=True)", RuntimeWarning)
+        lazy_distance = True
+    if plan["training"]["peak"] > budget:
+        warnings.warn("training on these datasets needs about {} ({} for DIAGNOSIS), more than the budget of {}".format(
+            _format_memory_size(plan["training"]["peak"]), _format_memory_size(plan["training"]["diagnosis"]),
+            _format_memory_size(budget)), RuntimeWarning)
+    return lazy_distance
 
 
 def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_column=None, temp_column=None,
                  id_column=None, sample_seed=42, process_fn="minmax_scale", batch_size=32, shuffle=True,
                  use_class=baseDataset,
                  spatial_fun=BasicDistance, temporal_fun=Manhattan_distance, max_val_size=-1, max_test_size=-1,
-                 from_for_cv=0, is_need_STNN=False, Reference=None, simple_distance=True, dropna=True):
+                 from_for_cv=0, is_need_STNN=False, Reference=None, simple_distance=True, dropna=True,
+                 reference_size=None, lazy_distance=False, cache_size=1024, distance_on_device=False,
+                 compress_temporal=False, memory_budget=None, execution=None, distance_radius=None):
     """
     Initialize the dataset and return the training set, validation set and test set for the model
 
@@ -470,9 +1405,34 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
     :param from_for_cv: the start index of the data for cross validation
     :param is_need_STNN: whether to use STNN
     :param Reference: reference points to calculate the distance
+        | ``"train"``/``"train_val"``, or a dataframe of reference points
+        | ``"kmeans"``/``"fps"``/``"grid"`` to select ``reference_size`` landmarks of the train data
+        | (see :func:`select_landmarks`)
     :param simple_distance: whether to use simple distance function to calculate the distance
+    :param reference_size: number of landmarks when ``Reference`` is a landmark method
+    :param lazy_distance: whether to store only the coordinates and compute the distance rows of each batch on demand
+        | (see :class:`LazyDistances`, only for simple distances without STNN)
+    :param cache_size: number of scaled distance rows cached by each dataset when ``lazy_distance`` is ``True``
+    :param distance_on_device: whether the datasets yield coordinates and the distance rows of each batch are computed
+        | by the model on its device (see :class:`gnnwr.networks.DistanceLayer`), implies ``lazy_distance``
+    :param compress_temporal: whether to store the temporal distances as a table between the unique times and one
+        | code per row (see :class:`TableDistance`), the rows are gathered per batch, only for simple distances
+        | without STNN and not needed with ``distance_on_device``
+    :param memory_budget: bytes, or a string like ``"8GB"``, the datasets may use (default: no limit)
+        | the peak memory is estimated by :func:`estimate_memory` before the distances are computed, if it exceeds the
+        | budget the distances are computed on demand (``lazy_distance``) when possible, otherwise MemoryError is
+        | raised; a warning is given if the estimated memory of training exceeds the budget
+    :param execution: :class:`~gnnwr.utils.ExecutionConfig`, the threads of torch used to compute the distances and
+        | the workers of the dataloaders (default: ``None``, the current threads and no workers)
+    :param distance_radius: keep only the reference points within this distance of each row, in the units of
+        | ``spatial_fun`` (default: ``None``, all the reference points); the inputs of the network are then the
+        | proximities ``1 - distance / distance_radius`` stored as a sparse matrix (see :class:`SparseDistances`), so
+        | the memory and the first layer of SWNN scale with the number of the neighbors; only for GNNWR with simple
+        | spatial distances
     :return: train dataset, valid dataset, test dataset
     """
+    if execution is not None:
+        execution.apply()
     if spatial_fun is None:
         # if dist_fun is None, raise error
         raise ValueError(
@@ -495,6 +1455,8 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
             warnings.warn("id_column is None and use default id column in data", RuntimeWarning)
     np.random.seed(sample_seed)
     data = data.sample(frac=1)  # shuffle data
+    # sklearn is imported on first use, prediction does not need it
+    from sklearn.preprocessing import MinMaxScaler, StandardScaler
     scaler_x = None
     scaler_y = None
     # data pre-process
@@ -537,17 +1499,73 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
             reference_data = train_data
         elif Reference == "train_val":
             reference_data = pandas.concat([train_data, val_data])
+        elif Reference in ("kmeans", "fps", "grid"):
+            reference_data = select_landmarks(train_data, spatial_column, reference_size, Reference, temp_column,
+                                              sample_seed)
         else:
-            raise ValueError("Reference str must be 'train' or 'train_val'")
+            raise ValueError("Reference str must be 'train', 'train_val', 'kmeans', 'fps' or 'grid'")
     else:
         reference_data = Reference
     if not isinstance(reference_data, pandas.DataFrame):
         raise ValueError("reference_data must be a pandas.DataFrame")
     train_dataset.reference, val_dataset.reference, test_dataset.reference = reference_data, reference_data, reference_data
+    if distance_radius is not None and (temp_column is not None or is_need_STNN or not simple_distance or
+                                        lazy_distance or distance_on_device or compress_temporal):
+        raise ValueError("distance_radius only supports simple spatial distances without STNN, lazy_distance, "
+                         "distance_on_device and compress_temporal")
+    if memory_budget is not None and distance_radius is None:
+        lazy_distance = _plan_distance_mode(memory_budget, len(data), len(x_column), len(reference_data),
+                                            len(spatial_column), 0 if temp_column is None else len(temp_column),
+                                            test_ratio, valid_ratio, simple_distance, is_need_STNN, lazy_distance,
+                                            distance_on_device, compress_temporal, cache_size, batch_size, max_val_size)
     train_dataset.spatial_column = val_dataset.spatial_column = test_dataset.spatial_column = spatial_column
     train_dataset.x_column = val_dataset.x_column = test_dataset.x_column = x_column
     train_dataset.y_column = val_dataset.y_column = test_dataset.y_column = y_column
-    if not is_need_STNN:
+    train_dataset.temp_column = val_dataset.temp_column = test_dataset.temp_column = temp_column
+    for dataset in (train_dataset, val_dataset, test_dataset):
+        dataset.spatial_fun, dataset.temporal_fun = spatial_fun, temporal_fun
+    lazy_distance = lazy_distance or distance_on_device
+    # distances computed on device are not stored, so the temporal distances are not compressed
+    compress_temporal = compress_temporal and temp_column is not None and not distance_on_device
+    row_distance = lazy_distance or compress_temporal  # whether distance rows are produced per batch
+    train_dataset.distance_on_device = val_dataset.distance_on_device = test_dataset.distance_on_device = \
+        distance_on_device
+    if distance_radius is not None:
+        for dataset, dataset_data in zip((train_dataset, val_dataset, test_dataset), (train_data, val_data, test_data)):
+            dataset.distances = SparseDistances.from_coordinates(dataset_data[spatial_column].values,
+                                                                 reference_data[spatial_column].values,
+                                                                 distance_radius, spatial_fun)
+        isolated = int(np.sum(np.diff(train_dataset.distances.indptr) == 0))
+        if isolated:
+            warnings.warn("{} rows of training have no reference point within distance_radius".format(isolated),
+                          RuntimeWarning)
+    elif row_distance:
+        if is_need_STNN or not simple_distance:
+            raise ValueError("lazy_distance and compress_temporal only support simple distances without STNN")
+        split_data = (train_data, val_data, test_data)
+        channels = []  # provider, coordinates of each dataset and reference coordinates of each channel
+        if lazy_distance:
+            # only store the coordinates, the distance rows are computed when the batches are loaded
+            channels.append((spatial_fun, [dataset_data[spatial_column].values for dataset_data in split_data],
+                             reference_data[spatial_column].values))
+        else:
+            # only the temporal distances are compressed, the spatial ones are computed once as float32
+            channels.append(MatrixDistance.from_values(
+                spatial_fun, [dataset_data[spatial_column].values for dataset_data in split_data],
+                reference_data[spatial_column].values))
+        if temp_column is not None:
+            if compress_temporal:
+                channels.append(TableDistance.from_values(
+                    temporal_fun, [dataset_data[temp_column].values for dataset_data in split_data],
+                    reference_data[temp_column].values))
+            else:
+                channels.append((temporal_fun, [dataset_data[temp_column].values for dataset_data in split_data],
+                                 reference_data[temp_column].values))
+        for i, dataset in enumerate((train_dataset, val_dataset, test_dataset)):
+            dataset.distances = LazyDistances([coords[i] for _, coords, _ in channels],
+                                              [reference for _, _, reference in channels],
+                                              [provider for provider, _, _ in channels], cache_size=cache_size)
+    elif not is_need_STNN:
         if simple_distance:
             # if not use STNN, calculate spatial/temporal distance matrix and concatenate them
             train_dataset.distances = spatial_fun(
@@ -574,52 +1592,55 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
                 test_dataset.distances = np.concatenate(
                     (test_dataset.distances[:, :, np.newaxis], test_dataset.temporal[:, :, np.newaxis]), axis=2)
         else:
-            train_dataset.distances = np.repeat(train_data[spatial_column].values[:, np.newaxis, :],
+            train_dataset.distances = np.repeat(_float32(train_data[spatial_column].values)[:, np.newaxis, :],
                                                 len(reference_data),
                                                 axis=1)
-            train_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :],
+            train_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
                                             train_dataset.datasize,
                                             axis=1)
             train_dataset.distances = np.concatenate(
                 (train_dataset.distances, np.transpose(train_temp_distance, (1, 0, 2))), axis=2)
 
-            val_dataset.distances = np.repeat(val_data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+            val_dataset.distances = np.repeat(_float32(val_data[spatial_column].values)[:, np.newaxis, :], len(reference_data),
                                               axis=1)
-            val_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :], val_dataset.datasize,
+            val_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
+                                          val_dataset.datasize,
                                           axis=1)
             val_dataset.distances = np.concatenate((val_dataset.distances, np.transpose(val_temp_distance, (1, 0, 2))),
                                                    axis=2)
 
-            test_dataset.distances = np.repeat(test_data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+            test_dataset.distances = np.repeat(_float32(test_data[spatial_column].values)[:, np.newaxis, :],
+                                               len(reference_data),
                                                axis=1)
-            test_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :],
+            test_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
                                            test_dataset.datasize,
                                            axis=1)
             test_dataset.distances = np.concatenate(
                 (test_dataset.distances, np.transpose(test_temp_distance, (1, 0, 2))), axis=2)
             # if temp_column is not None, calculate temporal point matrix
             if temp_column is not None:
-                train_dataset.temporal = np.repeat(train_data[temp_column].values[:, np.newaxis, :],
+                train_dataset.temporal = np.repeat(_float32(train_data[temp_column].values)[:, np.newaxis, :],
                                                    len(reference_data),
                                                    axis=1)
-                train_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+                train_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                                 train_dataset.datasize,
                                                 axis=1)
                 train_dataset.temporal = np.concatenate(
                     (train_dataset.temporal, np.transpose(train_temp_temporal, (1, 0, 2))), axis=2)
 
-                val_dataset.temporal = np.repeat(val_data[temp_column].values[:, np.newaxis, :], len(reference_data),
+                val_dataset.temporal = np.repeat(_float32(val_data[temp_column].values)[:, np.newaxis, :], len(reference_data),
                                                  axis=1)
-                val_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+                val_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                               val_dataset.datasize,
                                               axis=1)
                 val_dataset.temporal = np.concatenate(
                     (val_dataset.temporal, np.transpose(val_temp_temporal, (1, 0, 2))),
                     axis=2)
 
-                test_dataset.temporal = np.repeat(test_data[temp_column].values[:, np.newaxis, :], len(reference_data),
+                test_dataset.temporal = np.repeat(_float32(test_data[temp_column].values)[:, np.newaxis, :],
+                                                  len(reference_data),
                                                   axis=1)
-                test_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+                test_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                                test_dataset.datasize,
                                                axis=1)
                 test_dataset.temporal = np.concatenate(
@@ -632,46 +1653,49 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
                 (test_dataset.distances, test_dataset.temporal), axis=2)
     else:
         # if use STNN, calculate spatial/temporal point matrix
-        train_dataset.distances = np.repeat(train_data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+        train_dataset.distances = np.repeat(_float32(train_data[spatial_column].values)[:, np.newaxis, :], len(reference_data),
                                             axis=1)
-        train_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :], train_dataset.datasize,
+        train_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
+                                        train_dataset.datasize,
                                         axis=1)
         train_dataset.distances = np.concatenate(
             (train_dataset.distances, np.transpose(train_temp_distance, (1, 0, 2))), axis=2)
 
-        val_dataset.distances = np.repeat(val_data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+        val_dataset.distances = np.repeat(_float32(val_data[spatial_column].values)[:, np.newaxis, :], len(reference_data),
                                           axis=1)
-        val_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :], val_dataset.datasize,
+        val_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :], val_dataset.datasize,
                                       axis=1)
         val_dataset.distances = np.concatenate((val_dataset.distances, np.transpose(val_temp_distance, (1, 0, 2))),
                                                axis=2)
 
-        test_dataset.distances = np.repeat(test_data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+        test_dataset.distances = np.repeat(_float32(test_data[spatial_column].values)[:, np.newaxis, :], len(reference_data),
                                            axis=1)
-        test_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :], test_dataset.datasize,
+        test_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
+                                       test_dataset.datasize,
                                        axis=1)
         test_dataset.distances = np.concatenate(
             (test_dataset.distances, np.transpose(test_temp_distance, (1, 0, 2))), axis=2)
         # if temp_column is not None, calculate temporal point matrix
         if temp_column is not None:
-            train_dataset.temporal = np.repeat(train_data[temp_column].values[:, np.newaxis, :], len(reference_data),
+            train_dataset.temporal = np.repeat(_float32(train_data[temp_column].values)[:, np.newaxis, :], len(reference_data),
                                                axis=1)
-            train_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+            train_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                             train_dataset.datasize,
                                             axis=1)
             train_dataset.temporal = np.concatenate(
                 (train_dataset.temporal, np.transpose(train_temp_temporal, (1, 0, 2))), axis=2)
 
-            val_dataset.temporal = np.repeat(val_data[temp_column].values[:, np.newaxis, :], len(reference_data),
+            val_dataset.temporal = np.repeat(_float32(val_data[temp_column].values)[:, np.newaxis, :], len(reference_data),
                                              axis=1)
-            val_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :], val_dataset.datasize,
+            val_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :], val_dataset.datasize,
                                           axis=1)
             val_dataset.temporal = np.concatenate((val_dataset.temporal, np.transpose(val_temp_temporal, (1, 0, 2))),
                                                   axis=2)
 
-            test_dataset.temporal = np.repeat(test_data[temp_column].values[:, np.newaxis, :], len(reference_data),
+            test_dataset.temporal = np.repeat(_float32(test_data[temp_column].values)[:, np.newaxis, :], len(reference_data),
                                               axis=1)
-            test_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :], test_dataset.datasize,
+            test_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
+                                           test_dataset.datasize,
                                            axis=1)
             test_dataset.temporal = np.concatenate(
                 (test_dataset.temporal, np.transpose(test_temp_temporal, (1, 0, 2))), axis=2)
@@ -686,43 +1710,35 @@ def init_dataset(data, test_ratio, valid_ratio, x_column, y_column, spatial_colu
         max_val_size = len(val_dataset)
     if max_test_size < 0:
         max_test_size = len(test_dataset)
-    if process_fn == "minmax_scale":
-        distance_scale = MinMaxScaler()
-        temporal_scale = MinMaxScaler()
-    else:
-        distance_scale = StandardScaler()
-        temporal_scale = StandardScaler()
-    # scale distance matrix
-    train_distance_len = len(train_dataset.distances)
-    val_distance_len = len(val_dataset.distances)
-    distances = np.concatenate((train_dataset.distances, val_dataset.distances, test_dataset.distances), axis=0)
-    distances = distance_scale.fit_transform(distances.reshape(-1, distances.shape[-1])).reshape(distances.shape)
-    if process_fn == "minmax_scale":
-        distance_scale_param = {"min": distance_scale.data_min_, "max": distance_scale.data_max_}
+    # scale distance matrix with the parameters of MinMaxScaler/StandardScaler fitted on all the distances
+    distance_scale_fn = "minmax_scale" if process_fn == "minmax_scale" else "standard_scale"
+    split_datasets = (train_dataset, val_dataset, test_dataset)
+    if distance_radius is not None:
+        # the proximities are already in [0, 1]
+        distance_scale_param = {"radius": np.array([distance_radius], dtype=np.float64)}
+    elif row_distance:
+        distance_scale_param = _fit_distance_scale([dataset.distances for dataset in split_datasets], distance_scale_fn)
+        for dataset in split_datasets:
+            dataset.distances.scale_fn, dataset.distances.scale_param = distance_scale_fn, distance_scale_param
     else:
-        distance_scale_param = {"mean": distance_scale.mean_, "var": distance_scale.var_}
-    train_dataset.distances = distances[:train_distance_len]
-    val_dataset.distances = distances[train_distance_len:train_distance_len + val_distance_len]
-    test_dataset.distances = distances[train_distance_len + val_distance_len:]
+        # the float32 matrices are scaled in place, chunk by chunk, instead of through a concatenated copy
+        for dataset in split_datasets:
+            dataset.distances = _float32(dataset.distances)
+        distance_scale_param = _fit_distance_scale([dataset.distances for dataset in split_datasets], distance_scale_fn)
+        _scale_distance_inplace([dataset.distances for dataset in split_datasets], distance_scale_fn,
+                                distance_scale_param)
     train_dataset.distances_scale_param = val_dataset.distances_scale_param = test_dataset.distances_scale_param = distance_scale_param
-    if temp_column is not None:
-        temporal = np.concatenate((train_dataset.temporal, val_dataset.temporal, test_dataset.temporal), axis=0)
-        temporal = temporal_scale.fit_transform(temporal.reshape(-1, temporal.shape[-1])).reshape(temporal.shape)
-        if process_fn == "minmax_scale":
-            temporal_scale_param = {"min": temporal_scale.data_min_, "max": temporal_scale.data_max_}
-        else:
-            temporal_scale_param = {"mean": temporal_scale.mean_, "var": temporal_scale.var_}
-        train_dataset.temporal = temporal[:train_distance_len]
-        val_dataset.temporal = temporal[train_distance_len:train_distance_len + val_distance_len]
-        test_dataset.temporal = temporal[train_distance_len + val_distance_len:]
+    if temp_column is not None and not row_distance:
+        for dataset in split_datasets:
+            dataset.temporal = _float32(dataset.temporal)
+        temporal_scale_param = _fit_distance_scale([dataset.temporal for dataset in split_datasets], distance_scale_fn)
+        _scale_distance_inplace([dataset.temporal for dataset in split_datasets], distance_scale_fn,
+                                temporal_scale_param)
         train_dataset.temporal_scale_param = val_dataset.temporal_scale_param = test_dataset.temporal_scale_param = temporal_scale_param
 
-    train_dataset.dataloader = DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=shuffle)
-    val_dataset.dataloader = DataLoader(
-        val_dataset, batch_size=max_val_size, shuffle=shuffle)
-    test_dataset.dataloader = DataLoader(
-        test_dataset, batch_size=max_test_size, shuffle=shuffle)
+    train_dataset.dataloader = _make_dataloader(train_dataset, batch_size, shuffle, execution=execution)
+    val_dataset.dataloader = _make_dataloader(val_dataset, max_val_size, shuffle, execution=execution)
+    test_dataset.dataloader = _make_dataloader(test_dataset, max_test_size, shuffle, execution=execution)
     train_dataset.batch_size, train_dataset.shuffle = batch_size, shuffle
     val_dataset.batch_size, val_dataset.shuffle = max_val_size, shuffle
     test_dataset.batch_size, test_dataset.shuffle = max_test_size, shuffle
@@ -734,7 +1750,9 @@ def init_dataset_cv(data, test_ratio, k_fold, x_column, y_column, spatial_column
                     sample_seed=100,
                     process_fn="minmax_scale", batch_size=32, shuffle=True, use_class=baseDataset,
                     spatial_fun=BasicDistance, temporal_fun=Manhattan_distance, max_val_size=-1, max_test_size=-1,
-                    is_need_STNN=False, Reference=None, simple_distance=True):
+                    is_need_STNN=False, Reference=None, simple_distance=True, reference_size=None,
+                    lazy_distance=False, cache_size=1024, distance_on_device=False, compress_temporal=False,
+                    memory_budget=None, execution=None, distance_radius=None):
     """
     initialize dataset for cross validation
 
@@ -759,11 +1777,22 @@ def init_dataset_cv(data, test_ratio, k_fold, x_column, y_column, spatial_column
     :param is_need_STNN: whether need STNN
     :param Reference: reference data
     :param simple_distance: is simple distance
+    :param reference_size: number of landmarks when ``Reference`` is a landmark method
+    :param lazy_distance: whether to compute the distance rows of each batch on demand
+    :param cache_size: number of scaled distance rows cached by each dataset when ``lazy_distance`` is ``True``
+    :param distance_on_device: whether the distance rows of each batch are computed by the model on its device
+    :param compress_temporal: whether to store the temporal distances as a table between the unique times
+    :param memory_budget: bytes, or a string like ``"8GB"``, all the folds may use, each fold gets ``1 / k_fold`` of it
+        | (see :func:`init_dataset`)
+    :param execution: :class:`~gnnwr.utils.ExecutionConfig` of the threads and the dataloaders (see :func:`init_dataset`)
+    :param distance_radius: keep only the reference points within this distance of each row (see :func:`init_dataset`)
     :return: cv_data_set, test_dataset
     """
     cv_data_set = []
     valid_ratio = (1 - test_ratio) / k_fold
     test_dataset = None
+    # the datasets of all the folds are kept
+    fold_budget = None if memory_budget is None else _parse_memory_size(memory_budget) / k_fold
     for i in range(k_fold):
         train_dataset, val_dataset, test_dataset = init_dataset(data, test_ratio, valid_ratio, x_column, y_column,
                                                                 spatial_column,
@@ -772,7 +1801,13 @@ def init_dataset_cv(data, test_ratio, k_fold, x_column, y_column, spatial_column
                                                                 sample_seed,
                                                                 process_fn, batch_size, shuffle, use_class,
                                                                 spatial_fun, temporal_fun, max_val_size, max_test_size,
-                                                                i, is_need_STNN, Reference, simple_distance)
+                                                                i, is_need_STNN, Reference, simple_distance,
+                                                                reference_size=reference_size,
+                                                                lazy_distance=lazy_distance, cache_size=cache_size,
+                                                                distance_on_device=distance_on_device,
+                                                                compress_temporal=compress_temporal,
+                                                                memory_budget=fold_budget, execution=execution,
+                                                                distance_radius=distance_radius)
         cv_data_set.append((train_dataset, val_dataset))
     return cv_data_set, test_dataset
 
@@ -816,7 +1851,8 @@ def init_dataset_cv(data, test_ratio, k_fold, x_column, y_column, spatial_column
 
 def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, temp_column=None,
                          process_fn="minmax_scale", scale_sync=True, use_class=predictDataset,
-                         spatial_fun=BasicDistance, temporal_fun=Manhattan_distance, max_size=-1, is_need_STNN=False):
+                         spatial_fun=BasicDistance, temporal_fun=Manhattan_distance, max_size=-1, is_need_STNN=False,
+                         distance_cache=None, execution=None):
     """
     initialize predict dataset
 
@@ -832,8 +1868,13 @@ def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, tem
     :param spatial_fun: spatial distance calculate function
     :param temporal_fun: temporal distance calculate function
     :param is_need_STNN: is need STNN or not
+    :param distance_cache: :class:`DistanceCache` or the path of its database, the scaled distance rows of the
+        locations are looked up in it and only the missing rows are computed (only with simple distances)
+    :param execution: :class:`~gnnwr.utils.ExecutionConfig` of the threads and the dataloader (see :func:`init_dataset`)
     :return: predict_dataset
     """
+    if execution is not None:
+        execution.apply()
     if spatial_fun is None:
         # if dist_fun is None, raise error
         raise ValueError(
@@ -860,8 +1901,53 @@ def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, tem
 
     # train_data = train_dataset.dataframe
     reference_data = train_dataset.reference
-
-    if not is_need_STNN:
+    sparse = isinstance(train_dataset.distances, SparseDistances)
+    use_cache = distance_cache is not None and not is_need_STNN and train_dataset.simple_distance and \
+        not isinstance(train_dataset.distances, (LazyDistances, SparseDistances))
+    if distance_cache is not None and not use_cache:
+        warnings.warn("distance_cache is only used with the precomputed simple distances", RuntimeWarning)
+
+    if use_cache:
+        if isinstance(distance_cache, str):
+            distance_cache = DistanceCache(distance_cache)
+        columns = spatial_column if temp_column is None else spatial_column + temp_column
+        channels = [spatial_column] if temp_column is None else [spatial_column, temp_column]
+        funs = [spatial_fun] if temp_column is None else [spatial_fun, temporal_fun]
+        fingerprint = _distance_fingerprint([reference_data[channel].values for channel in channels], funs,
+                                            process_fn, train_dataset.distances_scale_param)
+        row_shape = (len(reference_data),) if temp_column is None else (len(reference_data), 2)
+        # repeated locations are looked up and computed once
+        coords, inverse = np.unique(np.ascontiguousarray(data[columns].values, dtype=np.float64), axis=0,
+                                    return_inverse=True)
+        keys = [hashlib.sha1(coord.tobytes()).hexdigest() for coord in coords]
+        rows = distance_cache.get(fingerprint, keys, row_shape)
+        missing = [i for i, key in enumerate(keys) if key not in rows]
+        if len(missing):
+            computed = spatial_fun(coords[missing, :len(spatial_column)], reference_data[spatial_column].values)
+            if temp_column is not None:
+                temporal = temporal_fun(coords[missing, len(spatial_column):], reference_data[temp_column].values)
+                computed = np.concatenate((computed[:, :, np.newaxis], temporal[:, :, np.newaxis]), axis=2)
+            computed = _scale_predict_distances(computed, process_fn, train_dataset)
+            new_rows = {keys[i]: row for i, row in zip(missing, computed)}
+            distance_cache.put(fingerprint, new_rows)
+            rows.update(new_rows)
+        predict_dataset.distances = np.stack([rows[key] for key in keys])[inverse.reshape(-1)]
+    elif sparse:
+        predict_dataset.distances = SparseDistances.from_coordinates(data[spatial_column].values,
+                                                                     reference_data[spatial_column].values,
+                                                                     train_dataset.distances.radius, spatial_fun)
+    elif isinstance(train_dataset.distances, LazyDistances):
+        # compute the distance rows on demand with the providers and the scale parameters of the train dataset
+        train_distances = train_dataset.distances
+        columns = [spatial_column] if temp_column is None else [spatial_column, temp_column]
+        channels = [provider.encode(data[column].values)
+                    for provider, column in zip(train_distances.providers, columns)]
+        predict_dataset.distances = LazyDistances([coords for _, coords in channels], train_distances.references,
+                                                  [provider for provider, _ in channels],
+                                                  train_distances.scale_fn, train_distances.scale_param,
+                                                  train_distances.cache_size)
+        predict_dataset.distance_on_device = train_dataset.distance_on_device
+    elif not is_need_STNN:
         # if not use STNN, calculate spatial/temporal distance matrix and concatenate them
         if train_dataset.simple_distance:
             predict_dataset.distances = spatial_fun(
@@ -876,20 +1962,20 @@ def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, tem
                     (predict_dataset.distances[:, :, np.newaxis], predict_dataset.temporal[:, :, np.newaxis]),
                     axis=2)  # concatenate spatial and temporal distance matrix
         else:
-            predict_dataset.distances = np.repeat(data[spatial_column].values[:, np.newaxis, :],
+            predict_dataset.distances = np.repeat(_float32(data[spatial_column].values)[:, np.newaxis, :],
                                                   len(reference_data),
                                                   axis=1)
-            predict_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :],
+            predict_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
                                               predict_dataset.datasize,
                                               axis=1)
             predict_dataset.distances = np.concatenate(
                 (predict_dataset.distances, np.transpose(predict_temp_distance, (1, 0, 2))), axis=2)
 
             if temp_column is not None:
-                predict_dataset.temporal = np.repeat(data[temp_column].values[:, np.newaxis, :],
+                predict_dataset.temporal = np.repeat(_float32(data[temp_column].values)[:, np.newaxis, :],
                                                      len(reference_data),
                                                      axis=1)
-                predict_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+                predict_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                                   predict_dataset.datasize,
                                                   axis=1)
                 predict_dataset.temporal = np.concatenate(
@@ -900,9 +1986,9 @@ def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, tem
     else:
         # if use STNN, calculate spatial/temporal point matrix
         # spatial distances matrix
-        predict_dataset.distances = np.repeat(data[spatial_column].values[:, np.newaxis, :], len(reference_data),
+        predict_dataset.distances = np.repeat(_float32(data[spatial_column].values)[:, np.newaxis, :], len(reference_data),
                                               axis=1)
-        predict_temp_distance = np.repeat(reference_data[spatial_column].values[:, np.newaxis, :],
+        predict_temp_distance = np.repeat(_float32(reference_data[spatial_column].values)[:, np.newaxis, :],
                                           predict_dataset.datasize,
                                           axis=1)
         predict_dataset.distances = np.concatenate(
@@ -910,30 +1996,150 @@ def init_predict_dataset(data, train_dataset, x_column, spatial_column=None, tem
 
         # temporal distances matrix
         if temp_column is not None:
-            predict_dataset.temporal = np.repeat(data[temp_column].values[:, np.newaxis, :], len(reference_data),
+            predict_dataset.temporal = np.repeat(_float32(data[temp_column].values)[:, np.newaxis, :], len(reference_data),
                                                  axis=1)
-            predict_temp_temporal = np.repeat(reference_data[temp_column].values[:, np.newaxis, :],
+            predict_temp_temporal = np.repeat(_float32(reference_data[temp_column].values)[:, np.newaxis, :],
                                               predict_dataset.datasize,
                                               axis=1)
             predict_dataset.temporal = np.concatenate(
                 (predict_dataset.temporal, np.transpose(predict_temp_temporal, (1, 0, 2))), axis=2)
-    if process_fn == "minmax_scale":
-        predict_dataset.distances = predict_dataset.minmax_scaler(predict_dataset.distances,
-                                                                  train_dataset.distances_scale_param['min'],
-                                                                  train_dataset.distances_scale_param['max'])
+    if isinstance(predict_dataset.distances, LazyDistances) or use_cache or sparse:
+        # lazily computed rows are scaled when they are computed, cached rows are stored scaled
+        # and the sparse proximities are not scaled
+        pass
     else:
-        predict_dataset.distances = predict_dataset.standard_scaler(predict_dataset.distances,
-                                                                    train_dataset.distances_scale_param['mean'],
-                                                                    train_dataset.distances_scale_param['var'])
+        predict_dataset.distances = _scale_predict_distances(predict_dataset.distances, process_fn, train_dataset)
     # initialize dataloader for train/val/test dataset
     if max_size < 0:
         max_size = len(predict_dataset)
-    predict_dataset.dataloader = DataLoader(
-        predict_dataset, batch_size=max_size, shuffle=False)
+    predict_dataset.dataloader = _make_dataloader(predict_dataset, max_size, False, execution=execution)
 
     return predict_dataset
 
 
+def _raw_distance_rows(dataset, data, reference):
+    """
+    the unscaled distance rows between the rows of ``data`` and the ``reference`` points, with the channels of
+    the distances of ``dataset``
+    """
+    spatial_fun = getattr(dataset, "spatial_fun", BasicDistance)
+    temporal_fun = getattr(dataset, "temporal_fun", Manhattan_distance)
+    rows = spatial_fun(data[dataset.spatial_column].values, reference[dataset.spatial_column].values)
+    if getattr(dataset, "temp_column", None) is not None:
+        temporal = temporal_fun(data[dataset.temp_column].values, reference[dataset.temp_column].values)
+        rows = np.concatenate((rows[:, :, np.newaxis], temporal[:, :, np.newaxis]), axis=2)
+    return _float32(rows)
+
+
+def update_dataset(dataset, data, window=None, update_reference=False, shared=()):
+    """
+    add new observations to a dataset of :func:`init_dataset` without preparing the data again
+    | the new rows are scaled with the scale parameters of the dataset and only their distance rows are computed,
+    | against the reference points of the dataset, so the input size of the network does not change and a trained
+    | model can be fine-tuned on the dataset (see ``GNNWR.fine_tune``)
+
+    :param dataset: the dataset to add the observations to, usually the train dataset
+    :param data: the new observations, with the columns of the dataset
+    :param window: the number of the newest rows kept, the older ones are dropped (default: ``None``, keep all)
+    :param update_reference: whether the new observations replace the oldest reference points, first in first out
+        | the number of the reference points stays the same, the distance columns of the replaced points and their
+        | scale parameters are computed again for ``dataset`` and ``shared``
+    :param shared: the other datasets with the same reference points, e.g. the valid and test datasets, whose
+        distance columns follow the replaced reference points
+    :return: the dataset
+    """
+    if dataset.is_need_STNN or not dataset.simple_distance:
+        raise ValueError("update_dataset only supports simple distances without STNN")
+    lazy = isinstance(dataset.distances, LazyDistances)
+    if lazy and any(isinstance(provider, TableDistance) for provider in dataset.distances.providers):
+        raise ValueError("update_dataset does not support compress_temporal")
+    sparse = isinstance(dataset.distances, SparseDistances)
+    if sparse and update_reference:
+        raise ValueError("update_reference does not support distance_radius")
+    if window is not None and window <= 0:
+        raise ValueError("window must be positive")
+    data = data.copy()
+    id_column = dataset.id[0] if isinstance(dataset.id, list) else dataset.id
+    if id_column not in data.columns:
+        data[id_column] = np.arange(len(data)) + int(dataset.id_data.max()) + 1
+    scale_info = dataset.x_scale_info
+    x_data = data[dataset.x].astype(np.float64).values
+    if dataset.scale_fn == "minmax_scale":
+        x_data = (x_data - scale_info["min"]) / (scale_info["max"] - scale_info["min"])
+    elif dataset.scale_fn == "standard_scale":
+        x_data = (x_data - scale_info["mean"]) / np.sqrt(scale_info["var"])
+    x_data = np.concatenate((_float32(x_data), np.ones((len(data), 1), dtype=np.float32)), axis=1)
+    distance_scale_fn = "minmax_scale" if dataset.scale_fn == "minmax_scale" else "standard_scale"
+
+    old_size = dataset.datasize
+    drop = 0 if window is None else max(old_size + len(data) - window, 0)
+    keep = slice(min(drop, old_size), None)
+    new = slice(max(drop - old_size, 0), None)
+    dataset.dataframe = pd.concat([dataset.dataframe[keep], data[new]])
+    dataset.x_data = np.concatenate((dataset.x_data[keep], x_data[new]))
+    dataset.y_data = np.concatenate((dataset.y_data[keep], data[dataset.y].astype(np.float32).values[new]))
+    dataset.id_data = np.concatenate((dataset.id_data[keep], data[dataset.id].astype(np.int64).values[new]))
+    dataset.datasize = len(dataset.y_data)
+    dataset.scaledDataframe = pd.DataFrame(np.concatenate((dataset.x_data[:, :-1], dataset.y_data), axis=1),
+                                           columns=np.concatenate((dataset.x, dataset.y), axis=0))
+    dataset.temporal = None  # only used with STNN
+    if lazy:
+        columns = [dataset.spatial_column] if dataset.temp_column is None else [dataset.spatial_column,
+                                                                                dataset.temp_column]
+        dataset.distances.coords = [np.concatenate((coords[keep], data[column].values[new]))
+                                    for coords, column in zip(dataset.distances.coords, columns)]
+        dataset.distances.shape = (dataset.datasize,) + dataset.distances.shape[1:]
+        dataset.distances.clear_cache()
+    elif sparse:
+        distances = dataset.distances
+        rows = SparseDistances.from_coordinates(data[dataset.spatial_column].values[new],
+                                                dataset.reference[dataset.spatial_column].values, distances.radius,
+                                                getattr(dataset, "spatial_fun", BasicDistance))
+        dataset.distances = SparseDistances.concatenate([distances.take(np.arange(len(distances))[keep]), rows])
+    else:
+        rows = _raw_distance_rows(dataset, data[new], dataset.reference)
+        _scale_distance_inplace([rows], distance_scale_fn, dataset.distances_scale_param)
+        dataset.distances = np.concatenate((dataset.distances[keep], rows))
+
+    if update_reference:
+        datasets = [dataset] + list(shared)
+        reference = dataset.reference.copy()
+        n_reference = len(reference)
+        position = getattr(dataset, "reference_position", 0)  # the oldest reference point
+        added = data[-n_reference:]
+        slots = (position + np.arange(len(added))) % n_reference
+        common = [column for column in reference.columns if column in added.columns]
+        reference.iloc[slots, reference.columns.get_indexer(common)] = added[common].values
+        columns = [_raw_distance_rows(item, item.dataframe, reference.iloc[slots]) for item in datasets]
+        scale_param = {key: np.array(value, dtype=np.float64) for key, value in dataset.distances_scale_param.items()}
+        column_param = scale_param
+        if columns[0].ndim == 2:
+            # the distances of one channel are scaled column by column, the replaced columns are fitted again
+            column_param = _fit_distance_scale(columns, distance_scale_fn)
+            for key in scale_param:
+                scale_param[key][slots] = column_param[key]
+        _scale_distance_inplace(columns, distance_scale_fn, column_param)
+        for item, column in zip(datasets, columns):
+            item.reference = reference
+            item.reference_position = (position + len(added)) % n_reference
+            item.distances_scale_param = scale_param
+            if isinstance(item.distances, LazyDistances):
+                references = [reference[dataset.spatial_column].values]
+                if dataset.temp_column is not None:
+                    references.append(reference[dataset.temp_column].values)
+                item.distances.references = references
+                item.distances.scale_param = scale_param
+                item.distances.clear_cache()
+            else:
+                item.distances[:, slots] = column
+
+    # a dataset loaded as one batch stays one batch
+    if dataset.batch_size is None or dataset.batch_size == old_size:
+        dataset.batch_size = dataset.datasize
+    dataset.dataloader = _make_dataloader(dataset, dataset.batch_size, dataset.shuffle)
+    return dataset
+
+
 def load_dataset(directory, use_class=baseDataset):
     dataset = use_class()
     dataset.read(directory)
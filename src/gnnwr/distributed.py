@@ -0,0 +1,162 @@
+import os
+import pickle
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DistributedSampler
+
+from .datasets import _make_dataloader
+
+r"""
+The package of `distributed` includes the helpers of the data-parallel training of GNNWR/GTNNWR on CPU, with
+``DistributedDataParallel`` and the gloo backend, used by ``run(distributed=True)``:
+    1. spawn: run a function in several local processes, each with the process group initialized
+    2. init_process_group: initialize the process group from the environment set by ``torchrun``
+    3. shard_dataloader: the dataloader of the part of a dataset of the current process
+    4. broadcast_values, all_reduce_sum: share python numbers between the processes
+
+The script of ``torchrun`` calls ``run(distributed=True)`` in every process:
+
+.. code-block:: bash
+
+    torchrun --standalone --nproc_per_node 8 train.py
+
+and ``spawn`` does the same without ``torchrun``:
+
+.. code-block:: python
+
+    def train(rank, world_size):
+        model = ...  # the same datasets and model in every process
+        model.run(1000, distributed=True)
+        return model._bestr2
+
+    best_r2 = spawn(train, 8)
+"""
+
+
+def is_distributed():
+    """
+    :return: whether the process group is initialized
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """
+    :return: the rank of the current process, ``0`` if the process group is not initialized
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """
+    :return: the number of processes, ``1`` if the process group is not initialized
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_process_group(backend="gloo"):
+    """
+    initialize the process group from the environment variables ``MASTER_ADDR``, ``MASTER_PORT``, ``RANK`` and
+    ``WORLD_SIZE`` (set by ``torchrun`` and ``spawn``), unless it is already initialized
+
+    :param backend: the backend of the process group
+    """
+    if not dist.is_available():
+        raise RuntimeError("torch.distributed is not available in this build of torch")
+    if not is_distributed():
+        dist.init_process_group(backend)
+
+
+def shard_dataloader(dataset, seed=0):
+    """
+    the dataloader of the part of ``dataset`` of the current process, with a ``DistributedSampler``
+    | the batch size of each process is ``dataset.batch_size / world_size``, so the processes together take the same
+    | steps as a single process, and ``sampler.set_epoch`` should be called before every epoch
+
+    :param dataset: the dataset of training, with ``batch_size`` and ``shuffle`` set by ``init_dataset``
+    :param seed: the seed of the shuffle, the same in all the processes
+    :return: dataloader and its sampler
+    """
+    world_size = get_world_size()
+    shuffle = bool(dataset.shuffle)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=get_rank(), shuffle=shuffle, seed=seed)
+    batch_size = max(-(-dataset.batch_size // world_size), 1)
+    return _make_dataloader(dataset, batch_size, shuffle, sampler=sampler), sampler
+
+
+def broadcast_values(values, src=0):
+    """
+    :param values: list of numbers
+    :param src: the rank whose values are sent
+    :return: the values of the process ``src`` in every process
+    """
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.broadcast(tensor, src)
+    return tensor.tolist()
+
+
+def all_reduce_sum(values):
+    """
+    :param values: list of numbers
+    :return: the sums of the values of all the processes
+    """
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def barrier():
+    """
+    wait for all the processes, if the process group is initialized
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _worker(rank, world_size, port, threads, backend, result_path, fn, args):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    torch.set_num_threads(threads)
+    init_process_group(backend)
+    try:
+        result = fn(rank, world_size, *args)
+        if rank == 0:
+            with open(result_path, "wb") as file:
+                pickle.dump(result, file)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn(fn, nprocs, args=(), threads=None, backend="gloo"):
+    r"""
+    run ``fn(rank, world_size, *args)`` in ``nprocs`` local processes, each with the process group initialized
+
+    ``fn`` is pickled to the processes, so it must be defined at the top level of a module, and the script calling
+    ``spawn`` should be guarded by ``if __name__ == "__main__":``
+
+    :param fn: the function run by every process
+    :param nprocs: the number of processes
+    :param args: the other arguments of ``fn``
+    :param threads: the intra-op threads of each process (default: ``None``, the CPUs divided by ``nprocs``)
+    :param backend: the backend of the process group
+    :return: the result of ``fn`` in the process of rank 0
+    """
+    if threads is None:
+        threads = max((os.cpu_count() or 1) // nprocs, 1)
+    with tempfile.TemporaryDirectory(prefix="gnnwr_spawn_") as directory:
+        result_path = os.path.join(directory, "result.pkl")
+        mp.spawn(_worker, args=(nprocs, _free_port(), threads, backend, result_path, fn, args), nprocs=nprocs,
+                 join=True)
+        if not os.path.exists(result_path):
+            return None
+        with open(result_path, "rb") as file:
+            return pickle.load(file)
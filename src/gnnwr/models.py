@@ -1,18 +1,70 @@
+import contextlib
+import copy
 import datetime
 import os
+import random
+import time
 import pandas as pd
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import warnings
-from sklearn.metrics import r2_score
-from torch.utils.tensorboard import SummaryWriter  # 用于保存训练过程
 from tqdm import trange
 from collections import OrderedDict
 import logging
-from .networks import SWNN, STPNN, STNN_SPNN
-from .utils import OLS, DIAGNOSIS
+from .datasets import _make_dataloader
+from .networks import SWNN, SWNNEnsemble, STPNN, STNN_SPNN
+from .utils import DIAGNOSIS, PhaseTimer, NullSink, TensorBoardSink, least_squares
+from .distributed import all_reduce_sum, barrier, broadcast_values, get_rank, init_process_group, shard_dataloader
+
+
+def r2_score(y_true, y_pred):
+    """
+    ``sklearn.metrics.r2_score``, sklearn is imported on first use because it is slow to import
+    """
+    from sklearn.metrics import r2_score as sklearn_r2_score
+    return sklearn_r2_score(y_true, y_pred)
+
+
+def _unwrap(module):
+    """
+    the module inside ``nn.DataParallel`` or ``DistributedDataParallel``
+    """
+    if isinstance(module, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return module.module
+    return module
+
+
+def _model_stages(module):
+    """
+    flatten the model into the stages computed one after another
+    """
+    if isinstance(module, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return _model_stages(module.module)
+    if isinstance(module, nn.Sequential):
+        return [stage for child in module for stage in _model_stages(child)]
+    if isinstance(module, SWNN):
+        return _model_stages(module.fc)
+    return [module]
+
+
+def _split_rows(data, size):
+    """
+    split a batch into chunks of ``size`` rows, the sparse rows of ``SparseDistances`` are split by their row pointers
+    """
+    if data.layout == torch.strided:
+        return torch.split(data, size)
+    crow, col, values = data.crow_indices(), data.col_indices(), data.values()
+    chunks = []
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "Sparse CSR tensor support is in beta")
+        for start in range(0, data.shape[0], size):
+            stop = min(start + size, data.shape[0])
+            low, high = int(crow[start]), int(crow[stop])
+            chunks.append(torch.sparse_csr_tensor(crow[start:stop + 1] - low, col[low:high], values[low:high],
+                                                  (stop - start, data.shape[1])))
+    return chunks
 
 
 # 23.6.8_TODO: 寻找合适的优化器  考虑SGD+学习率调整  输出权重
@@ -96,6 +148,12 @@ class GNNWR:
             | scheduler_T_0: int, the T_0 of the scheduler CosineAnnealingWarmRestarts (default: ``100``)
 
             | scheduler_T_mult: int, the T_mult of the scheduler CosineAnnealingWarmRestarts (default: ``3``)
+    metrics_sink : MetricsSink
+        where the metrics of the training are written, e.g. ``TensorBoardSink``, ``CSVSink``, ``MemorySink``
+        or ``NullSink`` (default: ``None``, ``TensorBoardSink(write_path)``)
+    execution : ExecutionConfig
+        the threads of torch, the workers of the dataloaders and the CPU affinity used by ``run`` and the
+        predictions (default: ``None``, the settings of ``init_dataset``), see ``gnnwr.tuning.tune_execution``
 
 
     """
@@ -119,28 +177,35 @@ class GNNWR:
             log_path="../gnnwr_logs/",
             log_file_name="gnnwr" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".log",
             log_level=logging.INFO,
-            optimizer_params=None
+            optimizer_params=None,
+            metrics_sink=None,
+            execution=None
     ):
         self._train_dataset = train_dataset  # train dataset
         self._valid_dataset = valid_dataset  # valid dataset
         self._test_dataset = test_dataset  # test dataset
         self._dense_layers = dense_layers  # structure of layers
         self._start_lr = start_lr  # initial learning rate
-        self._insize = train_dataset.datasize  # size of input layer
+        self._insize = train_dataset.distances.shape[1]  # size of input layer, the size of reference points
         self._outsize = train_dataset.coefsize  # size of output layer
-        self._writer = SummaryWriter(write_path)  # summary writer
+        self._write_path = write_path
+        self.__writer = None  # summary writer of add_graph, created on first use
+        if metrics_sink is None:
+            metrics_sink = TensorBoardSink(write_path)
+        self._metrics_sink = metrics_sink  # where the metrics of the training are written
+        self._execution = execution  # threads, dataloader workers and CPU affinity
         self._drop_out = drop_out  # drop_out ratio
         self._batch_norm = batch_norm  # batch normalization
         self._activate_func = activate_func  # activate function , default: PRelu(0.4)
         self._model = SWNN(self._dense_layers, self._insize, self._outsize,
                            self._drop_out, self._activate_func, self._batch_norm)  # model
+        self._add_distance_layer()
         self._log_path = log_path  # log path
         self._log_file_name = log_file_name  # log file
         self._log_level = log_level  # log level
         self.__istrained = False  # whether the model is trained
 
-        self._weight = OLS(
-            train_dataset.scaledDataframe, train_dataset.x, train_dataset.y).params  # OLS for weight
+        self._weight = least_squares(train_dataset.x_data, train_dataset.y_data)  # OLS for weight
         self._out = nn.Linear(
             self._outsize, 1, bias=False)  # layer to multiply weight,coefficients, and model output
         if use_ols:
@@ -154,15 +219,24 @@ class GNNWR:
         self._trainLossList = []  # record the loss in training process
         self._validLossList = []  # record the loss in validation process
         self._epoch = 0  # current epoch
+        self._start_epoch = 0  # first epoch of the next run, set by fine_tune
         self._bestr2 = float('-inf')  # best r2
         self._besttrainr2 = float('-inf')  # best train r2
         self._noUpdateEpoch = 0  # number of epochs without update
+        self.__best_state = None  # state_dict of the best model, saved with the checkpoints
         self._modelName = model_name  # model name
         self._modelSavePath = model_save_path  # model save path
-        self._train_diagnosis = None  # diagnosis of training
+        self.__train_outputs = None  # weights, x, y and prediction of the last training epoch
+        self.__train_diagnosis = None  # diagnosis of training, computed from them on first use
         self._test_diagnosis = None  # diagnosis of test
         self._valid_r2 = None  # r2 of validation
+        self.__valid_subset = None  # dataloader of the validation subsample of run, if any
+        self.__best_subset_r2 = float('-inf')  # best r2 of the validation subsample
+        self.__full_valid_epoch = -1  # last epoch validated on the whole validation dataset
+        self.__validated_epoch = -1  # last epoch validated on the subsample or the whole validation dataset
         self.result_data = None
+        self._profiler = PhaseTimer(enabled=False)  # timer of the phases of each epoch
+        self._distributed = False  # whether the model is trained by DistributedDataParallel
         self._use_gpu = use_gpu
         if self._use_gpu:
             if torch.cuda.is_available():
@@ -175,6 +249,60 @@ class GNNWR:
         self._optimizer_name = None
         self.init_optimizer(optimizer, optimizer_params)  # initialize the optimizer
 
+    @property
+    def _writer(self):
+        """
+        the SummaryWriter of TensorBoard, tensorboard is imported and the run directory is created on first use,
+        so that a model only used for prediction does not pay for them
+        """
+        if isinstance(self._metrics_sink, TensorBoardSink):
+            return self._metrics_sink.writer
+        if self.__writer is None:
+            from torch.utils.tensorboard import SummaryWriter  # 用于保存训练过程
+            self.__writer = SummaryWriter(self._write_path)
+        return self.__writer
+
+    def _dataloader(self, dataset, execution=None):
+        """
+        the dataloader of ``dataset`` with the settings of ``execution`` (default: the ``ExecutionConfig`` of the
+        model), the threads are set and the dataloader of the dataset is rebuilt if its workers differ
+        """
+        if execution is None:
+            execution = self._execution
+        if execution is None:
+            return dataset.dataloader
+        execution.apply()
+        dataset.dataloader = execution.configure(dataset.dataloader)
+        return dataset.dataloader
+
+    @property
+    def _train_diagnosis(self):
+        """
+        the DIAGNOSIS of the last training epoch, it needs O(n^2) memory and time, so it is only computed when
+        the metrics of the epoch are printed or logged
+        """
+        if self.__train_diagnosis is None and self.__train_outputs is not None:
+            with self._profiler.phase("train_diagnosis"):
+                self.__train_diagnosis = DIAGNOSIS(*self.__train_outputs)
+        return self.__train_diagnosis
+
+    def _train_r2(self):
+        """
+        the R2 of the last training epoch, the same as ``self._train_diagnosis.R2()`` without the diagnosis
+        """
+        if self.__train_diagnosis is not None:
+            return self.__train_diagnosis.R2().item()
+        y_true, y_pred = self.__train_outputs[2], self.__train_outputs[3]
+        return (1 - torch.sum((y_true - y_pred) ** 2) / torch.sum((y_true - torch.mean(y_true)) ** 2)).item()
+
+    def _add_distance_layer(self):
+        """
+        if the datasets compute the distances on device, put the layer computing the distance rows
+        from the coordinates of each batch in front of the model
+        """
+        if getattr(self._train_dataset, "distance_on_device", False):
+            self._model = nn.Sequential(self._train_dataset.distances.distance_layer(), self._model)
+
     def init_optimizer(self, optimizer, optimizer_params=None):
         r"""
         initialize the optimizer
@@ -183,7 +311,11 @@ class GNNWR:
         ----------
         optimizer : str
             the optimizer of the model (default: ``"Adagrad"``)
-            choose from "SGD","Adam","RMSprop","Adagrad","Adadelta"
+            choose from "SGD","Adam","RMSprop","Adagrad","Adadelta","LBFGS"
+
+            "LBFGS" trains on the whole train dataset at once, each epoch is one step of L-BFGS with up to
+            ``lbfgs_max_iter`` iterations, for small datasets; the dropout makes the loss random, so it should be
+            used with ``drop_out=0``
         optimizer_params : dict, optional
             the params of the optimizer and the scheduler (default: ``None``)
 
@@ -203,6 +335,14 @@ class GNNWR:
 
                 | stop_lr: float, the learning rate when stop change (default: ``0.001``)
 
+            if optimizer is LBFGS, the learning rate is constant and the params are:
+
+                | lbfgs_max_iter: int, the max iterations of each step (default: ``20``)
+
+                | lbfgs_history_size: int, the number of the updates kept to approximate the Hessian (default: ``10``)
+
+                | lbfgs_line_search: str, ``"strong_wolfe"`` or ``None`` (default: ``"strong_wolfe"``)
+
             if optimizer is Other, the params are:
 
                 | scheduler: str, the name of the scheduler (default: ``"CosineAnnealingWarmRestarts"``) in {``"MultiStepLR","CosineAnnealingLR","CosineAnnealingWarmRestarts"``}
@@ -220,27 +360,39 @@ class GNNWR:
                 | scheduler_T_mult: int, the T_mult of the scheduler CosineAnnealingWarmRestarts (default: ``3``)
         """
         # initialize the optimizer
+        parameters = self._parameter_groups(optimizer)
         if optimizer == "SGD":
             self._optimizer = optim.SGD(
-                self._model.parameters(), lr=1, momentum=0.9, weight_decay=1e-3)
+                parameters, lr=1, momentum=0.9, weight_decay=1e-3)
         elif optimizer == "Adam":
             self._optimizer = optim.Adam(
-                self._model.parameters(), lr=self._start_lr, weight_decay=1e-3)
+                parameters, lr=self._start_lr, weight_decay=1e-3)
         elif optimizer == "RMSprop":
             self._optimizer = optim.RMSprop(
-                self._model.parameters(), lr=self._start_lr)
+                parameters, lr=self._start_lr)
         elif optimizer == "Adagrad":
             self._optimizer = optim.Adagrad(
-                self._model.parameters(), lr=self._start_lr)
+                parameters, lr=self._start_lr)
         elif optimizer == "Adadelta":
             self._optimizer = optim.Adadelta(
-                self._model.parameters(), lr=self._start_lr)
+                parameters, lr=self._start_lr)
+        elif optimizer == "LBFGS":
+            params = optimizer_params if optimizer_params is not None else {}
+            self._optimizer = optim.LBFGS(
+                parameters, lr=self._start_lr, max_iter=params.get("lbfgs_max_iter", 20),
+                history_size=params.get("lbfgs_history_size", 10),
+                line_search_fn=params.get("lbfgs_line_search", "strong_wolfe"))
+            if self._drop_out:
+                warnings.warn("the loss of LBFGS is random with dropout, drop_out=0 is recommended", RuntimeWarning)
         else:
             raise ValueError("Invalid Optimizer")
         self._optimizer_name = optimizer  # optimizer name
 
         # lr scheduler
-        if self._optimizer_name == "SGD":
+        if self._optimizer_name == "LBFGS":
+            # the step size is chosen by the line search
+            self._scheduler = optim.lr_scheduler.LambdaLR(self._optimizer, lr_lambda=lambda epoch: 1.)
+        elif self._optimizer_name == "SGD":
             if optimizer_params is None:
                 optimizer_params = {}
             maxlr = optimizer_params.get("maxlr", 0.1)
@@ -278,18 +430,33 @@ class GNNWR:
             else:
                 raise ValueError("Invalid Scheduler")
 
+    def _parameter_groups(self, optimizer):
+        """
+        get the parameters, or the parameter groups, optimized by the optimizer
+
+        Parameters
+        ----------
+        optimizer : str
+            the name of the optimizer
+        """
+        return self._model.parameters()
+
     def __train(self):
         """
         train the network
         """
         self._model.train()  # set the model to train mode
+        if self._optimizer_name == "LBFGS":
+            self.__train_full_batch()
+            return
         train_loss = 0  # initialize the loss
         data_loader = self._train_dataset.dataloader  # get the data loader
         weight_all = torch.tensor([]).to(torch.float32)
         x_true = torch.tensor([]).to(torch.float32)
         y_true = torch.tensor([]).to(torch.float32)
         y_pred = torch.tensor([]).to(torch.float32)
-        for index, (data, coef, label, data_index) in enumerate(data_loader):
+        for index, (data, coef, label, data_index) in enumerate(self._profiler.iterate(data_loader,
+                                                                                       "train_data_loading")):
             # move the data to gpu
             device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
             data, coef, label = data.to(device), coef.to(device), label.to(device)
@@ -306,66 +473,123 @@ class GNNWR:
 
             x_true = torch.cat((x_true, coef), 0)
             y_true = torch.cat((y_true, label), 0)
-            weight = self._model(data)
-            weight_all = torch.cat((weight_all, weight.mul(torch.tensor(self._weight).to(torch.float32).to(device))), 0)
-            output = self._out(weight.mul(coef.to(torch.float32)))
-            y_pred = torch.cat((y_pred, output), 0)
-            loss = self._criterion(output, label)  # calculate the loss
-            loss.backward()  # back propagation
-            self._optimizer.step()  # update the parameters
+            with self._profiler.phase("train_step"):
+                weight = self._model(data)
+                weight_all = torch.cat(
+                    (weight_all, weight.mul(torch.tensor(self._weight).to(torch.float32).to(device))), 0)
+                output = self._out(weight.mul(coef.to(torch.float32)))
+                y_pred = torch.cat((y_pred, output), 0)
+                loss = self._criterion(output, label)  # calculate the loss
+                loss.backward()  # back propagation
+                self._optimizer.step()  # update the parameters
             if isinstance(data, list):
                 train_loss += loss.item() * data[0].size(0)
             else:
                 train_loss += loss.item() * data.size(0)  # accumulate the loss
 
-        self._train_diagnosis = DIAGNOSIS(weight_all, x_true, y_true, y_pred)
+        # the outputs are detached, so the graph of the epoch is freed before the diagnosis is needed
+        self.__train_outputs = (weight_all.detach(), x_true, y_true, y_pred.detach())
+        self.__train_diagnosis = None
         train_loss /= self._train_dataset.datasize  # calculate the average loss
+        if self._distributed:
+            train_loss = all_reduce_sum([train_loss])[0]  # each process has the loss of its part of the data
         self._trainLossList.append(train_loss)  # record the loss
 
+    def __train_full_batch(self):
+        """
+        train the network by one step of L-BFGS on the whole train dataset
+        """
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        with self._profiler.phase("train_data_loading"):
+            data, coef, label, _ = self._train_dataset[np.arange(len(self._train_dataset))]
+            data, coef, label = data.to(device), coef.to(device), label.to(device)
+        ols_weight = torch.tensor(self._weight).to(torch.float32).to(device)
+        last = {}
+
+        def closure():
+            self._optimizer.zero_grad()
+            weight = self._model(data)
+            output = self._out(weight.mul(coef.to(torch.float32)))
+            loss = self._criterion(output, label)
+            loss.backward()
+            # the outputs of the last evaluation of the line search, at or next to the parameters after the step
+            last.update(weight=weight, output=output, loss=loss)
+            return loss
+
+        with self._profiler.phase("train_step"):
+            self._optimizer.step(closure)
+        self.__train_outputs = (last["weight"].detach().mul(ols_weight), coef, label, last["output"].detach())
+        self.__train_diagnosis = None
+        self._trainLossList.append(last["loss"].item())
+
+    def _evaluate(self, data_loader, phase="valid_data_loading"):
+        """
+        the loss and the R2 of the model on a dataloader, the labels and the errors are accumulated on the device as
+        running sums and copied to the host once
+
+        Returns
+        -------
+        tuple
+            the mean squared error and the R2
+        """
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        # number of labels, sum and sum of squares of the labels minus the first mean (for accuracy), squared errors
+        sums = torch.zeros(4, dtype=torch.float64, device=device)
+        shift = None
+        with torch.no_grad():
+            for data, coef, label, data_index in self._profiler.iterate(data_loader, phase):
+                data, coef, label = data.to(device), coef.to(device), label.to(device)
+                output = self._out(self._model(data).mul(coef.to(torch.float32))).to(torch.float64)
+                label = label.to(torch.float64)
+                if shift is None:
+                    shift = label.mean()
+                centered = label - shift
+                sums += torch.stack((torch.tensor(float(label.numel()), dtype=torch.float64, device=device),
+                                     centered.sum(), centered.pow(2).sum(), (output - label).pow(2).sum()))
+        count, label_sum, label_square_sum, squared_error = sums.tolist()
+        loss = squared_error / count
+        total = label_square_sum - label_sum ** 2 / count
+        # the same as sklearn r2_score when the labels are constant
+        r2 = 1 - squared_error / total if total > 0 else float(squared_error == 0)
+        if self._distributed:
+            # every process validates the same model, the values of rank 0 are used by all of them,
+            # so that they always agree on the best model and the early stop
+            loss, r2 = broadcast_values([loss, r2])
+        return loss, r2
+
     def __valid(self):
         """
         validate the network
+        | with a validation subsample, the whole validation dataset is only evaluated when the R2 of the subsample
+        | is the best so far
         """
         self._model.eval()  # set the model to validation mode
-        val_loss = 0  # initialize the loss
-        label_list = np.array([])  # label list
-        out_list = np.array([])  # output list
-        data_loader = self._valid_dataset.dataloader  # get the data loader
-
-        with torch.no_grad():  # disable gradient calculation
-            for data, coef, label, data_index in data_loader:
-                device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
-                data, coef, label = data.to(device), coef.to(device), label.to(device)
-                # weight = self._model(data)
-                output = self._out(self._model(
-                    data).mul(coef.to(torch.float32)))
-                loss = self._criterion(output, label)  # calculate the loss
-                out_list = np.append(
-                    out_list, output.view(-1).cpu().detach().numpy())  # add the output to the list
-                label_list = np.append(
-                    label_list, label.view(-1).cpu().numpy())  # add the label to the list
-                if isinstance(data, list):
-                    val_loss += loss.item() * data[0].size(0)
-                else:
-                    val_loss += loss.item() * data.size(0)  # accumulate the loss
-            val_loss /= len(self._valid_dataset)  # calculate the average loss
-            self._validLossList.append(val_loss)  # record the loss
-            try:
-                r2 = r2_score(label_list, out_list)  # calculate the R square
-            except:
-                print(label_list)
-                print(out_list)
-            self._valid_r2 = r2
-            if r2 > self._bestr2:
-                # if the R square is better than the best R square,record the R square and save the model
-                self._bestr2 = r2
-                self._besttrainr2 = self._train_diagnosis.R2().data
-                self._noUpdateEpoch = 0
-                if not os.path.exists(self._modelSavePath):
-                    os.mkdir(self._modelSavePath)
-                torch.save(self._model, self._modelSavePath + '/' + self._modelName + ".pkl")
-            else:
+        if self.__valid_subset is not None:
+            val_loss, r2 = self._evaluate(self.__valid_subset)
+            if r2 <= self.__best_subset_r2:
+                self._validLossList.append(val_loss)
+                self._valid_r2 = r2
                 self._noUpdateEpoch += 1
+                return
+            self.__best_subset_r2 = r2
+        val_loss, r2 = self._evaluate(self._valid_dataset.dataloader)
+        self.__full_valid_epoch = self._epoch
+        self._validLossList.append(val_loss)  # record the loss
+        self._valid_r2 = r2
+        if r2 > self._bestr2:
+            # if the R square is better than the best R square,record the R square and save the model
+            self._bestr2 = r2
+            self._besttrainr2 = self._train_r2()
+            self._noUpdateEpoch = 0
+            with self._profiler.phase("model_save"):
+                self.__best_state = copy.deepcopy(_unwrap(self._model).state_dict())
+                if not self._distributed or get_rank() == 0:
+                    if not os.path.exists(self._modelSavePath):
+                        os.mkdir(self._modelSavePath)
+                    model = _unwrap(self._model) if self._distributed else self._model
+                    torch.save(model, self._modelSavePath + '/' + self._modelName + ".pkl")
+        else:
+            self._noUpdateEpoch += 1
 
     def __test(self):
         """
@@ -409,7 +633,190 @@ class GNNWR:
             self.__testr2 = r2_score(label_list, out_list)
             self._test_diagnosis = DIAGNOSIS(weight_all, x_data, y_data, y_pred)
 
-    def run(self, max_epoch=1, early_stop=-1, print_frequency=50, show_detailed_info=True):
+    def save_checkpoint(self, path, epoch):
+        """
+        save the full state of the training, so that the training can be resumed from it
+
+        Parameters
+        ----------
+        path : str
+            the path of the checkpoint
+        epoch : int
+            the number of the finished epochs
+        """
+        model = _unwrap(self._model)
+        checkpoint = {
+            "epoch": epoch,
+            "last_epoch": self._epoch,
+            "model": model.state_dict(),
+            "best_model": self.__best_state,
+            "out": self._out.state_dict(),
+            "optimizer": self._optimizer.state_dict(),
+            "scheduler": self._scheduler.state_dict(),
+            "bestr2": self._bestr2,
+            "besttrainr2": self._besttrainr2,
+            "noUpdateEpoch": self._noUpdateEpoch,
+            "valid_r2": self._valid_r2,
+            "best_subset_r2": self.__best_subset_r2,
+            "full_valid_epoch": self.__full_valid_epoch,
+            "validated_epoch": self.__validated_epoch,
+            "trainLossList": self._trainLossList,
+            "validLossList": self._validLossList,
+            "torch_rng_state": torch.get_rng_state(),
+            "cuda_rng_state": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            "numpy_rng_state": np.random.get_state(),
+            "python_rng_state": random.getstate(),
+        }
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # write to a temporary file first, so that an interrupted save never breaks the last checkpoint
+        torch.save(checkpoint, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def load_checkpoint(self, path):
+        """
+        load the full state of the training saved by ``save_checkpoint``
+        | the best model of the checkpoint is saved again to the path of the best model of this model, which may be
+        | another path than the one of the interrupted training
+
+        Parameters
+        ----------
+        path : str
+            the path of the checkpoint
+
+        Returns
+        -------
+        int
+            the number of the finished epochs
+        """
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+        model = _unwrap(self._model)
+        self.__best_state = checkpoint.get("best_model")
+        if self.__best_state is not None and (not self._distributed or get_rank() == 0):
+            best = copy.deepcopy(model if self._distributed else self._model)
+            _unwrap(best).load_state_dict(self.__best_state)
+            os.makedirs(self._modelSavePath, exist_ok=True)
+            torch.save(best, self._modelSavePath + '/' + self._modelName + ".pkl")
+        model.load_state_dict(checkpoint["model"])
+        self._out.load_state_dict(checkpoint["out"])
+        self._optimizer.load_state_dict(checkpoint["optimizer"])
+        self._scheduler.load_state_dict(checkpoint["scheduler"])
+        self._bestr2 = checkpoint["bestr2"]
+        self._besttrainr2 = checkpoint["besttrainr2"]
+        self._noUpdateEpoch = checkpoint["noUpdateEpoch"]
+        self._valid_r2 = checkpoint["valid_r2"]
+        self._epoch = checkpoint.get("last_epoch", checkpoint["epoch"] - 1)
+        self.__best_subset_r2 = checkpoint.get("best_subset_r2", float('-inf'))
+        self.__full_valid_epoch = checkpoint.get("full_valid_epoch", -1)
+        self.__validated_epoch = checkpoint.get("validated_epoch", -1)
+        self._trainLossList = checkpoint["trainLossList"]
+        self._validLossList = checkpoint["validLossList"]
+        torch.set_rng_state(checkpoint["torch_rng_state"])
+        if checkpoint["cuda_rng_state"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint["cuda_rng_state"])
+        np.random.set_state(checkpoint["numpy_rng_state"])
+        random.setstate(checkpoint["python_rng_state"])
+        return checkpoint["epoch"]
+
+    def _epoch_metrics(self):
+        """
+        the metrics of the current epoch, each of them is computed once and shared by the print, the sink and the log
+        """
+        diagnosis = self._train_diagnosis
+        return OrderedDict([
+            ('Training/Learning Rate', self._optimizer.param_groups[0]['lr']),
+            ('Training/Loss', self._trainLossList[-1]),
+            ('Training/R2', diagnosis.R2().item()),
+            ('Training/RMSE', diagnosis.RMSE().item()),
+            ('Training/AIC', float(diagnosis.AIC())),
+            ('Training/AICc', float(diagnosis.AICc())),
+            ('Validation/Loss', self._validLossList[-1] if self._validLossList else float('nan')),
+            ('Validation/R2', float('nan') if self._valid_r2 is None else float(self._valid_r2)),
+            ('Validation/Best R2', float(self._bestr2)),
+        ])
+
+    def __run_epoch(self, epoch, print_frequency, show_detailed_info, log_frequency=1, log_to_file=True,
+                    validate=True):
+        """
+        train and validate the network for one epoch, and record the information
+        """
+        # train the network
+        # record the information of the training process
+        with self._profiler.phase("train"):
+            self.__train()
+        # validate the network
+        # record the information of the validation process
+        if validate:
+            with self._profiler.phase("valid"):
+                self.__valid()
+        else:
+            self._noUpdateEpoch += 1
+        printed = print_frequency > 0 and (epoch + 1) % print_frequency == 0
+        logged = log_frequency > 0 and (epoch + 1) % log_frequency == 0 and (self._metrics_sink.enabled or log_to_file)
+        metrics = None
+        if printed or logged:
+            with self._profiler.phase("metrics"):
+                metrics = self._epoch_metrics()
+        with self._profiler.phase("logging"):
+            # out put log every {print_frequency} epoch:
+            if printed:
+                if show_detailed_info:
+                    print("\nEpoch: ", epoch + 1)
+                    print("learning rate: ", metrics['Training/Learning Rate'])
+                    print("Train Loss: ", metrics['Training/Loss'])
+                    print("Train R2: {:.5f}".format(metrics['Training/R2']))
+                    print("Train RMSE: {:.5f}".format(metrics['Training/RMSE']))
+                    print("Train AIC: {:.5f}".format(metrics['Training/AIC']))
+                    print("Train AICc: {:.5f}".format(metrics['Training/AICc']))
+                    print("Valid Loss: ", metrics['Validation/Loss'])
+                    print("Valid R2: {:.5f}".format(metrics['Validation/R2']), "\n")
+                    print("Best R2: {:.5f}".format(metrics['Validation/Best R2']), "\n")
+                else:
+                    print("\nEpoch: ", epoch + 1)
+                    print("Train R2: {:.5f}  Valid R2: {:.5f}  Best R2: {:.5f}\n".format(
+                        metrics['Training/R2'], metrics['Validation/R2'], metrics['Validation/Best R2']))
+        with self._profiler.phase("scheduler"):
+            self._scheduler.step()  # update the learning rate
+        if not logged:
+            return
+        with self._profiler.phase("metrics_sink"):
+            self._metrics_sink.write(self._epoch, metrics)
+        if log_to_file:
+            with self._profiler.phase("logging"):
+                logging.info("Epoch: " + str(epoch + 1) + "; " +
+                             "; ".join("{}: {}".format(tag, value) for tag, value in metrics.items()))
+
+    @contextlib.contextmanager
+    def _epoch_trace(self, epoch, trace_epochs, trace_path):
+        """
+        trace the epoch with ``torch.profiler`` if it is in ``trace_epochs``,
+        and save the trace as ``trace_epoch{epoch}.json`` in ``trace_path``
+        """
+        if trace_epochs is None or not trace_epochs[0] <= epoch + 1 <= trace_epochs[1]:
+            yield
+            return
+        if trace_path is None:
+            trace_path = self._write_path if self._write_path is not None else self._writer.log_dir
+        if not os.path.exists(trace_path):
+            os.makedirs(trace_path)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self._use_gpu:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        trace = torch.profiler.profile(activities=activities, record_shapes=True,
+                                       profile_memory=self._profiler.track_memory)
+        trace.start()
+        try:
+            yield
+        finally:
+            with self._profiler.phase("trace_export"):
+                trace.stop()
+                trace.export_chrome_trace(os.path.join(trace_path, "trace_epoch" + str(epoch + 1) + ".json"))
+
+    def run(self, max_epoch=1, early_stop=-1, print_frequency=50, show_detailed_info=True, callback=None,
+            checkpoint_every=0, checkpoint_path=None, resume_from=None, profile=False, profile_memory=False,
+            trace_epochs=None, trace_path=None, log_frequency=1, distributed=False, valid_every=1,
+            valid_subsample=None):
         """
         train the model and validate the model
 
@@ -426,75 +833,233 @@ class GNNWR:
 
         show_detailed_info : bool
             if ``True``, the detailed information will be shown (default: ``True``)
+        callback : callable
+            a function called as ``callback(model, epoch)`` after each epoch (default: ``None``)
+
+            if it returns ``True``, the training will stop
+        checkpoint_every : int
+            save the full state of the training every ``checkpoint_every`` epochs (default: ``0``, never)
+        checkpoint_path : str
+            the path of the checkpoint
+            (default: ``None``, ``self._modelSavePath + "/" + self._modelName + "_checkpoint.pt"``)
+        resume_from : str
+            the path of a checkpoint to resume the training from, the epochs already finished are skipped
+            (default: ``None``)
+        profile : bool
+            whether record the wall time of the phases of each epoch, see ``getProfile`` (default: ``False``)
+        profile_memory : bool
+            whether record the peak memory of the phases of each epoch too (default: ``False``)
+        trace_epochs : tuple
+            the first and the last epoch (counted from 1) traced by ``torch.profiler`` (default: ``None``)
+        trace_path : str
+            the directory of the traces (default: ``None``, the directory of the tensorboard)
+        log_frequency : int
+            the frequency of writing the metrics to the metrics sink and the log file (default: ``1``)
+
+            the metrics are only computed in the epochs printed or logged, with ``NullSink``, ``log_level`` above
+            ``logging.INFO`` or ``log_frequency=0`` the other epochs are pure computation
+        distributed : bool
+            whether train the model by ``DistributedDataParallel`` on CPU, with the gloo backend (default: ``False``)
+
+            ``run`` is called in every process, launched by ``torchrun`` or ``gnnwr.distributed.spawn``, with the
+            same datasets and model. Each process trains on its part of the train dataset with
+            ``batch_size / world_size`` samples per step; the validation, the best model and the early stop are
+            decided by the process of rank 0, which also prints, logs, writes the metrics and saves the model.
+            The train R2, RMSE, AIC and AICc are those of the part of rank 0.
+        valid_every : int
+            validate the model every ``valid_every`` epochs and after the last epoch (default: ``1``)
+
+            the epochs without validation count as epochs without update for ``early_stop``
+        valid_subsample : int or float
+            the number, or the fraction, of the validation samples in a fixed random subsample whose R2 decides when
+            to validate on the whole validation dataset (default: ``None``, always the whole dataset)
+
+            the whole dataset is only evaluated when the R2 of the subsample is the best so far, and after the last
+            epoch; the validation loss and R2 of the other epochs are those of the subsample
         """
+        if valid_every < 1:
+            raise ValueError("valid_every must be positive")
         self.__istrained = True
-        if self._use_gpu:
+        rank = 0
+        sampler = None
+        self.__valid_subset = None
+        self.__validated_epoch = -1
+        if valid_subsample is not None:
+            size = len(self._valid_dataset)
+            n_samples = int(round(valid_subsample * size)) if isinstance(valid_subsample, float) else valid_subsample
+            if not 0 < n_samples <= size:
+                raise ValueError("valid_subsample must select between 1 and all the validation samples")
+            # the same subsample in every process and every run
+            indices = np.sort(np.random.RandomState(0).choice(size, n_samples, replace=False)).tolist()
+            self.__valid_subset = _make_dataloader(self._valid_dataset, self._valid_dataset.dataloader.batch_size or
+                                                   self._valid_dataset.batch_size, False, sampler=indices)
+            self.__best_subset_r2 = float('-inf')
+        self._dataloader(self._train_dataset)
+        self._dataloader(self._valid_dataset)
+        if distributed:
+            if self._optimizer_name == "LBFGS":
+                raise ValueError("the distributed training does not support LBFGS")
+            if self._use_gpu:
+                warnings.warn("the distributed training runs on CPU, use_gpu is ignored", RuntimeWarning)
+                self._use_gpu = False
+            init_process_group()
+            rank = get_rank()
+            self._distributed = True
+            self._model = nn.parallel.DistributedDataParallel(self._model)
+            train_loader = self._train_dataset.dataloader
+            self._train_dataset.dataloader, sampler = shard_dataloader(self._train_dataset)
+            self._dataloader(self._train_dataset)
+            metrics_sink = self._metrics_sink
+            if rank != 0:
+                self._metrics_sink = NullSink()
+                print_frequency = 0
+        elif self._use_gpu:
             self._model = nn.DataParallel(module=self._model)  # parallel computing
             self._model = self._model.cuda()
             self._out = self._out.cuda()
-        # create file
-        if not os.path.exists(self._log_path):
-            os.mkdir(self._log_path)
+        if checkpoint_path is None:
+            checkpoint_path = self._modelSavePath + '/' + self._modelName + "_checkpoint.pt"
+        start_epoch, self._start_epoch = self._start_epoch, 0
+        if resume_from is not None:
+            start_epoch = self.load_checkpoint(resume_from)
+        # create file, the processes of the distributed training may create it at the same time
+        os.makedirs(self._log_path, exist_ok=True)
         file_str = self._log_path + self._log_file_name
         logging.basicConfig(format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s',
-                            filename=file_str, level=logging.INFO)
-        for epoch in trange(0, max_epoch):
+                            filename=file_str, level=self._log_level)
+        log_to_file = rank == 0 and logging.getLogger().isEnabledFor(logging.INFO)
+        self._profiler.enabled = profile or trace_epochs is not None
+        self._profiler.track_memory = profile_memory
+        self._profiler.record_functions = trace_epochs is not None
+        for epoch in trange(start_epoch, max_epoch, disable=rank != 0):
             self._epoch = epoch
-            # train the network
-            # record the information of the training process
-            self.__train()
-            # validate the network
-            # record the information of the validation process
-            self.__valid()
-            # out put log every {print_frequency} epoch:
-            if (epoch + 1) % print_frequency == 0:
-                if show_detailed_info:
-                    print("\nEpoch: ", epoch + 1)
-                    print("learning rate: ", self._optimizer.param_groups[0]['lr'])
-                    print("Train Loss: ", self._trainLossList[-1])
-                    print("Train R2: {:.5f}".format(self._train_diagnosis.R2().data))
-                    print("Train RMSE: {:.5f}".format(self._train_diagnosis.RMSE().data))
-                    print("Train AIC: {:.5f}".format(self._train_diagnosis.AIC()))
-                    print("Train AICc: {:.5f}".format(self._train_diagnosis.AICc()))
-                    print("Valid Loss: ", self._validLossList[-1])
-                    print("Valid R2: {:.5f}".format(self._valid_r2), "\n")
-                    print("Best R2: {:.5f}".format(self._bestr2), "\n")
-                else:
-                    print("\nEpoch: ", epoch + 1)
-                    print(
-                        "Train R2: {:.5f}  Valid R2: {:.5f}  Best R2: {:.5f}\n".format(self._train_diagnosis.R2().data,
-                                                                                       self._valid_r2, self._bestr2))
-            self._scheduler.step()  # update the learning rate
-            # tensorboard
-            self._writer.add_scalar('Training/Learning Rate', self._optimizer.param_groups[0]['lr'], self._epoch)
-            self._writer.add_scalar('Training/Loss', self._trainLossList[-1], self._epoch)
-            self._writer.add_scalar('Training/R2', self._train_diagnosis.R2().data, self._epoch)
-            self._writer.add_scalar('Training/RMSE', self._train_diagnosis.RMSE().data, self._epoch)
-            self._writer.add_scalar('Training/AIC', self._train_diagnosis.AIC(), self._epoch)
-            self._writer.add_scalar('Training/AICc', self._train_diagnosis.AICc(), self._epoch)
-            self._writer.add_scalar('Validation/Loss', self._validLossList[-1], self._epoch)
-            self._writer.add_scalar('Validation/R2', self._valid_r2, self._epoch)
-            self._writer.add_scalar('Validation/Best R2', self._bestr2, self._epoch)
-
-            # log output
-            log_str = "Epoch: " + str(epoch + 1) + \
-                      "; Train Loss: " + str(self._trainLossList[-1]) + \
-                      "; Train R2: {:5f}".format(self._train_diagnosis.R2().data) + \
-                      "; Train RMSE: {:5f}".format(self._train_diagnosis.RMSE().data) + \
-                      "; Train AIC: {:5f}".format(self._train_diagnosis.AIC()) + \
-                      "; Train AICc: {:5f}".format(self._train_diagnosis.AICc()) + \
-                      "; Valid Loss: " + str(self._validLossList[-1]) + \
-                      "; Valid R2: " + str(self._valid_r2) + \
-                      "; Learning Rate: " + str(self._optimizer.param_groups[0]['lr'])
-            logging.info(log_str)
+            if sampler is not None:
+                sampler.set_epoch(epoch)  # a different shuffle in each epoch, the same in all the processes
+            self._profiler.start_epoch(epoch + 1)
+            validate = (epoch + 1) % valid_every == 0 or epoch + 1 == max_epoch
+            if validate:
+                self.__validated_epoch = epoch
+            with self._epoch_trace(epoch, trace_epochs, trace_path):
+                self.__run_epoch(epoch, print_frequency, show_detailed_info, log_frequency, log_to_file, validate)
+            profile_record = self._profiler.end_epoch()
+            if profile_record is not None:
+                self._metrics_sink.write(self._epoch, {'Profile/' + key: value for key, value in profile_record.items()
+                                                       if key != "epoch"})
+                if log_to_file:
+                    logging.info("Epoch: " + str(epoch + 1) + "; Profile: " +
+                                 "; ".join("{}: {:.6f}".format(key, value) for key, value in profile_record.items()
+                                           if key != "epoch"))
+            if checkpoint_every > 0 and (epoch + 1) % checkpoint_every == 0 and rank == 0:
+                self.save_checkpoint(checkpoint_path, epoch + 1)
             if 0 < early_stop < self._noUpdateEpoch:  # stop when the model has not been updated for long time
-                print("Training stop! Model has not been improved for over {} epochs.".format(early_stop))
+                if rank == 0:
+                    print("Training stop! Model has not been improved for over {} epochs.".format(early_stop))
                 break
+            stop = callback is not None and callback(self, epoch)
+            if distributed:
+                stop = broadcast_values([float(bool(stop))])[0] > 0  # all the processes stop together
+            if stop:
+                break
+        if self.__full_valid_epoch != self._epoch and start_epoch < max_epoch:
+            # the last model is always validated on the whole validation dataset, which replaces the loss of
+            # the subsample recorded for the epoch
+            if self.__valid_subset is not None and len(self._validLossList) and self.__validated_epoch == self._epoch:
+                self._validLossList.pop()
+                self._noUpdateEpoch -= 1
+            self.__valid_subset = None
+            self.__valid()
+        self.__valid_subset = None
+        self._profiler.close()
+        self._metrics_sink.flush()
+        if distributed:
+            self._model = _unwrap(self._model)
+            self._train_dataset.dataloader = train_loader
+            self._metrics_sink = metrics_sink
+            self._distributed = False
+            barrier()  # the best model is saved by rank 0
         self.load_model(self._modelSavePath + '/' + self._modelName + ".pkl")
-        self.result_data = self.getWeights()
-        print("Best_r2:", self._bestr2)
+        if rank == 0:
+            self.result_data = self.getWeights()
+            print("Best_r2:", self._bestr2)
 
-    def predict(self, dataset):
+    def fine_tune(self, n_epochs=10, checkpoint=None, start_lr=None, **kwargs):
+        """
+        continue the training for ``n_epochs`` epochs, e.g. after new observations are added to the datasets by
+        ``update_dataset``; the best model is chosen again on the updated validation dataset
+
+        Parameters
+        ----------
+        n_epochs : int
+            the number of the epochs of fine-tuning (default: ``10``)
+        checkpoint : str
+            the checkpoint of ``save_checkpoint`` the training continues from (default: ``None``, the current
+            state of the model)
+        start_lr : float
+            the learning rate of fine-tuning (default: ``None``, the learning rate of the optimizer)
+        kwargs
+            the other arguments of ``run``
+        """
+        start_epoch = self._epoch + 1 if self.__istrained else 0
+        if checkpoint is not None:
+            start_epoch = self.load_checkpoint(checkpoint)
+        if getattr(self._train_dataset, "distance_on_device", False):
+            # the reference points may have been replaced by update_dataset
+            model = _unwrap(self._model)
+            model[0] = self._train_dataset.distances.distance_layer().to(next(model[1].parameters()).device)
+        if start_lr is not None:
+            for group in self._optimizer.param_groups:
+                group['lr'] = start_lr
+        self._bestr2 = float('-inf')
+        self._noUpdateEpoch = 0
+        self._start_epoch = start_epoch
+        self.run(start_epoch + n_epochs, **kwargs)
+
+    def time_epochs(self, n_epochs=2, execution=None, warmup=1):
+        """
+        time the training epochs on CPU with the settings of ``execution``, the parameters, the optimizer, the losses
+        and the random states are restored afterwards, so the model is the same as before
+
+        Parameters
+        ----------
+        n_epochs : int
+            the number of the timed epochs (default: ``2``)
+        execution : ExecutionConfig
+            the threads and the dataloader workers (default: ``None``, those of the model)
+        warmup : int
+            the number of the epochs run before the timed ones, e.g. to start the workers (default: ``1``)
+
+        Returns
+        -------
+        float
+            the median seconds of the timed epochs
+        """
+        if self._use_gpu:
+            raise ValueError("the epochs are timed on CPU, the model must be created with use_gpu=False")
+        train_loader = self._train_dataset.dataloader
+        state = copy.deepcopy({"model": self._model.state_dict(), "out": self._out.state_dict(),
+                               "optimizer": self._optimizer.state_dict()})
+        rng_states = (torch.get_rng_state(), np.random.get_state(), random.getstate())
+        losses, outputs, diagnosis = list(self._trainLossList), self.__train_outputs, self.__train_diagnosis
+        seconds = []
+        try:
+            self._dataloader(self._train_dataset, execution)
+            for _ in range(warmup + n_epochs):
+                start = time.perf_counter()
+                self.__train()
+                seconds.append(time.perf_counter() - start)
+        finally:
+            self._train_dataset.dataloader = train_loader
+            self._model.load_state_dict(state["model"])
+            self._out.load_state_dict(state["out"])
+            self._optimizer.load_state_dict(state["optimizer"])
+            torch.set_rng_state(rng_states[0])
+            np.random.set_state(rng_states[1])
+            random.setstate(rng_states[2])
+            self._trainLossList = losses
+            self.__train_outputs, self.__train_diagnosis = outputs, diagnosis
+        return float(np.median(seconds[warmup:]))
+
+    def predict(self, dataset, execution=None):
         """
         predict the result of the dataset
 
@@ -502,13 +1067,15 @@ class GNNWR:
         ----------
         dataset : baseDataset,predictDataset
             the dataset to be predicted
+        execution : ExecutionConfig
+            the threads and the dataloader workers of the prediction (default: ``None``, those of the model)
         
         Returns
         -------
         dataframe
             the Pandas dataframe of the dataset with the predicted result
         """
-        data_loader = dataset.dataloader
+        data_loader = self._dataloader(dataset, execution)
         if not self.__istrained:
             print("WARNING! The model hasn't been trained or loaded!")
         self._model.eval()
@@ -524,7 +1091,7 @@ class GNNWR:
         dataset.pred_result = result
         return dataset.dataframe
 
-    def predict_weight(self, dataset):
+    def predict_weight(self, dataset, execution=None):
         """
         predict the spatial weight of the dataset
 
@@ -532,13 +1099,15 @@ class GNNWR:
         ----------
         dataset : baseDataset,predictDataset
             the dataset to be predicted
+        execution : ExecutionConfig
+            the threads and the dataloader workers of the prediction (default: ``None``, those of the model)
 
         Returns
         -------
         dataframe
             the Pandas dataframe of the dataset with the predicted spatial weight
         """
-        data_loader = dataset.dataloader
+        data_loader = self._dataloader(dataset, execution)
         if not self.__istrained:
             print("WARNING! The model hasn't been trained or loaded!")
         self._model.eval()
@@ -555,6 +1124,106 @@ class GNNWR:
         result = result.cpu().detach().numpy()
         return result
 
+    def _sample_weights(self, data, n_samples):
+        """
+        run ``n_samples`` stochastic forward passes of a batch as one batched pass
+
+        Returns
+        -------
+        torch.Tensor
+            the output of the model with the shape ``(n_samples, batch, outsize)``
+        """
+        stages = _model_stages(self._model)
+        # the stages before the first dropout layer are the same for every pass, so they are computed once
+        first = len(stages)
+        for i, stage in enumerate(stages):
+            if any(isinstance(module, nn.Dropout) for module in stage.modules()):
+                first = i
+                break
+        for stage in stages[:first]:
+            if data.layout != torch.strided:
+                # the sparse proximities of SparseDistances, the first layer is a sparse-dense product as in SWNN
+                data = torch.sparse.mm(data, stage.weight.t()) + stage.bias
+            else:
+                data = stage(data)
+        batch = data.shape[0]
+        # the dropout layers sample a new mask for each row, so the passes are copies of the batch
+        data = data.repeat(n_samples, *([1] * (data.dim() - 1)))
+        for stage in stages[first:]:
+            data = stage(data)
+        return data.view(n_samples, batch, -1)
+
+    def predict_uncertainty(self, dataset, n_samples=100, quantiles=(0.025, 0.975), mc_dropout=True,
+                            chunk_size=None, execution=None):
+        """
+        predict the spatial weight of the dataset with its uncertainty by MC dropout,
+        the dropout layers of the model are kept sampling and the ``n_samples`` passes are computed in one batch
+
+        Parameters
+        ----------
+        dataset : baseDataset,predictDataset
+            the dataset to be predicted
+        n_samples : int
+            the number of stochastic passes (default: ``100``)
+        quantiles : tuple
+            the quantiles of the spatial weight (default: ``(0.025, 0.975)``)
+        mc_dropout : bool
+            whether sample the dropout layers (default: ``True``)
+
+            if ``False``, only the members of an ensemble are sampled, and a ``ValueError`` is raised for a model
+            which is not an ensemble
+        chunk_size : int
+            the number of rows computed together, so that ``chunk_size * n_samples`` rows are in memory at once
+            (default: ``None``, ``max(1, 65536 // n_samples)``)
+        execution : ExecutionConfig
+            the threads and the dataloader workers of the prediction (default: ``None``, those of the model)
+
+        Returns
+        -------
+        dataframe
+            the Pandas dataframe with the mean, standard deviation and quantiles of each spatial weight,
+            i.e. ``weight_x1_mean``, ``weight_x1_std``, ``weight_x1_q0.025``, and the ``id`` of the rows if the
+            dataset has
+        """
+        if not mc_dropout:
+            if not any(isinstance(module, SWNNEnsemble) for module in self._model.modules()):
+                raise ValueError("nothing is sampled without mc_dropout, the model is not an ensemble")
+            n_samples = 1
+        if chunk_size is None:
+            chunk_size = max(1, 65536 // n_samples)
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        ols_w = torch.tensor(self._weight).to(torch.float32).to(device)
+        q = torch.tensor(quantiles, dtype=torch.float32, device=device)
+        self._model.eval()
+        if mc_dropout:
+            for module in self._model.modules():
+                if isinstance(module, nn.Dropout):
+                    module.train()
+        stats, ids = [], []
+        try:
+            with torch.no_grad():
+                for batch in self._dataloader(dataset, execution):
+                    if len(batch) == 4:
+                        ids.append(batch[3].view(-1))
+                    for data in _split_rows(batch[0], chunk_size):
+                        weight = self._sample_weights(data.to(device), n_samples).mul(ols_w)
+                        # summarize each chunk at once, the samples are never kept for the whole dataset
+                        stats.append(torch.cat([weight.mean(dim=0), weight.std(dim=0, unbiased=False),
+                                                torch.quantile(weight, q, dim=0).permute(1, 0, 2).flatten(1)],
+                                               dim=1).cpu())
+        finally:
+            self._model.eval()
+        names = ["weight_" + x for x in self._train_dataset.x] + ["bias"]
+        columns = [name + "_mean" for name in names] + [name + "_std" for name in names] + \
+                  [name + "_q" + str(quantile) for quantile in quantiles for name in names]
+        result = pd.DataFrame(torch.cat(stats).numpy(), columns=columns)
+        # order the columns by the spatial weight
+        result = result[[name + suffix for name in names
+                         for suffix in ["_mean", "_std"] + ["_q" + str(quantile) for quantile in quantiles]]]
+        if ids:
+            result["id"] = torch.cat(ids).numpy().astype(np.int64)
+        return result
+
     def load_model(self, path, use_dict=False, map_location=None):
         """
         load the model
@@ -617,6 +1286,23 @@ class GNNWR:
         """
         return self._trainLossList, self._validLossList
 
+    def getProfile(self):
+        """
+        get the wall time, and the peak memory if recorded, of the phases of each epoch recorded by
+        ``run(profile=True)``
+
+        the phases are ``train_data_loading``, ``train_step`` (forward, backward and update), ``train_diagnosis``,
+        ``train`` (the rest of training), ``valid_data_loading``, ``model_save``, ``valid`` (the rest of validation),
+        ``logging``, ``scheduler``, ``tensorboard`` and ``trace_export``, the time of a phase excludes the phases in it
+
+        Returns
+        -------
+        dataframe
+            the Pandas dataframe with one row for each epoch, the columns are ``{phase}_seconds``,
+            ``{phase}_peak_mb`` and ``total_seconds``
+        """
+        return self._profiler.to_dataframe()
+
     def add_graph(self):
         """
         add the graph of the model to tensorboard
@@ -883,6 +1569,10 @@ class GTNNWR(GNNWR):
         STPNN_batch_norm:bool
             
             whether use batchnorm in STNN and SPNN or not (Default:``True``)
+    metrics_sink : MetricsSink
+        where the metrics of the training are written (default: ``None``, ``TensorBoardSink(write_path)``)
+    execution : ExecutionConfig
+        the threads, the dataloader workers and the CPU affinity (default: ``None``)
     """
 
     def __init__(self,
@@ -906,6 +1596,8 @@ class GTNNWR(GNNWR):
                  optimizer_params=None,
                  STPNN_outsize=1,
                  STNN_SPNN_params=None,
+                 metrics_sink=None,
+                 execution=None
                  ):
 
         if optimizer_params is None:
@@ -914,7 +1606,8 @@ class GTNNWR(GNNWR):
             dense_layers = [[], []]
         super(GTNNWR, self).__init__(train_dataset, valid_dataset, test_dataset, dense_layers[1], start_lr, optimizer,
                                      drop_out, batch_norm, activate_func, model_name, model_save_path, write_path,
-                                     use_gpu, use_ols, log_path, log_file_name, log_level, optimizer_params)
+                                     use_gpu, use_ols, log_path, log_file_name, log_level, optimizer_params,
+                                     metrics_sink, execution)
         self._STPNN_out = STPNN_outsize
         self._modelName = model_name  # model name
         if train_dataset.simple_distance:
@@ -938,4 +1631,341 @@ class GTNNWR(GNNWR):
                                               batch_norm=self.STPNN_batch_norm),
                                         SWNN(dense_layers[1], self._STPNN_out * self._insize, self._outsize, drop_out,
                                              activate_func, batch_norm))
+        self._add_distance_layer()
         self.init_optimizer(optimizer, optimizer_params)
+
+
+class GNNWREnsemble(GNNWR):
+    r"""
+    GNNWREnsemble trains ``n_members`` GNNWR models with the same structure at the same time, the SWNN of the members
+    are stacked in a ``SWNNEnsemble`` so that each mini-batch is loaded once and computed for all the members.
+    The coefficients are the mean of the members, and their variance measures the uncertainty of the estimation.
+
+    Parameters
+    ----------
+    train_dataset : baseDataset
+        the dataset of training
+    valid_dataset : baseDataset
+        the dataset of validation
+    test_dataset : baseDataset
+        the dataset of testing
+    n_members : int
+        the number of members (default: ``8``)
+    dense_layers : list
+        the dense layers of each member (default: ``None``)
+    start_lr : float or list
+        the start learning rate, or one for each member (default: ``0.1``)
+
+        the learning rates of the members are not used by ``"SGD"``, whose learning rate is set by the scheduler
+    optimizer : str, optional
+        the optimizer of the model (default: ``"Adagrad"``)
+        choose from "SGD","Adam","RMSprop","Adagrad","Adadelta"
+    drop_out : float or list
+        the drop out rate, or one for each member (default: ``0.2``)
+    batch_norm : bool, optional
+        whether use batch normalization (default: ``True``)
+    activate_func : torch.nn
+        the activate function, copied for each member (default: ``None``, ``nn.PReLU(init=0.4)`` for each member)
+    seed : int
+        if not ``None``, member ``i`` is initialized with the random seed ``seed + i`` (default: ``None``)
+
+    the other parameters are the same as ``GNNWR``
+    """
+
+    def __init__(self,
+                 train_dataset,
+                 valid_dataset,
+                 test_dataset,
+                 n_members=8,
+                 dense_layers=None,
+                 start_lr=.1,
+                 optimizer="Adagrad",
+                 drop_out=0.2,
+                 batch_norm=True,
+                 activate_func=None,
+                 seed=None,
+                 model_name="GNNWREnsemble_" + datetime.datetime.today().strftime("%Y%m%d-%H%M%S"),
+                 model_save_path="../gnnwr_models",
+                 write_path="../gnnwr_runs/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                 use_gpu: bool = True,
+                 use_ols: bool = True,
+                 log_path="../gnnwr_logs/",
+                 log_file_name="gnnwr" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".log",
+                 log_level=logging.INFO,
+                 optimizer_params=None,
+                 metrics_sink=None,
+                 execution=None
+                 ):
+        self._member_lr = list(start_lr) if isinstance(start_lr, (list, tuple)) else [start_lr] * n_members
+        if len(self._member_lr) != n_members:
+            raise ValueError("the length of start_lr must be equal to n_members")
+        if activate_func is None:
+            activate_func = nn.PReLU(init=0.4)
+        super(GNNWREnsemble, self).__init__(train_dataset, valid_dataset, test_dataset, dense_layers,
+                                            self._member_lr[0], optimizer,
+                                            drop_out[0] if isinstance(drop_out, (list, tuple)) else drop_out,
+                                            batch_norm, activate_func, model_name, model_save_path, write_path,
+                                            use_gpu, use_ols, log_path, log_file_name, log_level, optimizer_params,
+                                            metrics_sink, execution)
+        self._n_members = n_members
+        self._drop_out = drop_out
+        self._model = SWNNEnsemble(self._dense_layers, self._insize, self._outsize, n_members, drop_out,
+                                   activate_func, batch_norm, seed)
+        self._add_distance_layer()
+        self.init_optimizer(optimizer, optimizer_params)
+
+    def _ensemble(self):
+        """
+        get the ``SWNNEnsemble`` in the model
+        """
+        for module in self._model.modules():
+            if isinstance(module, SWNNEnsemble):
+                return module
+        return None
+
+    def _parameter_groups(self, optimizer):
+        if optimizer == "LBFGS":
+            raise ValueError("GNNWREnsemble does not support LBFGS")
+        ensemble = self._ensemble()
+        if ensemble is None or optimizer == "SGD":
+            return self._model.parameters()
+        # one group for each member, so that each member has its own learning rate
+        return [{"params": member.parameters(), "lr": lr} for member, lr in zip(ensemble.members, self._member_lr)]
+
+    @contextlib.contextmanager
+    def _members_output(self):
+        """
+        let the model output the results of all the members instead of their mean
+        """
+        ensemble = self._ensemble()
+        ensemble.reduction = "none"
+        try:
+            yield
+        finally:
+            ensemble.reduction = "mean"
+
+    def _train_members(self, device):
+        """
+        train the members for one epoch
+
+        Returns
+        -------
+        numpy.ndarray
+            the train loss of each member
+        """
+        self._model.train()
+        train_loss = 0
+        for data, coef, label, data_index in self._train_dataset.dataloader:
+            data, coef, label = data.to(device), coef.to(device), label.to(device)
+            self._optimizer.zero_grad()
+            weight = self._model(data)  # (members, batch, outsize)
+            output = self._out(weight.mul(coef.to(torch.float32)))
+            loss = ((output - label) ** 2).mean(dim=(1, 2))  # loss of each member
+            # the members share no parameters, so the sum keeps their gradients apart
+            loss.sum().backward()
+            self._optimizer.step()
+            train_loss += loss.detach().cpu().numpy() * data.size(0)
+        return train_loss / self._train_dataset.datasize
+
+    def _valid_members(self, device):
+        """
+        validate the members and their mean
+
+        Returns
+        -------
+        tuple
+            the loss and R2 of each member, and the loss and R2 of the mean of the members
+        """
+        self._model.eval()
+        outputs, labels = [], []
+        with torch.no_grad(), self._members_output():
+            for data, coef, label, data_index in self._valid_dataset.dataloader:
+                data, coef = data.to(device), coef.to(device)
+                output = self._out(self._model(data).mul(coef.to(torch.float32)))
+                outputs.append(output[..., 0].cpu())
+                labels.append(label.view(-1))
+        outputs = torch.cat(outputs, 1).numpy().astype(np.float64)
+        labels = torch.cat(labels).numpy().astype(np.float64)
+        member_loss = ((outputs - labels) ** 2).mean(axis=1)
+        member_r2 = 1 - member_loss / ((labels - labels.mean()) ** 2).mean()
+        mean_output = outputs.mean(axis=0)
+        return member_loss, member_r2, float(((mean_output - labels) ** 2).mean()), r2_score(labels, mean_output)
+
+    def run(self, max_epoch=1, early_stop=-1, print_frequency=50, show_detailed_info=True, callback=None,
+            checkpoint_every=0, checkpoint_path=None, resume_from=None, profile=False, profile_memory=False,
+            trace_epochs=None, trace_path=None, log_frequency=1, distributed=False, valid_every=1,
+            valid_subsample=None):
+        """
+        train the members and validate them, each member keeps its own best state on the validation dataset
+        | the checkpoints, the profile, the traces, the distributed training and the validation subsample of
+        | ``GNNWR.run`` are not supported, and a ``ValueError`` is raised if any of them is asked for
+
+        Parameters
+        ----------
+        max_epoch : int
+            the max epoch of the training (default: ``1``)
+        early_stop : int
+            if no member has been updated for ``early_stop`` epochs, the training will stop (default: ``-1``)
+
+            if ``early_stop`` is ``-1``, the training will not stop until the max epoch
+        print_frequency : int
+            the frequency of printing the information (default: ``50``)
+        show_detailed_info : bool
+            if ``True``, the R2 of each member will be shown (default: ``True``)
+        callback : callable
+            a function called as ``callback(model, epoch)`` after each epoch (default: ``None``)
+
+            if it returns ``True``, the training will stop
+        log_frequency : int
+            the frequency of writing the metrics to the metrics sink and the log file (default: ``1``)
+        valid_every : int
+            validate the members every ``valid_every`` epochs and after the last epoch (default: ``1``)
+
+            the epochs without validation count as epochs without update for ``early_stop``
+        """
+        unsupported = [name for name, value, default in (
+            ("checkpoint_every", checkpoint_every, 0), ("checkpoint_path", checkpoint_path, None),
+            ("resume_from", resume_from, None), ("profile", profile, False), ("profile_memory", profile_memory, False),
+            ("trace_epochs", trace_epochs, None), ("trace_path", trace_path, None), ("distributed", distributed, False),
+            ("valid_subsample", valid_subsample, None)) if value != default]
+        if unsupported:
+            raise ValueError("GNNWREnsemble does not support " + ", ".join(unsupported))
+        if valid_every < 1:
+            raise ValueError("valid_every must be positive")
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        self._model = self._model.to(device)
+        self._out = self._out.to(device)
+        self._dataloader(self._train_dataset)
+        self._dataloader(self._valid_dataset)
+        if not os.path.exists(self._log_path):
+            os.mkdir(self._log_path)
+        file_str = self._log_path + self._log_file_name
+        logging.basicConfig(format='%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s',
+                            filename=file_str, level=self._log_level)
+        log_to_file = logging.getLogger().isEnabledFor(logging.INFO)
+        ensemble = self._ensemble()
+        best_member_r2 = np.full(self._n_members, -np.inf)
+        best_states = [copy.deepcopy(member.state_dict()) for member in ensemble.members]
+        for epoch in trange(0, max_epoch):
+            self._epoch = epoch
+            train_loss = self._train_members(device)
+            self._trainLossList.append(float(train_loss.mean()))
+            improved = []
+            if (epoch + 1) % valid_every == 0 or epoch + 1 == max_epoch:
+                member_loss, member_r2, valid_loss, self._valid_r2 = self._valid_members(device)
+                self._validLossList.append(valid_loss)
+                self._bestr2 = max(self._bestr2, self._valid_r2)
+                improved = np.flatnonzero(member_r2 > best_member_r2)
+                for i in improved:
+                    best_member_r2[i] = member_r2[i]
+                    best_states[i] = copy.deepcopy(ensemble.members[i].state_dict())
+            self._noUpdateEpoch = 0 if len(improved) else self._noUpdateEpoch + 1
+            if (epoch + 1) % print_frequency == 0 and self._validLossList:
+                print("\nEpoch: ", epoch + 1)
+                print("Train Loss: {:.5f}  Valid R2: {:.5f}  Best R2: {:.5f}".format(self._trainLossList[-1],
+                                                                                   self._valid_r2, self._bestr2))
+                if show_detailed_info:
+                    print("Members Best R2: ", " ".join("{:.5f}".format(r2) for r2 in best_member_r2), "\n")
+            learning_rate = self._optimizer.param_groups[0]['lr']
+            self._scheduler.step()  # update the learning rate
+            if log_frequency > 0 and (epoch + 1) % log_frequency == 0 and self._validLossList:
+                self._metrics_sink.write(self._epoch, OrderedDict([
+                    ('Training/Learning Rate', learning_rate),
+                    ('Training/Loss', self._trainLossList[-1]),
+                    ('Validation/Loss', self._validLossList[-1]),
+                    ('Validation/R2', float(self._valid_r2)),
+                    ('Validation/Best R2', float(self._bestr2)),
+                ]))
+                if log_to_file:
+                    logging.info("Epoch: " + str(epoch + 1) +
+                                 "; Train Loss: " + str(self._trainLossList[-1]) +
+                                 "; Valid Loss: " + str(self._validLossList[-1]) +
+                                 "; Valid R2: " + str(self._valid_r2) +
+                                 "; Members Best R2: " + str(best_member_r2.tolist()))
+            if 0 < early_stop < self._noUpdateEpoch:  # stop when no member has been updated for long time
+                print("Training stop! Model has not been improved for over {} epochs.".format(early_stop))
+                break
+            if callback is not None and callback(self, epoch):
+                break
+        self._metrics_sink.flush()
+        # every member goes back to its best state
+        for member, state in zip(ensemble.members, best_states):
+            member.load_state_dict(state)
+        if not os.path.exists(self._modelSavePath):
+            os.mkdir(self._modelSavePath)
+        torch.save(self._model, self._modelSavePath + '/' + self._modelName + ".pkl")
+        self.load_model(self._modelSavePath + '/' + self._modelName + ".pkl")
+        self._bestr2 = self._valid_members(device)[3]
+        self.result_data = self.getWeights()
+        print("Best_r2:", self._bestr2)
+
+    def predict(self, dataset, execution=None):
+        """
+        predict the result of the dataset by the mean of the members
+
+        Parameters
+        ----------
+        dataset : baseDataset,predictDataset
+            the dataset to be predicted
+        execution : ExecutionConfig
+            the threads and the dataloader workers of the prediction (default: ``None``, those of the model)
+
+        Returns
+        -------
+        dataframe
+            the Pandas dataframe of the dataset with the predicted result ``pred_result`` and
+            its standard deviation among the members ``pred_std``, the population standard deviation (``ddof=0``)
+            like the variance of ``predict_weight``
+        """
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        self._model.eval()
+        result = []
+        with torch.no_grad(), self._members_output():
+            for batch in self._dataloader(dataset, execution):
+                data, coef = batch[0].to(device), batch[1].to(device)
+                output = self._out(self._model(data).mul(coef.to(torch.float32)))
+                result.append(output[..., 0].cpu())
+        result = torch.cat(result, 1).numpy()
+        dataset.dataframe['pred_result'] = result.mean(axis=0)
+        dataset.dataframe['pred_std'] = result.std(axis=0)
+        dataset.pred_result = result.mean(axis=0)
+        return dataset.dataframe
+
+    def predict_weight(self, dataset, return_var=False, execution=None):
+        """
+        predict the spatial weight of the dataset by the mean of the members
+
+        Parameters
+        ----------
+        dataset : baseDataset,predictDataset
+            the dataset to be predicted
+        return_var : bool
+            whether return the variance of the spatial weight among the members, the population variance
+            (``ddof=0``) like the standard deviation of ``predict`` (default: ``False``)
+        execution : ExecutionConfig
+            the threads and the dataloader workers of the prediction (default: ``None``, those of the model)
+
+        Returns
+        -------
+        numpy.ndarray or tuple
+            the mean of the spatial weight, and its variance if ``return_var`` is ``True``
+        """
+        device = torch.device('cuda') if self._use_gpu else torch.device('cpu')
+        ols_w = torch.tensor(self._weight).to(torch.float32).to(device)
+        self._model.eval()
+        mean, var = [], []
+        with torch.no_grad(), self._members_output():
+            for batch in self._dataloader(dataset, execution):
+                weight = self._model(batch[0].to(device)).mul(ols_w)
+                mean.append(weight.mean(dim=0).cpu())
+                var.append(weight.var(dim=0, unbiased=False).cpu())
+        if return_var:
+            return torch.cat(mean).numpy(), torch.cat(var).numpy()
+        return torch.cat(mean).numpy()
+
+    def _sample_weights(self, data, n_samples):
+        batch = data.shape[0]
+        with self._members_output():
+            weight = self._model(data.repeat(n_samples, 1))  # (members, n_samples * batch, outsize)
+        # every member and every pass is a sample
+        return weight.reshape(-1, batch, weight.shape[-1])
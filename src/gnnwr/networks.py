@@ -1,6 +1,8 @@
+import copy
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 def default_dense_layer(insize, outsize):
@@ -87,11 +89,110 @@ class SWNN(nn.Module):
                     m.bias.data.fill_(0)
 
     def forward(self, x):
+        if x.layout != torch.strided:
+            # the sparse proximities of SparseDistances, the first layer is a sparse-dense product
+            first = self.fc[0]
+            x = torch.sparse.mm(x, first.weight.t()) + first.bias
+            return self.fc[1:](x)
         x.to(torch.float32)
         x = self.fc(x)
         return x
 
 
+class SWNNEnsemble(nn.Module):
+    """
+    SWNNEnsemble trains ``n_members`` independent SWNN with the same structure in one pass,
+    the layers of the members are stacked and computed by grouped batched matrix multiplication.
+    | The members are ordinary SWNN in ``members`` and can be used alone
+    | The output has the shape ``(n_members, batch, outsize)`` in training, and in evaluation the outputs of the members
+    | are averaged to ``(batch, outsize)`` unless ``reduction`` is ``"none"``
+
+    Parameters
+    ----------
+    dense_layer: list
+        a list of dense layers of Neural Network
+    insize: int
+        input size of Neural Network(must be positive)
+    outsize: int
+        Output size of Neural Network(must be positive)
+    n_members: int
+        number of members(default: ``8``)
+    drop_out: float or list
+        drop out rate, or one rate per member(default: ``0.2``)
+    activate_func: torch.nn.Module
+        activate function, copied for each member(default: ``None``, ``nn.PReLU(init=0.1)`` for each member)
+    batch_norm: bool
+        whether use batch normalization(default: ``True``)
+    seed: int
+        if not ``None``, member ``i`` is initialized with the random seed ``seed + i``(default: ``None``)
+    """
+    def __init__(self, dense_layer=None, insize=-1, outsize=-1, n_members=8, drop_out=0.2, activate_func=None,
+                 batch_norm=True, seed=None):
+
+        super(SWNNEnsemble, self).__init__()
+        if n_members < 1:
+            raise ValueError("n_members must be positive")
+        if not isinstance(drop_out, (list, tuple)):
+            drop_out = [drop_out] * n_members
+        if len(drop_out) != n_members:
+            raise ValueError("the length of drop_out must be equal to n_members")
+        self.n_members = n_members
+        self.reduction = "mean"
+        members = []
+        for i in range(n_members):
+            if seed is not None:
+                torch.manual_seed(seed + i)
+            activate = nn.PReLU(init=0.1) if activate_func is None else copy.deepcopy(activate_func)
+            members.append(SWNN(dense_layer, insize, outsize, drop_out[i], activate, batch_norm))
+        self.members = nn.ModuleList(members)
+        self.register_buffer("drop_out", torch.tensor(drop_out, dtype=torch.float32).view(-1, 1, 1))
+
+    def forward(self, x):
+        x = x.to(torch.float32)
+        # the modules at the same position of all members
+        for modules in zip(*[member.fc for member in self.members]):
+            first = modules[0]
+            if isinstance(first, nn.Linear):
+                weight = torch.stack([module.weight for module in modules]).transpose(1, 2)
+                bias = torch.stack([module.bias for module in modules]).unsqueeze(1)
+                # (batch, in) is broadcast to every member in the first layer
+                x = torch.matmul(x, weight) + bias
+            elif isinstance(first, nn.BatchNorm1d):
+                members, batch, size = x.shape
+                running_mean = torch.cat([module.running_mean for module in modules])
+                running_var = torch.cat([module.running_var for module in modules])
+                x = F.batch_norm(x.transpose(0, 1).reshape(batch, members * size), running_mean, running_var,
+                                 torch.cat([module.weight for module in modules]),
+                                 torch.cat([module.bias for module in modules]),
+                                 self.training, first.momentum, first.eps)
+                x = x.reshape(batch, members, size).transpose(0, 1)
+                if self.training:
+                    # write the updated statistics back to the members
+                    with torch.no_grad():
+                        for i, module in enumerate(modules):
+                            module.running_mean.copy_(running_mean[i * size:(i + 1) * size])
+                            module.running_var.copy_(running_var[i * size:(i + 1) * size])
+                            module.num_batches_tracked += 1
+            elif isinstance(first, nn.PReLU):
+                slope = torch.stack([module.weight for module in modules])
+                x = torch.where(x >= 0, x, slope.view(len(modules), 1, -1) * x)
+            elif isinstance(first, nn.Dropout):
+                # follow the mode of the dropout layer of each member, which may sample in evaluation (MC dropout)
+                training = [module.training for module in modules]
+                if any(training):
+                    drop_out = self.drop_out * torch.tensor(training, dtype=x.dtype, device=x.device).view(-1, 1, 1)
+                    keep = (torch.rand_like(x) >= drop_out).to(x.dtype)
+                    x = x * keep / torch.clamp(1 - drop_out, min=1e-12)
+            elif any(True for _ in first.parameters()) or any(True for _ in first.buffers()):
+                # other modules with parameters or states, e.g. a custom activate function, are run by each member
+                x = torch.stack([module(x[i]) for i, module in enumerate(modules)])
+            else:
+                x = first(x)
+        if not self.training and self.reduction == "mean":
+            x = x.mean(dim=0)
+        return x
+
+
 class STPNN(nn.Module):
     """
     STPNN is a neural network with dense layers, which is used to calculate the spatial and temporal proximity
@@ -199,6 +300,56 @@ class STNN_SPNN(nn.Module):
         return output
 
 
+class DistanceLayer(nn.Module):
+    """
+    DistanceLayer computes the scaled distances between the input coordinates and the reference points,
+    so that the distance rows of a batch are computed on the device of the model instead of being copied to it.
+    | the input is the concatenated coordinates of each channel, the output has the shape ``(batch, m)``
+    | with one channel and ``(batch, m, channels)`` otherwise, the same as ``LazyDistances``
+
+    Parameters
+    ----------
+    references: list
+        coordinates of the reference points, one array per channel
+    providers: list
+        distance providers with ``torch_pairwise``, one per channel
+    scale_fn: str
+        scale function name of the distances, ``minmax_scale`` or ``standard_scale``
+    scale_param: dict
+        scale parameters of the distances
+    """
+    def __init__(self, references, providers, scale_fn, scale_param):
+
+        super(DistanceLayer, self).__init__()
+        self.providers = providers
+        self.widths = [reference.shape[1] for reference in references]
+        for i, reference in enumerate(references):
+            self.register_buffer("reference" + str(i), torch.tensor(reference, dtype=torch.float32))
+        # express the scaling as distance * scale + offset
+        if scale_fn == "minmax_scale":
+            data_range = torch.tensor(scale_param["max"] - scale_param["min"], dtype=torch.float64)
+            scale = 1 / torch.where(data_range == 0, torch.ones_like(data_range), data_range)
+            offset = -torch.tensor(scale_param["min"], dtype=torch.float64) * scale
+        elif scale_fn == "standard_scale":
+            std = torch.sqrt(torch.tensor(scale_param["var"], dtype=torch.float64))
+            scale = 1 / torch.where(std == 0, torch.ones_like(std), std)
+            offset = -torch.tensor(scale_param["mean"], dtype=torch.float64) * scale
+        else:
+            raise ValueError("scale_fn must be minmax_scale or standard_scale")
+        self.register_buffer("scale", scale.to(torch.float32))
+        self.register_buffer("offset", offset.to(torch.float32))
+
+    def forward(self, x):
+        x = x.to(torch.float32)
+        channels = []
+        start = 0
+        for i, (provider, width) in enumerate(zip(self.providers, self.widths)):
+            channels.append(provider.torch_pairwise(x[:, start:start + width], getattr(self, "reference" + str(i))))
+            start += width
+        x = channels[0] if len(channels) == 1 else torch.stack(channels, dim=-1)
+        return x * self.scale + self.offset
+
+
 # 权共享计算
 def weight_share(model, x, output_size=1):
     """
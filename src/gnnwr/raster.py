@@ -0,0 +1,341 @@
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+
+r"""
+The package of `raster` renders the coefficient surfaces of ``result_data`` offline, without folium and the tile
+server of ``Visualize``:
+    1. rasterize: interpolate the columns of scattered points onto a regular longitude/latitude grid
+    2. write_png, write_world_file: save a grid as a colored PNG, or as ``.npy`` with ``numpy.save``, georeferenced
+       by a world file
+    3. export_tiles: write XYZ (web mercator) tiles of the columns at several zoom levels, which can be browsed
+       offline, e.g. by ``folium.TileLayer(tiles=path + "/{z}/{x}/{y}.png", attr="gnnwr")``
+    4. export_coefficients: the grids, PNGs and tiles of the ``weight_*`` columns of a trained model
+"""
+
+YLORRD = ["#ffffcc", "#ffeda0", "#fed976", "#feb24c", "#fd8d3c", "#fc4e2a", "#e31a1c", "#bd0026",
+          "#800026"]  # the colors of YlOrRd_09, the default colormap of Visualize
+METHODS = ["idw", "nearest", "bin"]
+_MAX_LATITUDE = 85.0511287798  # the latitude limit of web mercator
+_CHUNK_PIXELS = 2 ** 16  # pixels interpolated at a time, bounds the (pixels, k, columns) temporaries
+
+
+def _check_method(method):
+    if method not in METHODS:
+        raise ValueError("method must be one of " + ", ".join(METHODS))
+
+
+def _data_bounds(lon, lat):
+    """
+    the (west, south, east, north) of the points, widened if the points are on a line
+    """
+    west, east, south, north = lon.min(), lon.max(), lat.min(), lat.max()
+    pad_lon = 0.5 if east == west else 0.
+    pad_lat = 0.5 if north == south else 0.
+    return float(west - pad_lon), float(south - pad_lat), float(east + pad_lon), float(north + pad_lat)
+
+
+def _interpolate(tree, values, pixels, method="idw", k=8, power=2., max_distance=None):
+    """
+    interpolate ``values`` (points, columns) of the points in ``tree`` at ``pixels`` (pixels, 2) by inverse distance
+    weighting of the ``k`` nearest points, or by the nearest point
+
+    the pixels without any point within ``max_distance`` are ``NaN``
+    """
+    result = np.full((len(pixels), values.shape[1]), np.nan, dtype=np.float32)
+    k = 1 if method == "nearest" else min(k, tree.n)
+    upper_bound = np.inf if max_distance is None else max_distance
+    for start in range(0, len(pixels), _CHUNK_PIXELS):
+        distance, index = tree.query(pixels[start:start + _CHUNK_PIXELS], k=k, distance_upper_bound=upper_bound)
+        if k == 1:
+            distance, index = distance[:, None], index[:, None]
+        # the missing neighbours have an infinite distance and the index tree.n
+        found = np.isfinite(distance)
+        index = np.where(found, index, 0)
+        if k == 1:
+            weight = found.astype(np.float64)
+        else:
+            with np.errstate(divide="ignore"):
+                weight = np.where(found, 1. / distance ** power, 0.)
+            exact = found & (distance == 0)
+            hit = exact.any(axis=1)
+            weight[hit] = exact[hit]  # a pixel on a point takes its value
+        total = weight.sum(axis=1)
+        valid = total > 0
+        chunk = np.einsum("pk,pkc->pc", weight[valid], values[index[valid]]) / total[valid, None]
+        result[start:start + _CHUNK_PIXELS][valid] = chunk
+    return result
+
+
+def _bin_mean(lon, lat, values, bounds, width, height):
+    """
+    the mean of ``values`` (points, columns) of the points in each pixel, ``NaN`` for the empty pixels
+    """
+    west, south, east, north = bounds
+    col = np.floor((lon - west) / (east - west) * width).astype(np.int64)
+    row = np.floor((north - lat) / (north - south) * height).astype(np.int64)
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    pixel = row[inside] * width + col[inside]
+    count = np.bincount(pixel, minlength=width * height)
+    result = np.full((width * height, values.shape[1]), np.nan, dtype=np.float32)
+    filled = count > 0
+    for c in range(values.shape[1]):
+        total = np.bincount(pixel, weights=values[inside, c], minlength=width * height)
+        result[filled, c] = total[filled] / count[filled]
+    return result
+
+
+def rasterize(points, columns, lon_column, lat_column, width=512, height=None, bounds=None, method="idw", k=8,
+              power=2., max_distance=None):
+    r"""
+    interpolate the columns of scattered points onto a regular longitude/latitude grid
+
+    :param points: the Pandas dataframe of the points, e.g. ``result_data`` of a trained model
+    :param columns: the names of the columns rasterized
+    :param lon_column: the name of the longitude (x) column
+    :param lat_column: the name of the latitude (y) column
+    :param width: the number of pixels from west to east
+    :param height: the number of pixels from north to south (default: ``None``, keep the aspect of ``bounds``)
+    :param bounds: the (west, south, east, north) of the grid (default: ``None``, the extent of the points)
+    :param method: ``"idw"`` (inverse distance weighting of the ``k`` nearest points), ``"nearest"``,
+                   or ``"bin"`` (the mean of the points in each pixel, no interpolation)
+    :param k: the number of points of the inverse distance weighting
+    :param power: the power of the distance of the inverse distance weighting
+    :param max_distance: the pixels farther than ``max_distance`` (in the units of the coordinates) from every point
+                         are ``NaN`` (default: ``None``, no limit)
+    :return: dict of ``{column: float32 array (height, width)}``, the first row is the north, and the bounds
+    """
+    _check_method(method)
+    lon = points[lon_column].to_numpy(dtype=np.float64)
+    lat = points[lat_column].to_numpy(dtype=np.float64)
+    values = points[list(columns)].to_numpy(dtype=np.float64)
+    if bounds is None:
+        bounds = _data_bounds(lon, lat)
+    west, south, east, north = bounds
+    if height is None:
+        height = max(int(round(width * (north - south) / (east - west))), 1)
+    if method == "bin":
+        grid = _bin_mean(lon, lat, values, bounds, width, height)
+    else:
+        from scipy.spatial import cKDTree  # imported on first use, it is slow to import
+        pixel_lon = west + (np.arange(width) + 0.5) * (east - west) / width
+        pixel_lat = north - (np.arange(height) + 0.5) * (north - south) / height
+        pixels = np.stack(np.meshgrid(pixel_lon, pixel_lat), axis=-1).reshape(-1, 2)
+        grid = _interpolate(cKDTree(np.stack([lon, lat], axis=1)), values, pixels, method, k, power, max_distance)
+    grid = grid.reshape(height, width, len(columns))
+    return {column: np.ascontiguousarray(grid[:, :, c]) for c, column in enumerate(columns)}, tuple(bounds)
+
+
+def _to_rgba(grid, vmin, vmax, colors):
+    """
+    color the grid by the colors spread evenly from ``vmin`` to ``vmax``, the ``NaN`` pixels are transparent
+    """
+    palette = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in colors], dtype=np.float64)
+    finite = np.isfinite(grid)
+    scaled = np.zeros(grid.shape, dtype=np.float64)
+    if vmax > vmin:
+        scaled[finite] = np.clip((grid[finite] - vmin) / (vmax - vmin), 0, 1)
+    stops = np.linspace(0, 1, len(palette))
+    rgba = np.empty(grid.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.round(np.interp(scaled, stops, palette[:, channel]))
+    rgba[..., 3] = np.where(finite, 255, 0)
+    return rgba
+
+
+def _encode_png(rgba):
+    """
+    encode an RGBA array (height, width, 4) of uint8 as a PNG file, without any imaging library
+    """
+    height, width = rgba.shape[:2]
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    # every scanline starts with the filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    return b"".join([b"\x89PNG\r\n\x1a\n",
+                     chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+                     chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+                     chunk(b"IEND", b"")])
+
+
+def _prepare_directory(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+
+def write_png(path, grid, vmin=None, vmax=None, colors=None):
+    r"""
+    save a grid as a colored PNG, the ``NaN`` pixels are transparent
+
+    :param path: the path of the PNG
+    :param grid: the array (height, width), the first row is the north
+    :param vmin: the value of the first color (default: ``None``, the min of the grid)
+    :param vmax: the value of the last color (default: ``None``, the max of the grid)
+    :param colors: the colors as ``"#RRGGBB"`` from ``vmin`` to ``vmax`` (default: ``None``, ``YLORRD``)
+    """
+    vmin = float(np.nanmin(grid)) if vmin is None else vmin
+    vmax = float(np.nanmax(grid)) if vmax is None else vmax
+    _prepare_directory(path)
+    with open(path, "wb") as file:
+        file.write(_encode_png(_to_rgba(grid, vmin, vmax, YLORRD if colors is None else colors)))
+
+
+def write_world_file(path, bounds, shape):
+    r"""
+    save the georeference of a grid as a world file (``.pgw`` for a PNG, ``.wld`` in general), which GIS software
+    reads next to the image
+
+    :param path: the path of the world file
+    :param bounds: the (west, south, east, north) of the grid
+    :param shape: the (height, width) of the grid
+    """
+    west, south, east, north = bounds
+    height, width = shape[:2]
+    pixel_x = (east - west) / width
+    pixel_y = (north - south) / height
+    _prepare_directory(path)
+    with open(path, "w") as file:
+        # the size of a pixel, the rotations and the center of the upper left pixel
+        file.write("\n".join(repr(float(value)) for value in
+                             [pixel_x, 0., 0., -pixel_y, west + pixel_x / 2, north - pixel_y / 2]) + "\n")
+
+
+def _tile_range(bounds, zoom):
+    """
+    the x and y ranges of the tiles covering the bounds at the zoom level
+    """
+    west, south, east, north = bounds
+    n = 2 ** zoom
+
+    def tile_x(lon):
+        return min(max(int((lon + 180.) / 360. * n), 0), n - 1)
+
+    def tile_y(lat):
+        lat = math.radians(min(max(lat, -_MAX_LATITUDE), _MAX_LATITUDE))
+        return min(max(int((1. - math.asinh(math.tan(lat)) / math.pi) / 2. * n), 0), n - 1)
+
+    return range(tile_x(west), tile_x(east) + 1), range(tile_y(north), tile_y(south) + 1)
+
+
+def _tile_pixels(x, y, zoom, tile_size):
+    """
+    the longitude and latitude of the pixel centers of a tile, (tile_size * tile_size, 2)
+    """
+    n = 2 ** zoom
+    position = np.arange(tile_size) + 0.5
+    lon = (x + position / tile_size) / n * 360. - 180.
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * (y + position / tile_size) / n))))
+    return np.stack(np.meshgrid(lon, lat), axis=-1).reshape(-1, 2)
+
+
+def export_tiles(points, columns, lon_column, lat_column, path, zoom_levels=range(0, 8), tile_size=256,
+                 method="idw", k=8, power=2., max_distance=None, vmin=None, vmax=None, colors=None, fmt="png"):
+    r"""
+    write XYZ (web mercator) tiles of the columns, ``path/{column}/{z}/{x}/{y}.png``, at several zoom levels
+
+    the tiles are interpolated from the points directly at each zoom level, the pixels outside the extent of the
+    points are transparent and the empty tiles are not written
+
+    :param points: the Pandas dataframe of the points, whose coordinates are longitude and latitude in degrees
+    :param columns: the names of the columns
+    :param lon_column: the name of the longitude column
+    :param lat_column: the name of the latitude column
+    :param path: the directory of the tiles
+    :param zoom_levels: the zoom levels
+    :param tile_size: the number of pixels of each side of a tile
+    :param method: ``"idw"`` or ``"nearest"``, see ``rasterize``
+    :param k: the number of points of the inverse distance weighting
+    :param power: the power of the distance of the inverse distance weighting
+    :param max_distance: the pixels farther than ``max_distance`` degrees from every point are transparent
+    :param vmin: the value of the first color of every column (default: ``None``, the min of each column)
+    :param vmax: the value of the last color of every column (default: ``None``, the max of each column)
+    :param colors: the colors as ``"#RRGGBB"`` (default: ``None``, ``YLORRD``)
+    :param fmt: ``"png"``, or ``"npy"`` for the float32 values of the tiles
+    :return: the number of tiles written of each column
+    """
+    if method not in ["idw", "nearest"]:
+        raise ValueError("the tiles are interpolated by 'idw' or 'nearest'")
+    if fmt not in ["png", "npy"]:
+        raise ValueError("fmt must be 'png' or 'npy'")
+    from scipy.spatial import cKDTree  # imported on first use, it is slow to import
+    columns = list(columns)
+    lon = points[lon_column].to_numpy(dtype=np.float64)
+    lat = points[lat_column].to_numpy(dtype=np.float64)
+    values = points[columns].to_numpy(dtype=np.float64)
+    lows = values.min(axis=0) if vmin is None else np.full(len(columns), vmin)
+    highs = values.max(axis=0) if vmax is None else np.full(len(columns), vmax)
+    bounds = _data_bounds(lon, lat)
+    west, south, east, north = bounds
+    tree = cKDTree(np.stack([lon, lat], axis=1))
+    written = 0
+    for zoom in zoom_levels:
+        x_range, y_range = _tile_range(bounds, zoom)
+        for x in x_range:
+            for y in y_range:
+                pixels = _tile_pixels(x, y, zoom, tile_size)
+                inside = (pixels[:, 0] >= west) & (pixels[:, 0] <= east) & \
+                         (pixels[:, 1] >= south) & (pixels[:, 1] <= north)
+                if not inside.any():
+                    continue
+                tile = np.full((len(pixels), len(columns)), np.nan, dtype=np.float32)
+                tile[inside] = _interpolate(tree, values, pixels[inside], method, k, power, max_distance)
+                if np.isnan(tile).all():
+                    continue
+                tile = tile.reshape(tile_size, tile_size, len(columns))
+                for c, column in enumerate(columns):
+                    file_path = os.path.join(path, str(column), str(zoom), str(x), str(y) + "." + fmt)
+                    if fmt == "png":
+                        write_png(file_path, tile[:, :, c], lows[c], highs[c], colors)
+                    else:
+                        _prepare_directory(file_path)
+                        np.save(file_path, np.ascontiguousarray(tile[:, :, c]))
+                written += 1
+    return written
+
+
+def export_coefficients(model, path, columns=None, lon_lat_columns=None, width=1024, zoom_levels=None, method="idw",
+                        k=8, power=2., max_distance=None, colors=None):
+    r"""
+    write the coefficient surfaces of a trained model: ``{column}.npy`` (float32 grid), ``{column}.png`` and their
+    world files ``{column}.wld`` and ``{column}.pgw``, and the tiles in ``path/tiles`` if ``zoom_levels`` is given
+
+    :param model: the trained GNNWR/GTNNWR, whose ``result_data`` holds the coefficients
+    :param path: the output directory
+    :param columns: the names of the columns (default: ``None``, the ``weight_*`` columns)
+    :param lon_lat_columns: the longitude and latitude columns (default: ``None``, the spatial columns of the dataset)
+    :param width: the number of pixels from west to east of the grids
+    :param zoom_levels: the zoom levels of the tiles (default: ``None``, no tiles)
+    :param method: the interpolation, see ``rasterize``
+    :param k: the number of points of the inverse distance weighting
+    :param power: the power of the distance of the inverse distance weighting
+    :param max_distance: the pixels farther than ``max_distance`` from every point are ``NaN``
+    :param colors: the colors of the PNGs as ``"#RRGGBB"`` (default: ``None``, ``YLORRD``)
+    :return: dict of ``{column: grid}`` and the bounds of the grids
+    """
+    data = model.result_data if model.result_data is not None else model.getWeights()
+    if columns is None:
+        columns = [column for column in data.columns if str(column).startswith("weight_")]
+    if lon_lat_columns is None:
+        lon_lat_columns = model._train_dataset.spatial_column
+    lon_column, lat_column = lon_lat_columns[0], lon_lat_columns[1]
+    grids, bounds = rasterize(data, columns, lon_column, lat_column, width=width, method=method, k=k, power=power,
+                              max_distance=max_distance)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for column, grid in grids.items():
+        np.save(os.path.join(path, column + ".npy"), grid)
+        write_png(os.path.join(path, column + ".png"), grid, float(data[column].min()), float(data[column].max()),
+                  colors)
+        for extension in [".wld", ".pgw"]:
+            write_world_file(os.path.join(path, column + extension), bounds, grid.shape)
+    if zoom_levels is not None:
+        export_tiles(data, columns, lon_column, lat_column, os.path.join(path, "tiles"), zoom_levels,
+                     method="nearest" if method == "bin" else method, k=k, power=power, max_distance=max_distance,
+                     colors=colors)
+    return grids, bounds
@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .datasets import init_predict_dataset
+
+r"""
+The package of `serving` includes the micro-batching predictor of a trained GNNWR/GTNNWR for request/response
+services:
+    1. BatchPredictor: collect the concurrent requests, compute their distances and predict them in one batch
+"""
+
+
+class BatchPredictor:
+    r"""
+    BatchPredictor collects the points of concurrent requests for up to ``max_wait_ms`` milliseconds or
+    ``max_batch_size`` points, computes their distances to the reference points at once, runs a single forward pass
+    and returns the result of each request.
+    | the forward pass runs in a worker thread, so the requests are still collected while a batch is predicted
+
+    Examples
+    --------
+    .. code-block:: python
+
+        predictor = BatchPredictor(model, train_dataset, x_column, spatial_column)
+        async with predictor:
+            result = await predictor.predict(points)
+
+    Parameters
+    ----------
+    model : GNNWR
+        the trained model
+    train_dataset : baseDataset
+        the dataset of training, which holds the reference points and the scale parameters
+    x_column : list
+        the independent variable column names
+    spatial_column : list
+        the spatial column names
+    temp_column : list
+        the temporal column names (default: ``None``)
+    max_batch_size : int
+        the max number of points predicted together (default: ``1024``)
+    max_wait_ms : float
+        the max time the first request of a batch waits for other requests (default: ``5``)
+    process_fn : str
+        the scale function of the data, ``"minmax_scale"`` or ``"standard_scale"`` (default: ``"minmax_scale"``)
+    distance_cache : DistanceCache or str
+        the cache of the distance rows passed to ``init_predict_dataset`` (default: ``None``)
+    latency_window : int
+        the number of the latest requests used by the latency percentiles (default: ``10000``)
+    """
+
+    def __init__(self, model, train_dataset, x_column, spatial_column, temp_column=None, max_batch_size=1024,
+                 max_wait_ms=5, process_fn="minmax_scale", distance_cache=None, latency_window=10000):
+        self._model = model
+        self._train_dataset = train_dataset
+        self._x_column = x_column
+        self._spatial_column = spatial_column
+        self._temp_column = temp_column
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._process_fn = process_fn
+        self._distance_cache = distance_cache
+        self._queue = None
+        self._task = None
+        self._executor = None
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._start_time = None
+        self._requests = 0
+        self._points = 0
+        self._batches = 0
+        self._predict_seconds = 0.
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def start(self):
+        """
+        start collecting the requests in the running event loop
+        """
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        # one worker thread keeps the forward passes in order and off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._start_time = time.perf_counter()
+        self._task = asyncio.get_running_loop().create_task(self._collect())
+
+    async def stop(self):
+        """
+        predict the requests already received and stop
+        """
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._executor.shutdown()
+
+    async def predict(self, points):
+        """
+        predict the points of a request
+
+        Parameters
+        ----------
+        points : dataframe or list
+            the points to be predicted, a Pandas dataframe or a list of dict with the columns of
+            ``x_column``, ``spatial_column`` and ``temp_column``
+
+        Returns
+        -------
+        dataframe
+            the Pandas dataframe of the points with the predicted result ``pred_result``
+        """
+        if self._task is None:
+            raise RuntimeError("the predictor is not started")
+        if not isinstance(points, pd.DataFrame):
+            points = pd.DataFrame(points)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((points, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        """
+        collect the requests into batches until ``stop`` is called
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            size = len(item[0])
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                size += len(item[0])
+            await self._run_batch(loop, batch)
+
+    async def _run_batch(self, loop, batch):
+        """
+        predict a batch and fan the result out to the requests
+        """
+        frames = [points for points, _, _ in batch]
+        start = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(self._executor, self._predict_frame,
+                                                pd.concat(frames, ignore_index=True))
+        except Exception as error:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        end = time.perf_counter()
+        self._predict_seconds += end - start
+        self._batches += 1
+        offset = 0
+        for points, future, received in batch:
+            self._requests += 1
+            self._points += len(points)
+            self._latencies.append(end - received)
+            if not future.done():
+                future.set_result(points.assign(pred_result=result[offset:offset + len(points)]))
+            offset += len(points)
+
+    def _predict_frame(self, data):
+        """
+        compute the distances of the points at once and predict them in a single forward pass
+        """
+        dataset = init_predict_dataset(data, self._train_dataset, self._x_column,
+                                       spatial_column=self._spatial_column, temp_column=self._temp_column,
+                                       process_fn=self._process_fn, distance_cache=self._distance_cache)
+        return self._model.predict(dataset)['pred_result'].values
+
+    def metrics(self):
+        """
+        get the latency and throughput of the predictor
+
+        Returns
+        -------
+        dict
+            the number of requests, points and batches, the mean batch size, the throughput in points and requests
+            per second, the share of time spent in forward passes and the latency percentiles in milliseconds
+        """
+        elapsed = time.perf_counter() - self._start_time if self._start_time is not None else 0.
+        latencies = np.array(self._latencies) * 1000
+        return {
+            "requests": self._requests,
+            "points": self._points,
+            "batches": self._batches,
+            "mean_batch_size": self._points / self._batches if self._batches else 0.,
+            "points_per_second": self._points / elapsed if elapsed > 0 else 0.,
+            "requests_per_second": self._requests / elapsed if elapsed > 0 else 0.,
+            "busy_ratio": self._predict_seconds / elapsed if elapsed > 0 else 0.,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.,
+            "latency_p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else 0.,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.,
+        }
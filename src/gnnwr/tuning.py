@@ -0,0 +1,447 @@
+import copy
+import math
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from .models import GNNWR
+from .utils import ExecutionConfig, NullSink, TensorBoardSink
+
+r"""
+The package of `tuning` includes the hyperparameter search of GNNWR/GTNNWR:
+    1. HyperparameterSearch: search the hyperparameters with trials running in parallel worker processes
+    2. RandomSampler/BayesianSampler: suggest the hyperparameters of the next trial
+    3. MedianPruner/SuccessiveHalvingPruner: stop unpromising trials early by their validation loss
+    4. tune_execution: choose the threads and the dataloader workers of a model by timing a few epochs
+All the trials share the datasets prepared once by ``init_dataset``.
+
+A search space is a dict from the arguments of the model to their candidates:
+    | a list is a categorical choice, i.e. ``{"optimizer": ["Adam", "Adagrad"], "dense_layers": [[64], [128, 32]]}``
+    | a tuple ``(low, high)`` is a uniform range, integer if both ends are integers, i.e. ``{"drop_out": (0., 0.5)}``
+    | a tuple ``(low, high, "log")`` is a log-uniform range, i.e. ``{"start_lr": (1e-3, 1e-1, "log")}``
+"""
+
+
+def _sample_value(spec, rng):
+    """
+    sample a value of one dimension of the search space
+    """
+    if isinstance(spec, list):
+        return copy.deepcopy(spec[rng.randint(len(spec))])
+    low, high = spec[0], spec[1]
+    if len(spec) > 2 and spec[2] == "log":
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        return int(round(value)) if isinstance(low, int) and isinstance(high, int) else value
+    if isinstance(low, int) and isinstance(high, int):
+        return int(rng.randint(low, high + 1))
+    return float(rng.uniform(low, high))
+
+
+def _to_unit(spec, value):
+    """
+    map a value of a numeric dimension to [0, 1]
+    """
+    low, high = spec[0], spec[1]
+    if len(spec) > 2 and spec[2] == "log":
+        low, high, value = math.log(low), math.log(high), math.log(value)
+    return (value - low) / (high - low) if high > low else 0.5
+
+
+class RandomSampler:
+    """
+    RandomSampler samples every trial independently from the search space
+    """
+
+    def suggest(self, space, trials, rng):
+        """
+        suggest the hyperparameters of the next trial
+
+        :param space: search space
+        :param trials: results of the finished trials
+        :param rng: numpy.random.RandomState
+        :return: dict of hyperparameters
+        """
+        return {name: _sample_value(spec, rng) for name, spec in space.items()}
+
+
+class BayesianSampler(RandomSampler):
+    """
+    BayesianSampler is a tree-structured Parzen estimator:
+    | the finished trials are split into the best ``gamma`` fraction and the others, and among ``n_candidates``
+    | random candidates the one maximizing the ratio of the densities of the two groups is suggested
+
+    :param n_startup: number of random trials before using the estimator
+    :param gamma: fraction of the finished trials regarded as good
+    :param n_candidates: number of candidates evaluated for each suggestion
+    """
+
+    def __init__(self, n_startup=8, gamma=0.25, n_candidates=24):
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.n_candidates = n_candidates
+
+    def suggest(self, space, trials, rng):
+        finished = [trial for trial in trials if trial["best_valid_loss"] is not None]
+        if len(finished) < self.n_startup:
+            return super(BayesianSampler, self).suggest(space, trials, rng)
+        finished = sorted(finished, key=lambda trial: trial["best_valid_loss"])
+        n_good = max(1, int(math.ceil(self.gamma * len(finished))))
+        good, bad = finished[:n_good], finished[n_good:]
+        candidates = [super(BayesianSampler, self).suggest(space, trials, rng) for _ in range(self.n_candidates)]
+        scores = [sum(self._log_density(spec, candidate[name], [trial["params"][name] for trial in good]) -
+                      self._log_density(spec, candidate[name], [trial["params"][name] for trial in bad])
+                      for name, spec in space.items())
+                  for candidate in candidates]
+        return candidates[int(np.argmax(scores))]
+
+    @staticmethod
+    def _log_density(spec, value, observed):
+        """
+        log density of a value under the Parzen estimator of the observed values, mixed with the uniform prior
+        """
+        if isinstance(spec, list):
+            counts = sum(1 for item in observed if item == value)
+            return math.log((counts + 1) / (len(observed) + len(spec)))
+        x = _to_unit(spec, value)
+        points = np.array([_to_unit(spec, item) for item in observed])
+        bandwidth = max(0.05, 1.0 / max(1, len(points)) ** 0.2 / 2)
+        kernels = np.exp(-0.5 * ((x - points) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi))
+        return math.log((kernels.sum() + 1) / (len(points) + 1))
+
+
+class MedianPruner:
+    """
+    MedianPruner stops a trial if its best validation loss is worse than the median of the other trials
+    at the same epoch
+
+    :param warmup_epochs: number of epochs before pruning
+    :param interval: number of epochs between two checks
+    :param min_trials: minimum number of other trials reported at the epoch to prune
+    """
+
+    def __init__(self, warmup_epochs=50, interval=10, min_trials=4):
+        self.warmup_epochs = warmup_epochs
+        self.interval = interval
+        self.min_trials = min_trials
+
+    def should_prune(self, history, trial_id, epoch, value):
+        """
+        record the value of a trial and decide whether to stop it
+
+        :param history: dict shared by the trials, ``(epoch, trial_id) -> value``
+        :param trial_id: id of the trial
+        :param epoch: number of the finished epochs
+        :param value: best validation loss of the trial
+        :return: whether to stop the trial
+        """
+        if epoch < self.warmup_epochs or (epoch - self.warmup_epochs) % self.interval != 0:
+            return False
+        history[(epoch, trial_id)] = value
+        others = [v for (e, t), v in history.items() if e == epoch and t != trial_id]
+        if len(others) < self.min_trials:
+            return False
+        return value > float(np.median(others))
+
+
+class SuccessiveHalvingPruner:
+    """
+    SuccessiveHalvingPruner is the asynchronous successive halving:
+    | the rungs are at ``min_epochs * reduction_factor ** k`` epochs, a trial reaching a rung continues only if it is
+    | in the best ``1 / reduction_factor`` of the trials reported at the rung
+
+    :param min_epochs: number of epochs of the first rung
+    :param reduction_factor: reduction factor between two rungs
+    """
+
+    def __init__(self, min_epochs=20, reduction_factor=3):
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+
+    def should_prune(self, history, trial_id, epoch, value):
+        rung = epoch / self.min_epochs
+        if rung < 1:
+            return False
+        k = math.log(rung, self.reduction_factor)
+        if abs(k - round(k)) > 1e-9:
+            return False
+        history[(epoch, trial_id)] = value
+        values = sorted(v for (e, t), v in history.items() if e == epoch)
+        if len(values) < self.reduction_factor:
+            return False
+        n_keep = max(1, len(values) // self.reduction_factor)
+        return value > values[n_keep - 1]
+
+
+def _run_trial(state, trial_id, params, history):
+    """
+    train one model with the hyperparameters and report the result
+
+    :param state: shared state of the search, including datasets and settings
+    :param trial_id: id of the trial
+    :param params: hyperparameters of the trial
+    :param history: dict shared by the trials for the pruner
+    :return: result of the trial
+    """
+    start = time.time()
+    torch.manual_seed(state["seed"] + trial_id)
+    np.random.seed(state["seed"] + trial_id)
+    kwargs = copy.deepcopy(state["fixed_params"])
+    kwargs.update(params)
+    # the default activate function is a single module instance, give each trial its own
+    kwargs.setdefault("activate_func", nn.PReLU(init=0.4))
+    name = "trial_" + str(trial_id)
+    save_path = state["save_path"]
+    # a SummaryWriter per trial is only created when the runs of TensorBoard are asked for
+    kwargs.setdefault("metrics_sink", TensorBoardSink(os.path.join(save_path, "runs", name)) if state["tensorboard"]
+                      else NullSink())
+    model = state["model_class"](state["train_dataset"], state["valid_dataset"], state["test_dataset"],
+                                 model_name=name, model_save_path=os.path.join(save_path, "models"),
+                                 write_path=os.path.join(save_path, "runs", name),
+                                 log_path=os.path.join(save_path, "logs") + "/", log_file_name=name + ".log",
+                                 **kwargs)
+    pruner = state["pruner"]
+    pruned = []
+
+    def callback(trained_model, epoch):
+        if pruner is not None and pruner.should_prune(history, trial_id, epoch + 1,
+                                                      min(trained_model._validLossList)):
+            pruned.append(epoch + 1)
+            return True
+        return False
+
+    try:
+        model.run(state["max_epoch"], state["early_stop"], print_frequency=state["max_epoch"] + 1,
+                  show_detailed_info=False, callback=callback)
+    finally:
+        kwargs["metrics_sink"].close()
+    return {"trial": trial_id,
+            "params": params,
+            "state": "pruned" if pruned else "complete",
+            "epochs": len(model._validLossList),
+            "best_valid_loss": float(min(model._validLossList)),
+            "best_valid_r2": float(model._bestr2),
+            "seconds": time.time() - start}
+
+
+_worker_state = {}
+
+
+def _init_worker(state, num_threads):
+    _worker_state.update(state)
+    torch.set_num_threads(num_threads)
+
+
+def _run_pool_trial(trial_id, params, history):
+    return _run_trial(_worker_state, trial_id, params, history)
+
+
+class HyperparameterSearch:
+    r"""
+    HyperparameterSearch searches the hyperparameters of GNNWR/GTNNWR on datasets prepared once by ``init_dataset``,
+    the trials run in ``n_jobs`` worker processes and unpromising ones are stopped early by the pruner.
+
+    Parameters
+    ----------
+    train_dataset : baseDataset
+        the dataset of training
+    valid_dataset : baseDataset
+        the dataset of validation
+    test_dataset : baseDataset
+        the dataset of testing
+    search_space : dict
+        the candidates of the arguments of the model (see the description of the module)
+    model_class : type
+        the class of the model (default: ``GNNWR``)
+    fixed_params : dict
+        the arguments of the model shared by all trials (default: ``None``)
+    sampler : str or object
+        ``"random"``, ``"bayesian"`` or an object with ``suggest(space, trials, rng)`` (default: ``"bayesian"``)
+    pruner : str or object
+        ``"median"``, ``"halving"``, ``None`` or an object with ``should_prune(history, trial_id, epoch, value)``
+        (default: ``"median"``)
+    n_trials : int
+        the number of trials (default: ``20``)
+    n_jobs : int
+        the number of worker processes, the trials run in the current process if ``1`` (default: ``1``)
+    max_epoch : int
+        the max epoch of each trial (default: ``1000``)
+    early_stop : int
+        the early stop of each trial, see ``GNNWR.run`` (default: ``-1``)
+    seed : int
+        the random seed (default: ``42``)
+    save_path : str
+        the directory of the models, logs and runs of the trials (default: ``"../gnnwr_search"``)
+    tensorboard : bool
+        whether write the metrics of each trial to TensorBoard in ``save_path/runs`` (default: ``False``)
+
+        the metrics sink of the trials can also be set by ``fixed_params["metrics_sink"]``
+    """
+
+    def __init__(self, train_dataset, valid_dataset, test_dataset, search_space, model_class=GNNWR, fixed_params=None,
+                 sampler="bayesian", pruner="median", n_trials=20, n_jobs=1, max_epoch=1000, early_stop=-1, seed=42,
+                 save_path="../gnnwr_search", tensorboard=False):
+        self._train_dataset = train_dataset
+        self._valid_dataset = valid_dataset
+        self._test_dataset = test_dataset
+        self._search_space = search_space
+        self._model_class = model_class
+        self._fixed_params = fixed_params if fixed_params is not None else {}
+        if sampler == "random":
+            self._sampler = RandomSampler()
+        elif sampler == "bayesian":
+            self._sampler = BayesianSampler()
+        elif isinstance(sampler, str):
+            raise ValueError("sampler must be 'random' or 'bayesian'")
+        else:
+            self._sampler = sampler
+        if pruner == "median":
+            self._pruner = MedianPruner()
+        elif pruner == "halving":
+            self._pruner = SuccessiveHalvingPruner()
+        elif isinstance(pruner, str):
+            raise ValueError("pruner must be 'median', 'halving' or None")
+        else:
+            self._pruner = pruner
+        self._n_trials = n_trials
+        self._n_jobs = n_jobs
+        self._max_epoch = max_epoch
+        self._early_stop = early_stop
+        self._seed = seed
+        self._save_path = save_path
+        self._tensorboard = tensorboard
+        self.trials = []  # results of the finished trials
+
+    def _state(self):
+        return {"train_dataset": self._train_dataset, "valid_dataset": self._valid_dataset,
+                "test_dataset": self._test_dataset, "model_class": self._model_class,
+                "fixed_params": self._fixed_params, "pruner": self._pruner, "max_epoch": self._max_epoch,
+                "early_stop": self._early_stop, "seed": self._seed, "save_path": self._save_path,
+                "tensorboard": self._tensorboard}
+
+    def run(self):
+        """
+        run the search
+
+        Returns
+        -------
+        dataframe
+            the leaderboard of the trials
+        """
+        rng = np.random.RandomState(self._seed)
+        if self._n_jobs <= 1:
+            history = {}
+            for trial_id in range(self._n_trials):
+                params = self._sampler.suggest(self._search_space, self.trials, rng)
+                self.trials.append(_run_trial(self._state(), trial_id, params, history))
+            return self.leaderboard()
+        num_threads = max(1, (os.cpu_count() or 1) // self._n_jobs)
+        with multiprocessing.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=self._n_jobs, initializer=_init_worker,
+                                    initargs=(self._state(), num_threads)) as executor:
+            history = manager.dict()
+            pending = {}
+            next_id = 0
+            while next_id < self._n_trials or pending:
+                # keep every worker busy, suggesting with the results finished so far
+                while next_id < self._n_trials and len(pending) < self._n_jobs:
+                    params = self._sampler.suggest(self._search_space, self.trials, rng)
+                    pending[executor.submit(_run_pool_trial, next_id, params, history)] = next_id
+                    next_id += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    self.trials.append(future.result())
+        return self.leaderboard()
+
+    def leaderboard(self):
+        """
+        get the leaderboard of the finished trials, sorted by the best validation loss
+
+        Returns
+        -------
+        dataframe
+            one row per trial with its hyperparameters, state, epochs, best validation loss/R2 and time
+        """
+        rows = []
+        for trial in self.trials:
+            row = {"trial": trial["trial"]}
+            row.update(trial["params"])
+            row.update({key: trial[key] for key in ("state", "epochs", "best_valid_loss", "best_valid_r2", "seconds")})
+            rows.append(row)
+        result = pd.DataFrame(rows)
+        if len(result):
+            result = result.sort_values("best_valid_loss").reset_index(drop=True)
+        return result
+
+    def best_params(self):
+        """
+        get the hyperparameters of the best trial
+
+        Returns
+        -------
+        dict
+            the hyperparameters of the trial with the lowest validation loss
+        """
+        return min(self.trials, key=lambda trial: trial["best_valid_loss"])["params"]
+
+
+def _thread_candidates():
+    """
+    the powers of 2 up to the available CPUs, and the available CPUs
+    """
+    cpus = len(ExecutionConfig.available_cpus())
+    candidates = [2 ** i for i in range(cpus.bit_length()) if 2 ** i < cpus]
+    return candidates + [cpus]
+
+
+def tune_execution(model, num_threads=None, num_workers=(0,), n_epochs=2, warmup=1, verbose=True):
+    """
+    choose the ``ExecutionConfig`` of a model by timing a few epochs of training with each candidate, the model is
+    not changed by the timing (see ``GNNWR.time_epochs``) and uses the fastest config afterwards
+
+    Parameters
+    ----------
+    model : GNNWR
+        the model, created with ``use_gpu=False``
+    num_threads : list
+        the candidates of the intra-op threads (default: ``None``, the powers of 2 up to the available CPUs)
+    num_workers : list
+        the candidates of the workers of the dataloaders, the workers are persistent (default: ``(0,)``)
+    n_epochs : int
+        the number of the timed epochs of each candidate (default: ``2``)
+    warmup : int
+        the number of the epochs run before the timed ones (default: ``1``)
+    verbose : bool
+        whether print the time of each candidate (default: ``True``)
+
+    Returns
+    -------
+    tuple
+        the fastest ``ExecutionConfig`` and a dataframe of the seconds per epoch of the candidates, fastest first
+    """
+    if num_threads is None:
+        num_threads = _thread_candidates()
+    initial_threads = torch.get_num_threads()
+    rows = []
+    configs = []
+    try:
+        for threads in num_threads:
+            for workers in num_workers:
+                execution = ExecutionConfig(num_threads=threads, num_workers=workers, persistent_workers=workers > 0)
+                seconds = model.time_epochs(n_epochs, execution, warmup)
+                if verbose:
+                    print("threads: {}  workers: {}  seconds/epoch: {:.4f}".format(threads, workers, seconds))
+                rows.append({"num_threads": threads, "num_workers": workers, "seconds_per_epoch": seconds})
+                configs.append(execution)
+    finally:
+        torch.set_num_threads(initial_threads)
+    best = configs[int(np.argmin([row["seconds_per_epoch"] for row in rows]))]
+    model._execution = best
+    result = pd.DataFrame(rows).sort_values("seconds_per_epoch").reset_index(drop=True)
+    return best, result
@@ -1,34 +1,74 @@
+import contextlib
+import csv
 import math
-import statsmodels.api as sm
+import os
+import time
+import tracemalloc
+import numpy as np
 import pandas as pd
 import torch
 import warnings
-from scipy.stats import f
-from scipy.stats import t
-import folium
-from folium.plugins import HeatMap, MarkerCluster
-import branca
+
+
+def least_squares(x_data, y_data, weights=None, ridge=0.):
+    """
+    solve the (optionally weighted or ridge) least squares of ``y_data`` on ``x_data`` in float64
+    by ``torch.linalg.lstsq``, a rank deficient ``x_data`` gets the minimum norm solution
+
+    :param x_data: array (n, k) of the independent variables, whose last column is the intercept column of ones,
+                   as ``x_data`` of the datasets
+    :param y_data: array (n,) or (n, 1) of the dependent variable
+    :param weights: the weight of each sample (default: ``None``, all ``1``)
+    :param ridge: the L2 penalty of the coefficients, the intercept is not penalized (default: ``0``)
+    :return: list of the k coefficients, the intercept is the last one
+    """
+    x = torch.as_tensor(np.asarray(x_data, dtype=np.float64))
+    y = torch.as_tensor(np.asarray(y_data, dtype=np.float64)).reshape(-1, 1)
+    if weights is not None:
+        root = torch.as_tensor(np.sqrt(np.asarray(weights, dtype=np.float64))).reshape(-1, 1)
+        x, y = x * root, y * root
+    if ridge > 0:
+        # the penalty is solved as extra rows sqrt(ridge) * I, which keep the problem a least squares one
+        penalty = torch.eye(x.shape[1], dtype=torch.float64)[:-1] * math.sqrt(ridge)
+        x = torch.cat([x, penalty], 0)
+        y = torch.cat([y, torch.zeros(penalty.shape[0], 1, dtype=torch.float64)], 0)
+    return torch.linalg.lstsq(x, y, driver="gelsd").solution[:, 0].tolist()
 
 
 class OLS:
     """
-    OLS is the class to calculate the OLR weights of data.Get the weight by `object.params`.
+    OLS is the class to calculate the OLR weights of data.Get the weight by `object.params`,
+    the coefficients of ``xName`` followed by the intercept.
+    The weights are solved by ``least_squares``, statsmodels is only used by ``summary``.
 
     :param dataset: Input data
     :param xName: the independent variables' column
     :param yName: the dependent variable's column
+    :param weights: the weight of each sample (default: ``None``)
+    :param ridge: the L2 penalty of the coefficients, the intercept is not penalized (default: ``0``)
     """
 
-    def __init__(self, dataset, xName: list, yName: list):
+    def __init__(self, dataset, xName: list, yName: list, weights=None, ridge=0.):
         self.__dataset = dataset
         self.__xName = xName
         self.__yName = yName
-        self.__formula = yName[0] + '~' + '+'.join(xName)
-        self.__fit = sm.formula.ols(self.__formula, dataset).fit()
-        self.params = list(self.__fit.params.to_dict().values())
-        intercept = self.__fit.params[0]
-        self.params = self.params[1:]
-        self.params.append(intercept)
+        self.__weights = weights
+        self.__ridge = ridge
+        x_data = np.concatenate([dataset[xName].to_numpy(dtype=np.float64), np.ones((len(dataset), 1))], axis=1)
+        self.params = least_squares(x_data, dataset[yName[0]].to_numpy(dtype=np.float64), weights, ridge)
+
+    def summary(self):
+        """
+        :return: the summary of the fit by statsmodels, with the standard errors and the tests of the coefficients
+        """
+        if self.__ridge > 0:
+            raise ValueError("the summary is not available for the ridge regression")
+        import statsmodels.api as sm  # imported on first use, it is slow to import
+        x_data = sm.add_constant(self.__dataset[self.__xName].astype(np.float64), prepend=False)
+        y_data = self.__dataset[self.__yName[0]].astype(np.float64)
+        if self.__weights is None:
+            return sm.OLS(y_data, x_data).fit().summary()
+        return sm.WLS(y_data, x_data, weights=self.__weights).fit().summary()
 
 
 class DIAGNOSIS:
@@ -175,6 +215,469 @@ class DIAGNOSIS:
         return torch.sqrt(torch.sum(self.__residual ** 2) / self.__n)
 
 
+class PhaseTimer:
+    """
+    PhaseTimer records the wall time, and optionally the peak memory, of the phases of each epoch.
+    The time of a phase excludes the phases nested in it, so the phases of an epoch add up to its time.
+    The peak memory is the peak of CUDA memory if CUDA is available, otherwise the peak of the memory
+    traced by ``tracemalloc`` (allocations of python and numpy).
+
+    :param enabled: whether record the phases
+    :param track_memory: whether record the peak memory of the phases
+    :param record_functions: whether mark the phases in the trace of ``torch.profiler``
+    """
+
+    def __init__(self, enabled=True, track_memory=False, record_functions=False):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.record_functions = record_functions
+        self.records = []  # one dict for each epoch
+        self._current = None
+        self._stack = []
+        self._epoch_start = None
+        self._tracing = False  # whether tracemalloc is started by the timer
+
+    def start_epoch(self, epoch):
+        """
+        start recording the phases of an epoch
+        """
+        if not self.enabled:
+            return
+        if self.track_memory and not torch.cuda.is_available() and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._current = {"epoch": epoch}
+        self._epoch_start = time.perf_counter()
+
+    def end_epoch(self):
+        """
+        finish recording the epoch
+
+        :return: the record of the epoch, ``None`` if not enabled
+        """
+        if not self.enabled or self._current is None:
+            return None
+        self._current["total_seconds"] = time.perf_counter() - self._epoch_start
+        self.records.append(self._current)
+        record, self._current = self._current, None
+        return record
+
+    def close(self):
+        """
+        stop ``tracemalloc`` if it is started by the timer
+        """
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _reset_peak(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            tracemalloc.reset_peak()
+
+    def _peak_mb(self):
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        record the code in the ``with`` block as the phase ``name``, a phase entered several times in an epoch
+        is accumulated
+        """
+        if not self.enabled or self._current is None:
+            yield
+            return
+        entry = {"child_seconds": 0., "peak_mb": 0.}
+        self._stack.append(entry)
+        if self.track_memory:
+            self._reset_peak()
+        start = time.perf_counter()
+        try:
+            if self.record_functions:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            key = name + "_seconds"
+            self._current[key] = self._current.get(key, 0.) + elapsed - entry["child_seconds"]
+            if self.track_memory:
+                peak = max(self._peak_mb(), entry["peak_mb"])
+                self._current[name + "_peak_mb"] = max(self._current.get(name + "_peak_mb", 0.), peak)
+            if self._stack:
+                self._stack[-1]["child_seconds"] += elapsed
+                self._stack[-1]["peak_mb"] = max(self._stack[-1]["peak_mb"], entry["peak_mb"],
+                                                 self._current.get(name + "_peak_mb", 0.))
+
+    def iterate(self, iterable, name):
+        """
+        iterate over ``iterable`` and record the time of getting each item as the phase ``name``,
+        i.e. the loading and collation of the batches of a DataLoader
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def to_dataframe(self):
+        """
+        :return: the Pandas dataframe of the records, one row for each epoch
+        """
+        return pd.DataFrame(self.records)
+
+
+class ExecutionConfig:
+    """
+    ExecutionConfig is the CPU execution settings of the training and the inference: the threads of torch,
+    the worker processes of the DataLoaders and the CPU affinity of the process.
+    It is accepted by ``init_dataset``, ``init_predict_dataset``, the models and ``predict``;
+    ``None`` keeps the current setting of torch, and ``ExecutionConfig.for_job`` splits the CPUs between
+    several jobs running on the same machine.
+
+    :param num_threads: the intra-op threads, ``torch.set_num_threads``
+    :param num_interop_threads: the inter-op threads, ``torch.set_num_interop_threads``, which torch only accepts
+                                before any inter-op work of the process
+    :param num_workers: the worker processes of the DataLoaders
+    :param pin_memory: whether the DataLoaders put the batches in pinned memory, for the copies to CUDA
+    :param persistent_workers: whether the workers of the DataLoaders are kept between the epochs
+    :param prefetch_factor: the batches loaded in advance by each worker
+    :param cpu_affinity: the CPUs the process may run on, ``os.sched_setaffinity`` (Linux only)
+    """
+
+    def __init__(self, num_threads=None, num_interop_threads=None, num_workers=0, pin_memory=False,
+                 persistent_workers=False, prefetch_factor=None, cpu_affinity=None):
+        if num_workers < 0:
+            raise ValueError("num_workers must be non-negative")
+        if num_workers == 0 and (persistent_workers or prefetch_factor is not None):
+            raise ValueError("persistent_workers and prefetch_factor need num_workers > 0")
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.cpu_affinity = None if cpu_affinity is None else sorted(cpu_affinity)
+
+    @staticmethod
+    def available_cpus():
+        """
+        :return: the CPUs the process may run on
+        """
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+    @classmethod
+    def for_job(cls, n_jobs, job_index, **kwargs):
+        """
+        the config of the job ``job_index`` of ``n_jobs`` jobs sharing the CPUs of the machine, each job gets its own
+        CPUs and as many intra-op threads, so the jobs do not oversubscribe the cores
+
+        :param n_jobs: the number of jobs
+        :param job_index: the index of the job, from ``0`` to ``n_jobs - 1``
+        :param kwargs: the other parameters of the config
+        """
+        if not 0 <= job_index < n_jobs:
+            raise ValueError("job_index must be in [0, n_jobs)")
+        cpus = cls.available_cpus()
+        share = max(len(cpus) // n_jobs, 1)
+        start = (job_index * share) % len(cpus)
+        affinity = cpus[start:start + share]
+        kwargs.setdefault("num_interop_threads", 1)
+        return cls(num_threads=len(affinity), cpu_affinity=affinity, **kwargs)
+
+    def apply(self):
+        """
+        set the threads of torch and the CPU affinity of the process
+
+        :return: the config itself
+        """
+        if self.cpu_affinity is not None:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, self.cpu_affinity)
+            else:
+                warnings.warn("the CPU affinity is not supported on this platform", RuntimeWarning)
+        if self.num_threads is not None and torch.get_num_threads() != self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        if self.num_interop_threads is not None and torch.get_num_interop_threads() != self.num_interop_threads:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                warnings.warn("the inter-op threads can only be set before any inter-op work of the process, "
+                              "they stay {}".format(torch.get_num_interop_threads()), RuntimeWarning)
+        return self
+
+    def dataloader_kwargs(self):
+        """
+        :return: the keyword arguments of ``torch.utils.data.DataLoader``
+        """
+        kwargs = {"num_workers": self.num_workers, "pin_memory": self.pin_memory}
+        if self.num_workers > 0:
+            kwargs["persistent_workers"] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                kwargs["prefetch_factor"] = self.prefetch_factor
+        return kwargs
+
+    def configure(self, loader):
+        """
+        the same batches as ``loader`` loaded with the settings of the config
+
+        :param loader: a DataLoader
+        :return: ``loader`` if it already has the settings, otherwise a new DataLoader with its dataset, sampler and
+                 collate function
+        """
+        from torch.utils.data import DataLoader
+        if all(getattr(loader, key) == value for key, value in self.dataloader_kwargs().items()):
+            return loader
+        if loader.batch_size is None:
+            # the dataset is indexed by whole batches, i.e. the lazily evaluated distances
+            return DataLoader(loader.dataset, sampler=loader.sampler, batch_size=None, collate_fn=loader.collate_fn,
+                              **self.dataloader_kwargs())
+        return DataLoader(loader.dataset, batch_sampler=loader.batch_sampler, collate_fn=loader.collate_fn,
+                          **self.dataloader_kwargs())
+
+    def to_dict(self):
+        return {"num_threads": self.num_threads, "num_interop_threads": self.num_interop_threads,
+                "num_workers": self.num_workers, "pin_memory": self.pin_memory,
+                "persistent_workers": self.persistent_workers, "prefetch_factor": self.prefetch_factor,
+                "cpu_affinity": self.cpu_affinity}
+
+    def __repr__(self):
+        return "ExecutionConfig(" + ", ".join("{}={!r}".format(key, value) for key, value in self.to_dict().items()
+                                              if value is not None) + ")"
+
+
+class MetricsSink:
+    """
+    MetricsSink receives the metrics of the training, a dict of ``{tag: value}`` for each logged epoch.
+    The records are buffered and written ``flush_every`` records at a time by ``_write_records``,
+    so the training loop does not wait for the storage every epoch.
+    Subclasses implement ``_write_records``; ``flush`` is called at the end of ``run``.
+
+    :param flush_every: the number of records buffered before they are written
+    """
+
+    enabled = True  # whether the metrics should be computed for the sink at all
+
+    def __init__(self, flush_every=1):
+        if flush_every < 1:
+            raise ValueError("flush_every must be positive")
+        self.flush_every = flush_every
+        self._buffer = []
+
+    def write(self, step, metrics):
+        """
+        record the metrics of a step (the epoch, counted from 0)
+
+        :param step: the step of the metrics
+        :param metrics: dict of ``{tag: value}``, the values are python numbers
+        """
+        self._buffer.append((step, metrics))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        write the buffered records
+        """
+        if self._buffer:
+            records, self._buffer = self._buffer, []
+            self._write_records(records)
+
+    def close(self):
+        """
+        write the buffered records and release the resources of the sink
+        """
+        self.flush()
+
+    def _write_records(self, records):
+        raise NotImplementedError
+
+
+class NullSink(MetricsSink):
+    """
+    NullSink drops the metrics. With it, and the logging disabled, the metrics of the epochs that are not printed
+    are not computed at all, so the training is pure computation.
+    """
+
+    enabled = False
+
+    def write(self, step, metrics):
+        pass
+
+    def _write_records(self, records):
+        pass
+
+
+class MemorySink(MetricsSink):
+    """
+    MemorySink keeps the metrics in memory, e.g. for the tuning or for notebooks.
+    """
+
+    def __init__(self):
+        super(MemorySink, self).__init__(flush_every=1)
+        self.records = []  # list of (step, metrics)
+
+    def _write_records(self, records):
+        self.records.extend(records)
+
+    def to_dataframe(self):
+        """
+        :return: the Pandas dataframe of the metrics, one row for each step and one column for each tag
+        """
+        rows = {}
+        for step, metrics in self.records:
+            rows.setdefault(step, {"epoch": step}).update(metrics)
+        return pd.DataFrame(list(rows.values()))
+
+
+class CSVSink(MetricsSink):
+    """
+    CSVSink appends the metrics to a CSV file with the columns ``epoch``, ``tag`` and ``value``,
+    one row for each metric, so the tags may differ between the steps.
+
+    :param path: the path of the CSV file, it is overwritten by the first write
+    :param flush_every: the number of records buffered before they are written (default: ``50``)
+    """
+
+    def __init__(self, path, flush_every=50):
+        super(CSVSink, self).__init__(flush_every)
+        self.path = path
+        self._started = False
+
+    def _write_records(self, records):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, "a" if self._started else "w", newline="") as file:
+            writer = csv.writer(file)
+            if not self._started:
+                writer.writerow(["epoch", "tag", "value"])
+                self._started = True
+            writer.writerows((step, tag, value) for step, metrics in records for tag, value in metrics.items())
+
+
+class TensorBoardSink(MetricsSink):
+    """
+    TensorBoardSink writes the metrics as scalars of TensorBoard. Tensorboard is imported and the run directory is
+    created on the first write, so that a model only used for prediction does not pay for them.
+
+    :param log_dir: the directory of the run
+    :param flush_every: the number of records buffered before they are given to the ``SummaryWriter`` (default: ``10``)
+    """
+
+    def __init__(self, log_dir=None, flush_every=10):
+        super(TensorBoardSink, self).__init__(flush_every)
+        self._log_dir = log_dir
+        self._writer = None
+
+    @property
+    def writer(self):
+        """
+        the ``SummaryWriter`` of the run, created on first use
+        """
+        if self._writer is None:
+            from torch.utils.tensorboard import SummaryWriter
+            self._writer = SummaryWriter(self._log_dir)
+        return self._writer
+
+    @property
+    def log_dir(self):
+        return self.writer.log_dir if self._log_dir is None else self._log_dir
+
+    def _write_records(self, records):
+        writer = self.writer
+        for step, metrics in records:
+            for tag, value in metrics.items():
+                writer.add_scalar(tag, value, step)
+
+    def close(self):
+        super(TensorBoardSink, self).close()
+        if self._writer is not None:
+            # the file and the thread of the SummaryWriter, a later write opens a new one
+            self._writer.close()
+            self._writer = None
+
+
+def _colormap(colors, vmin, vmax, steps):
+    """
+    the ``StepColormap`` of the maps, ``YlOrRd_09`` if no colors are given
+    """
+    import branca
+    if colors is None or len(colors) <= 0:
+        return branca.colormap.linear.YlOrRd_09.scale(vmin, vmax).to_step(steps)
+    return branca.colormap.LinearColormap(colors=colors, vmin=vmin, vmax=vmax).to_step(steps)
+
+
+def _hex_colors(colormap, values):
+    """
+    the colors of ``values`` in a ``StepColormap`` as ``"#RRGGBB"`` strings, the same as ``colormap.rgb_hex_str``
+    of each value but looked up for all of them at once
+    """
+    index = np.asarray(colormap.index, dtype=float)
+    palette = np.array(["#%02x%02x%02x" % tuple(int(u * 255.9999) for u in color[:3]) for color in colormap.colors])
+    values = np.asarray(values, dtype=float)
+    position = np.clip(np.searchsorted(index, values, side="left") - 1, 0, len(palette) - 1)
+    position[values <= index[0]] = 0
+    position[values >= index[-1]] = len(palette) - 1
+    return palette[position]
+
+
+def _grid_bins(points, lon_column, lat_column, y_column, max_points):
+    """
+    aggregate the points into a regular grid of at most ``max_points`` cells, each cell is shown at the mean
+    location of its points with their mean value and their number in the column ``count``
+    """
+    cells = max(int(np.sqrt(max_points)), 1)
+    key = np.zeros(len(points), dtype=np.int64)
+    for column in [lon_column, lat_column]:
+        values = points[column].values
+        span = values.max() - values.min()
+        cell = np.zeros(len(values), dtype=np.int64) if span == 0 else \
+            np.minimum(((values - values.min()) / span * cells).astype(np.int64), cells - 1)
+        key = key * cells + cell
+    grouped = points[[lon_column, lat_column, y_column]].groupby(key)
+    binned = grouped.mean()
+    binned["count"] = grouped.size()
+    return binned.reset_index(drop=True)
+
+
+def _points_layer(points, lon_column, lat_column, y_column, colormap, max_points=None):
+    """
+    the points as a single GeoJSON layer of circle markers colored by ``y_column``, instead of one
+    ``folium.CircleMarker`` for each point, so that maps of many points are fast to build and small
+
+    if there are more than ``max_points`` points, they are aggregated by ``_grid_bins``
+    """
+    import folium
+    fields = [lon_column, lat_column, y_column]
+    points = points[fields]
+    if max_points is not None and len(points) > max_points:
+        points = _grid_bins(points, lon_column, lat_column, y_column, max_points)
+        fields = fields + ["count"]
+    colors = _hex_colors(colormap, points[y_column].values)
+    columns = [points[field].tolist() for field in fields]
+    features = [{"type": "Feature", "id": str(i),
+                 "geometry": {"type": "Point", "coordinates": [row[0], row[1]]},
+                 "properties": dict(zip(fields, row), color=color)}
+                for i, (row, color) in enumerate(zip(zip(*columns), colors.tolist()))]
+    return folium.GeoJson({"type": "FeatureCollection", "features": features},
+                          marker=folium.CircleMarker(radius=7, fill=True, fill_opacity=1),
+                          style_function=lambda feature: {"color": feature["properties"]["color"],
+                                                          "fillColor": feature["properties"]["color"]},
+                          popup=folium.GeoJsonPopup(fields=fields,
+                                                    aliases=["longitude", "latitude"] + fields[2:]))
+
+
 class Visualize:
     def __init__(self, data, lon_lat_columns=None, zoom=4):
         self.__raw_data = data
@@ -201,15 +704,22 @@ class Visualize:
                 self.__lat_column = self._spatial_column[1]
             self._x_column = data._train_dataset.x_column
             self._y_column = data._train_dataset.y_column
+            # folium and branca are imported on first use, only the maps need them
+            import folium
             self.__map = folium.Map(location=[self.__center_lat, self.__center_lon], zoom_start=zoom,
                                     tiles=self.__tiles, attr="高德")
         else:
             raise ValueError("given data is not instance of GNNWR")
 
-    def display_dataset(self, name="all", y_column=None, colors=None, steps=20, vmin=None, vmax=None):
-        # colormap = branca.colormap.linear.RdYlGn_10.scale().to_step(steps)
-        if colors is None:
-            colors = []
+    def display_dataset(self, name="all", y_column=None, colors=None, steps=20, vmin=None, vmax=None,
+                        max_points=None):
+        """
+        show the points of the dataset on a map, colored by ``y_column``
+
+        if ``max_points`` is given and the dataset has more points, they are aggregated into a grid of at most
+        ``max_points`` cells
+        """
+        import folium
         if y_column is None:
             warnings.warn("y_column is not given. Using the first y_column in dataset")
             y_column = self._y_column[0]
@@ -227,35 +737,21 @@ class Visualize:
         dst_max = dst[y_column].max() if vmax == None else vmax
         res = folium.Map(location=[self.__center_lat, self.__center_lon], zoom_start=self.__zoom, tiles=self.__tiles,
                          attr="高德")
-        if len(colors) <= 0:
-            colormap = branca.colormap.linear.YlOrRd_09.scale(dst_min, dst_max).to_step(steps)
-        else:
-            colormap = branca.colormap.LinearColormap(colors=colors, vmin=dst_min, vmax=dst_max).to_step(steps)
-        for idx, row in dst.iterrows():
-            folium.CircleMarker(location=(row[self.__lat_column], row[self.__lon_column]), radius=7,
-                                color=colormap.rgb_hex_str(row[y_column]), fill=True, fill_opacity=1,
-                                popup="""
-            longitude:{}
-            latitude:{}
-            {}:{}
-            """.format(row[self.__lon_column], row[self.__lat_column], y_column, row[y_column])
-                                ).add_to(res)
+        colormap = _colormap(colors, dst_min, dst_max, steps)
+        _points_layer(dst, self.__lon_column, self.__lat_column, y_column, colormap, max_points).add_to(res)
         res.add_child(colormap)
         return res
 
     def weights_heatmap(self, data_column, colors=None, steps=20, vmin=None, vmax=None):
-        if colors is None:
-            colors = []
+        import folium
+        from folium.plugins import HeatMap
         res = folium.Map(location=[self.__center_lat, self.__center_lon], zoom_start=self.__zoom, tiles=self.__tiles,
                          attr="高德")
         dst = self._result_data
         dst_min = dst[data_column].min() if vmin is None else vmin
         dst_max = dst[data_column].max() if vmax is None else vmax
-        data = [[row[self.__lat_column], row[self.__lon_column], row[data_column]] for index, row in dst.iterrows()]
-        if len(colors) <= 0:
-            colormap = branca.colormap.linear.YlOrRd_09.scale(dst_min, dst_max).to_step(steps)
-        else:
-            colormap = branca.colormap.LinearColormap(colors=colors, vmin=dst_min, vmax=dst_max).to_step(steps)
+        data = dst[[self.__lat_column, self.__lon_column, data_column]].values.tolist()
+        colormap = _colormap(colors, dst_min, dst_max, steps)
         gradient_map = dict()
         for i in range(steps):
             gradient_map[i / steps] = colormap.rgb_hex_str(i / steps)
@@ -263,26 +759,21 @@ class Visualize:
         HeatMap(data=data, gradient=gradient_map, radius=10).add_to(res)
         return res
 
-    def dot_map(self, data, lon_column, lat_column, y_column, zoom=4, colors=None, steps=20, vmin=None, vmax=None):
-        if colors is None:
-            colors = []
+    def dot_map(self, data, lon_column, lat_column, y_column, zoom=4, colors=None, steps=20, vmin=None, vmax=None,
+                max_points=None):
+        """
+        show the points of ``data`` on a map, colored by ``y_column``
+
+        if ``max_points`` is given and ``data`` has more points, they are aggregated into a grid of at most
+        ``max_points`` cells
+        """
+        import folium
         center_lon = data[lon_column].mean()
         center_lat = data[lat_column].mean()
         dst_min = data[y_column].min() if vmin is None else vmin
         dst_max = data[y_column].max() if vmax is None else vmax
         res = folium.Map(location=[center_lat, center_lon], zoom_start=zoom, tiles=self.__tiles, attr="高德")
-        if len(colors) <= 0:
-            colormap = branca.colormap.linear.YlOrRd_09.scale(dst_min, dst_max).to_step(steps)
-        else:
-            colormap = branca.colormap.LinearColormap(colors=colors, vmin=dst_min, vmax=dst_max).to_step(steps)
-        for idx, row in data.iterrows():
-            folium.CircleMarker(location=(row[lat_column], row[lon_column]), radius=7,
-                                color=colormap.rgb_hex_str(row[y_column]), fill=True, fill_opacity=1,
-                                popup="""
-            longitude:{}
-            latitude:{}
-            {}:{}
-            """.format(row[lon_column], row[lat_column], y_column, row[y_column])
-                                ).add_to(res)
+        colormap = _colormap(colors, dst_min, dst_max, steps)
+        _points_layer(data, lon_column, lat_column, y_column, colormap, max_points).add_to(res)
         colormap.add_to(res)
         return res